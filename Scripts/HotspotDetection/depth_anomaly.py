@@ -0,0 +1,225 @@
+import cv2
+import numpy as np
+
+# one row per depth anomaly, coordinates are (x, y) pixels of the 240x180 depth frame
+ANOMALY_DTYPE = np.dtype([
+    ("x", np.float32),         # score weighted centroid
+    ("y", np.float32),
+    ("area", np.int32),        # pixels above the threshold
+    ("score", np.float32),     # strongest score, positive is a bump, negative a hollow
+    ("height", np.float32),    # mean height above (or below, negative) the expected surface
+    ("bbox", np.int32, (4,)),  # x, y, width, height
+])
+
+
+def fit_ground_plane(depth, valid, step=4, iterations=3, cutoff=3.0):
+    """
+    Robust least squares fit of the plane depth = a * x + b * y + c.
+
+    The fit runs on every `step`-th pixel; after each pass pixels further than
+    `cutoff` robust standard deviations (from the median absolute deviation)
+    from the plane are left out, so rocks, holes and the odd flying pixel do
+    not tilt it.
+
+    :param depth: (H, W) depth frame.
+    :param valid: (H, W) mask of the pixels to fit.
+    :param step: pixel stride of the fit.
+    :param iterations: fit passes.
+    :param cutoff: outlier cutoff in robust standard deviations.
+    :return: (a, b, c), or None when too few pixels are valid.
+    """
+    ys, xs = np.mgrid[0:depth.shape[0]:step, 0:depth.shape[1]:step]
+    z = depth[::step, ::step]
+    keep = valid[::step, ::step].copy()
+    design = np.stack([xs.ravel(), ys.ravel(), np.ones(xs.size)], axis=1).astype(np.float64)
+    z = z.ravel().astype(np.float64)
+    keep = keep.ravel()
+
+    plane = None
+    for _ in range(iterations):
+        if keep.sum() < 3:
+            return plane
+        plane, *_ = np.linalg.lstsq(design[keep], z[keep], rcond=None)
+        residual = z - design @ plane
+        sigma = 1.4826 * np.median(np.abs(residual[keep])) + 1e-6
+        keep &= np.abs(residual) < cutoff * sigma
+    return plane
+
+
+class DepthAnomalyDetector:
+    """
+    Per-pixel anomaly score of ToF depth frames against the expected ground surface.
+
+    Every frame goes through the same vectorized steps on preallocated buffers:
+
+        1. a robust plane fit removes the tilt and height of the rig over the ground
+        2. a running background of the remaining relief (exponential moving
+           average, frozen where anomalies are) removes the fixed structure of
+           the scene and the sensor's own pattern
+        3. the height left over is compared to the mean of its neighbourhood
+           (box filters, i.e. integral image sums, the same cost for any window)
+           and divided by the frame's noise level (median absolute deviation);
+           a second pass takes the mean again without the pixels the first one
+           found anomalous, so a bump does not sink its surroundings into a
+           hollow ring (and a hollow does not raise a ring of bumps)
+
+    Positive scores are closer than expected (bumps, objects on the surface),
+    negative scores further (hollows, disturbed and sunken soil). Invalid pixels
+    (no depth or low confidence) score 0. `height` holds the height in mm left
+    over after step 2, e.g. for find_anomalies.
+    """
+
+    def __init__(self, window=31, alpha=0.05, threshold=3.0, confidence_value=30, noise=3.0, plane_step=4):
+        """
+        :param window: side in pixels of the neighbourhood, a few times larger than the anomalies looked for.
+        :param alpha: background update weight, 0 disables the running background.
+        :param threshold: score of an anomaly, such pixels are left out of the background update.
+        :param confidence_value: lowest valid confidence.
+        :param noise: lowest noise level in mm, keeps very clean frames from giving huge scores.
+        :param plane_step: pixel stride of the ground plane fit and the noise estimate.
+        """
+        self.window = window
+        self.alpha = alpha
+        self.threshold = threshold
+        self.confidence_value = confidence_value
+        self.noise = noise
+        self.plane_step = plane_step
+        self.plane = None
+        self.background = None
+        self.sigma = noise
+        self._shape = None
+
+    def _allocate(self, shape):
+        self._shape = shape
+        ys, xs = np.mgrid[0:shape[0], 0:shape[1]]
+        self._xs = xs.astype(np.float32)
+        self._ys = ys.astype(np.float32)
+        self.height = np.empty(shape, dtype=np.float32)
+        self._valid = np.empty(shape, dtype=np.float32)
+        self._invalid = np.empty(shape, dtype=bool)
+        self._support = np.empty(shape, dtype=np.float32)
+        self._outlier = np.empty(shape, dtype=bool)
+        self._sum = np.empty(shape, dtype=np.float32)
+        self._count = np.empty(shape, dtype=np.float32)
+        self.score = np.empty(shape, dtype=np.float32)
+        self.background = np.zeros(shape, dtype=np.float32)
+
+    def update(self, depth, confidence=None):
+        """
+        Scores one frame and updates the background.
+
+        :param depth: (H, W) depth frame in mm.
+        :param confidence: optional (H, W) confidence frame.
+        :return: (H, W) float32 anomaly score, overwritten by the next update.
+        """
+        depth = np.asarray(depth, dtype=np.float32)
+        if self._shape != depth.shape:
+            self._allocate(depth.shape)
+        valid = depth > 0
+        if confidence is not None:
+            valid &= confidence >= self.confidence_value
+
+        # 1. height above the ground plane, positive towards the sensor
+        plane = fit_ground_plane(depth, valid, self.plane_step)
+        if plane is not None:
+            self.plane = plane
+        height = self.height
+        if self.plane is None:
+            height[:] = 0
+        else:
+            a, b, c = self.plane
+            np.multiply(self._xs, a, out=height)
+            height += b * self._ys
+            height += c
+            height -= depth
+        np.copyto(self._valid, valid)
+        np.logical_not(valid, out=self._invalid)
+        # zeroed rather than multiplied by the mask, NaN depth would stay NaN
+        np.copyto(height, 0, where=self._invalid)
+
+        # 2. relief left once the background is removed
+        height -= self.background
+        np.copyto(height, 0, where=self._invalid)
+
+        # 3. height against the local mean of the valid pixels, then against the mean of the
+        # pixels the first pass did not find anomalous
+        self._score(self._valid, valid)
+        np.abs(self.score, out=self._sum)
+        np.greater_equal(self._sum, self.threshold, out=self._outlier)
+        if self._outlier.any():
+            np.copyto(self._support, self._valid)
+            np.copyto(self._support, 0, where=self._outlier)
+            self._score(self._support, valid)
+
+        if self.alpha > 0:
+            self._update_background(valid)
+        return self.score
+
+    def _score(self, support, valid):
+        # the sums of the support pixels over the window from box filters, in units of
+        # the frame's robust noise level
+        size = (self.window, self.window)
+        np.multiply(self.height, support, out=self.score)
+        cv2.boxFilter(self.score, -1, size, self._sum, normalize=False, borderType=cv2.BORDER_CONSTANT)
+        cv2.boxFilter(support, -1, size, self._count, normalize=False, borderType=cv2.BORDER_CONSTANT)
+        np.maximum(self._count, 1, out=self._count)
+        self._sum /= self._count
+        np.subtract(self.height, self._sum, out=self.score)
+        np.copyto(self.score, 0, where=self._invalid)
+        sample = self.score[::self.plane_step, ::self.plane_step][valid[::self.plane_step, ::self.plane_step]]
+        self.sigma = max(1.4826 * float(np.median(np.abs(sample))) if sample.size else 0.0, self.noise)
+        self.score /= self.sigma
+
+    def _update_background(self, valid):
+        # anomalies and invalid pixels do not fade into the background
+        relief = self.height + self.background
+        still = valid & (np.abs(self.score) < self.threshold)
+        cv2.accumulateWeighted(relief, self.background, self.alpha, still.view(np.uint8))
+
+    def reset(self):
+        """Forgets the plane and the background, e.g. after the rig was moved to a new spot."""
+        self.plane = None
+        if self.background is not None:
+            self.background[:] = 0
+
+
+def find_anomalies(score, height=None, threshold=3.0, min_area=4):
+    """
+    Groups the pixels scoring beyond the threshold into anomalies.
+
+    :param score: (H, W) anomaly score, see DepthAnomalyDetector.
+    :param height: optional (H, W) height relative to the expected surface in mm.
+    :param threshold: smallest absolute score of an anomalous pixel.
+    :param min_area: smallest anomaly in pixels.
+    :return: structured array with ANOMALY_DTYPE, one row per anomaly.
+    """
+    anomalies = []
+    # bumps and hollows are labelled separately so a bump next to a hole stays two anomalies
+    for sign in (1, -1):
+        mask = (sign * score > threshold).view(np.uint8)
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        if count < 2:
+            continue
+        flat_labels = labels.ravel()
+        weights = np.abs(score).ravel()
+        ys, xs = np.divmod(np.arange(flat_labels.size), score.shape[1])
+        weight = np.bincount(flat_labels, weights=weights, minlength=count)
+        wx = np.bincount(flat_labels, weights=weights * xs, minlength=count)
+        wy = np.bincount(flat_labels, weights=weights * ys, minlength=count)
+        strongest = np.zeros(count, dtype=np.float32)
+        np.maximum.at(strongest, flat_labels, weights)
+
+        keep = np.arange(1, count)
+        keep = keep[stats[keep, cv2.CC_STAT_AREA] >= min_area]
+        found = np.zeros(len(keep), dtype=ANOMALY_DTYPE)
+        found["x"] = wx[keep] / weight[keep]
+        found["y"] = wy[keep] / weight[keep]
+        found["area"] = stats[keep, cv2.CC_STAT_AREA]
+        found["score"] = sign * strongest[keep]
+        if height is not None:
+            found["height"] = np.bincount(flat_labels, weights=height.ravel(), minlength=count)[keep] / found["area"]
+        found["bbox"] = stats[keep, :4]
+        anomalies.append(found)
+    if not anomalies:
+        return np.zeros(0, dtype=ANOMALY_DTYPE)
+    return np.concatenate(anomalies)
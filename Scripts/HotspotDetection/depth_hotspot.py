@@ -1,12 +1,14 @@
 import cv2
 import numpy as np
+import warnings
 
-def extract_depth_values(depth_image_path, points=[]):
+def extract_depth_values(depth_image_path, points=None):
     """
     Extracts depth values from specific points in a depth image.
 
     :param depth_image_path: Path to the depth image (16-bit or 32-bit format).
-    :param points: List of (x, y) coordinates to extract depth from.
+    :param points: List of (x, y) coordinates to extract depth from, rounded to the nearest pixel and
+        clipped to the image like sample_depth; NaN or inf points get NaN.
     :return: Dictionary with pixel coordinates and depth values.
     """
     # Load depth image (ensure it's in grayscale mode)
@@ -21,12 +23,83 @@ def extract_depth_values(depth_image_path, points=[]):
         depth_image = cv2.cvtColor(depth_image, cv2.COLOR_BGR2GRAY)
 
     # Extract depth values at given points
-    depth_values = {}
-    for (x, y) in points:
-        depth = depth_image[y, x]  # Access pixel (y, x)
-        depth_values[(x, y)] = depth
+    points = [] if points is None else points
+    coords, finite = _pixel_coordinates(points, depth_image.shape)
+    values = depth_image[coords[:, 1], coords[:, 0]]  # Access pixels (y, x) at once
+    if not finite.all():
+        values = values.astype(np.float64)
+        values[~finite] = np.nan  # NaN / inf points have no depth
+    return {(x, y): depth for (x, y), depth in zip(points, values)}
 
-    return depth_values
+
+def _pixel_coordinates(points, shape):
+    """
+    Rounds (x, y) points to the nearest pixel of a frame and clips them to it.
+
+    :param points: (N, 2) sub-pixel coordinates.
+    :param shape: (H, W, ...) shape of the frame.
+    :return: ((N, 2) integer coordinates, (N,) mask of the finite points); non-finite points get (0, 0).
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    finite = np.isfinite(points).all(axis=1)
+    coords = np.rint(np.where(finite[:, None], points, 0)).astype(np.intp)
+    np.clip(coords[:, 0], 0, shape[1] - 1, out=coords[:, 0])
+    np.clip(coords[:, 1], 0, shape[0] - 1, out=coords[:, 1])
+    return coords, finite
+
+
+def sample_depth(depth, points, confidence=None, window=1, confidence_value=30, weighted=False):
+    """
+    Samples depth values at many points of an already loaded depth frame.
+
+    Pixels with no depth (0 or NaN) or a confidence below `confidence_value`
+    are invalid. With a window larger than 1 every point returns the median
+    (or the confidence weighted mean) of the valid pixels of the k x k window
+    around it, which rides over single dropped pixels.
+
+    :param depth: (H, W) depth frame.
+    :param points: (N, 2) array of (x, y) pixel coordinates, rounded to the nearest pixel and clipped to
+        the frame; NaN or inf points are invalid.
+    :param confidence: optional (H, W) confidence frame.
+    :param window: odd window size k of the k x k neighbourhood.
+    :param confidence_value: lowest valid confidence.
+    :param weighted: confidence weighted mean instead of the median (needs confidence).
+    :return: ((N,) depths with NaN where no valid pixel was found, mean of all valid depths)
+    """
+    depth = np.asarray(depth)
+    points, finite = _pixel_coordinates(points, depth.shape)
+
+    # validity of every pixel, shared by the point lookups and the frame mean
+    valid = depth > 0
+    if confidence is not None:
+        valid &= confidence >= confidence_value
+    valid_values = depth[valid]
+    mean_depth = float(valid_values.mean()) if valid_values.size > 0 else 0.0
+
+    xs, ys = points[:, 0], points[:, 1]
+
+    if window <= 1:
+        values = depth[ys, xs].astype(np.float64)
+        values[~(valid[ys, xs] & finite)] = np.nan
+        return values, mean_depth
+
+    # k x k neighbourhoods of all points at once through a strided view of the padded frame
+    half = window // 2
+    masked = np.where(valid, depth, np.nan).astype(np.float64)
+    padded = np.pad(masked, half, constant_values=np.nan)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (window, window))[ys, xs]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN windows give NaN
+        if weighted and confidence is not None:
+            weights = np.pad(np.where(valid, confidence, 0).astype(np.float64), half)
+            weights = np.lib.stride_tricks.sliding_window_view(weights, (window, window))[ys, xs]
+            total = weights.sum(axis=(1, 2))
+            values = np.nansum(windows * weights, axis=(1, 2)) / np.where(total > 0, total, np.nan)
+        else:
+            values = np.nanmedian(windows.reshape(len(points), -1), axis=1)
+    values[~finite] = np.nan
+    return values, mean_depth
 
 # # Example usage
 # depth_image_path = "depth_test.png"  # Replace with actual depth image
@@ -34,6 +34,163 @@ def detect_hotspots(thermal_image_path, threshold=200):
     #return image, thresh
     return image, centers
 
+# one row per detected hotspot, coordinates are (x, y) pixels of the raw 24x32 frame
+HOTSPOT_DTYPE = np.dtype([
+    ("frame", np.int32),     # index of the frame in the batch
+    ("x", np.float32),       # centroid weighted by the degrees above the cutoff
+    ("y", np.float32),
+    ("area", np.int32),      # pixels above the threshold
+    ("peak", np.float32),    # hottest temperature in C
+    ("mean", np.float32),    # mean temperature in C
+    ("bbox", np.int32, (4,)),  # x, y, width, height
+])
+
+
+def detect_hotspots_array(temperature, threshold=None, delta=None, background=None, min_area=1):
+    """
+    Detects hotspots directly in temperature frames, no rendered image needed.
+
+    A pixel is hot when it is above the absolute `threshold` and/or more than
+    `delta` degrees above the background. Without a background the median of
+    each frame is used.
+
+    :param temperature: (24, 32) frame or (N, 24, 32) batch of temperatures in C.
+    :param threshold: absolute temperature threshold in C.
+    :param delta: threshold in C relative to the background.
+    :param background: (24, 32) background temperatures or a scalar, see RollingBackground.
+    :param min_area: smallest hotspot in pixels.
+    :return: structured array with HOTSPOT_DTYPE, one row per hotspot.
+    """
+    if threshold is None and delta is None:
+        raise ValueError("Set an absolute threshold, a relative delta or both")
+    frames = np.asarray(temperature, dtype=np.float32)
+    if frames.ndim == 2:
+        frames = frames[np.newaxis]
+    n, rows, cols = frames.shape
+
+    # a pixel is hot above the highest of the cutoffs that are set
+    cutoff = np.full(frames.shape, -np.inf, dtype=np.float32)
+    if threshold is not None:
+        np.maximum(cutoff, np.float32(threshold), out=cutoff)
+    if delta is not None:
+        if background is None:
+            background = np.median(frames.reshape(n, -1), axis=1).reshape(n, 1, 1)
+        np.maximum(cutoff, np.asarray(background, dtype=np.float32) + delta, out=cutoff)
+    hot = frames > cutoff
+
+    # stack the frames with an empty row between them so one labelling pass covers
+    # the whole batch without blobs running from one frame into the next
+    mask = np.zeros((n, rows + 1, cols), dtype=np.uint8)
+    mask[:, :rows] = hot
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask.reshape(-1, cols), connectivity=8)
+    if count < 2:
+        return np.zeros(0, dtype=HOTSPOT_DTYPE)
+
+    # per-blob sums over the whole batch in a few bincount passes, the centroid is
+    # weighted by the degrees above the cutoff, which are > 0 inside every blob
+    # whatever the sign of the temperatures
+    padded = np.zeros((n, rows + 1, cols), dtype=np.float32)
+    padded[:, :rows] = frames
+    excess = np.zeros((n, rows + 1, cols), dtype=np.float32)
+    np.subtract(frames, cutoff, out=excess[:, :rows], where=hot)
+    flat_labels = labels.ravel()
+    flat_temps = padded.ravel()
+    flat_excess = excess.ravel()
+    ys, xs = np.divmod(np.arange(flat_labels.size), cols)
+    total = np.bincount(flat_labels, weights=flat_temps, minlength=count)
+    weight = np.bincount(flat_labels, weights=flat_excess, minlength=count)
+    wx = np.bincount(flat_labels, weights=flat_excess * xs, minlength=count)
+    wy = np.bincount(flat_labels, weights=flat_excess * ys, minlength=count)
+    peak = np.full(count, -np.inf, dtype=np.float32)
+    np.maximum.at(peak, flat_labels, flat_temps)
+
+    keep = np.arange(1, count)
+    keep = keep[stats[keep, cv2.CC_STAT_AREA] >= min_area]
+
+    hotspots = np.zeros(len(keep), dtype=HOTSPOT_DTYPE)
+    top = stats[keep, cv2.CC_STAT_TOP]
+    hotspots["frame"] = top // (rows + 1)
+    hotspots["x"] = wx[keep] / weight[keep]
+    hotspots["y"] = wy[keep] / weight[keep] - hotspots["frame"] * (rows + 1)
+    hotspots["area"] = stats[keep, cv2.CC_STAT_AREA]
+    hotspots["peak"] = peak[keep]
+    hotspots["mean"] = total[keep] / stats[keep, cv2.CC_STAT_AREA]
+    hotspots["bbox"] = np.stack([stats[keep, cv2.CC_STAT_LEFT], top % (rows + 1),
+                                 stats[keep, cv2.CC_STAT_WIDTH], stats[keep, cv2.CC_STAT_HEIGHT]], axis=1)
+    return hotspots
+
+
+class RollingBackground:
+    """
+    Per-pixel background temperature as an exponential moving average.
+
+    Pixels detected as hot are left out of the update so a buried object does
+    not fade into the background while it is in view.
+    """
+
+    def __init__(self, alpha=0.05):
+        """
+        :param alpha: weight of the newest frame in the average.
+        """
+        self.alpha = alpha
+        self.background = None
+
+    def update(self, temperature, hot=None):
+        """
+        Folds a frame into the background.
+
+        :param temperature: (24, 32) frame in C.
+        :param hot: optional mask of pixels to leave out.
+        :return: the updated background.
+        """
+        if self.background is None:
+            self.background = np.array(temperature, dtype=np.float32)
+            if hot is not None and hot.any() and not hot.all():
+                # start hot pixels at the typical scene temperature
+                self.background[hot] = np.median(self.background[~hot])
+            return self.background
+        update = self.alpha * (temperature - self.background)
+        if hot is not None:
+            update[hot] = 0
+        self.background += update
+        return self.background
+
+
+class HotspotDetector:
+    """
+    Streaming hotspot detection on temperature frames against a rolling background.
+    """
+
+    def __init__(self, threshold=None, delta=5.0, alpha=0.05, min_area=1):
+        """
+        :param threshold: absolute temperature threshold in C.
+        :param delta: threshold in C above the rolling background.
+        :param alpha: background update weight, see RollingBackground.
+        :param min_area: smallest hotspot in pixels.
+        """
+        self.threshold = threshold
+        self.delta = delta
+        self.min_area = min_area
+        self.background = RollingBackground(alpha)
+
+    def detect(self, temperature):
+        """
+        Detects the hotspots of one frame and updates the background.
+
+        :param temperature: (24, 32) frame in C.
+        :return: structured array with HOTSPOT_DTYPE.
+        """
+        background = self.background.background
+        if background is None:
+            background = np.median(temperature)
+        hotspots = detect_hotspots_array(temperature, self.threshold, self.delta, background, self.min_area)
+
+        hot = None
+        if self.delta is not None:
+            hot = temperature > np.asarray(background) + self.delta
+        self.background.update(temperature, hot)
+        return hotspots
+
 # thermal_image = "1.png"
 # #hotspot_image, thresholded = detect_hotspots(thermal_image, threshold=200)
 # hotspot_image, centers = detect_hotspots(thermal_image, threshold=200)
@@ -1,40 +1,204 @@
-from depth_hotspot import extract_depth_values
+from depth_hotspot import sample_depth
 from thermal_hotspot import detect_hotspots
 import cv2
 import numpy as np
 
-thermal_image = "1.png"
-hotspot_image, thermal_hotspot_centers = detect_hotspots(thermal_image, threshold=200)
+# one row per track, coordinates are (x, y) pixels of the raw 24x32 frame
+TRACK_DTYPE = np.dtype([
+    ("id", np.int64),            # persistent id, never reused
+    ("x", np.float32),           # last matched (or predicted) position
+    ("y", np.float32),
+    ("vx", np.float32),          # smoothed velocity in pixels per frame
+    ("vy", np.float32),
+    ("peak", np.float32),        # smoothed peak temperature in C
+    ("area", np.int32),          # area of the last matched hotspot
+    ("age", np.int32),           # frames since the track started
+    ("hits", np.int32),          # frames with a matched hotspot
+    ("missed", np.int32),        # frames since the last match
+    ("confidence", np.float32),  # 0..1, grows with the hits and fades with the misses
+])
 
-# Save and display the thermal hotspots
-cv2.imwrite("hotspot_detected.jpg", hotspot_image)
-cv2.waitKey(0)
-cv2.destroyAllWindows()
 
-depth_image_path = "depth_test.png"  # Replace with actual depth image
+class HotspotTracker:
+    """
+    Associates hotspot detections across frames and gives every object a persistent id.
 
-depth_to_check = []
-imageT = cv2.imread(thermal_image)
-depth_image = cv2.imread(depth_image_path)
-wT, hT = imageT.shape[1], imageT.shape[0]
-wD, hD = depth_image.shape[1], depth_image.shape[0]
-width_conversion, height_conversion = wD/wT, hD/hT
+    Every frame the active tracks are moved on by their velocity and greedily
+    matched to the new hotspots, cheapest pair first, on a cost adding the
+    distance in pixels and the difference in peak temperature. Pairs further
+    apart than `max_distance` never match. Unmatched hotspots start new tracks
+    and tracks unmatched for more than `max_missed` frames are dropped.
 
-# convert coordinates from the thermal image size to depth image size
-for x, y in thermal_hotspot_centers:
-    depth_to_check.append((int(x*width_conversion), int(y*height_conversion)))
+    A track counts as an object once it was matched `min_hits` times, so one
+    noisy frame does not add an object, and a buried object keeps its id while
+    the rig moves over it instead of being counted again in every frame.
 
-depth_results = extract_depth_values(depth_image_path, depth_to_check) # check the hotspots from the thermal in the depth
+    The tracks live in a preallocated table of `max_tracks` rows and at most
+    `max_detections` hotspots are used per frame, so an update costs the same
+    at the start and at the end of a long run.
+    """
 
-# Print extracted depth values
-for point, depth in depth_results.items():
-    print(f"Depth at {point}: {depth} units")
+    def __init__(self, max_distance=4.0, temperature_weight=0.5, max_missed=5, min_hits=3,
+                 max_tracks=32, max_detections=32, smoothing=0.5):
+        """
+        :param max_distance: largest move in pixels of one object between two frames.
+        :param temperature_weight: cost in pixels of one degree of peak difference.
+        :param max_missed: frames a track survives without a match.
+        :param min_hits: matches before a track is confirmed as an object.
+        :param max_tracks: size of the active set, when full the least confident track makes room.
+        :param max_detections: hotspots used per frame, the hottest ones.
+        :param smoothing: weight of the newest match in the velocity and peak estimates.
+        """
+        self.max_distance = max_distance
+        self.temperature_weight = temperature_weight
+        self.max_missed = max_missed
+        self.min_hits = min_hits
+        self.max_detections = max_detections
+        self.smoothing = smoothing
 
-#avg depth
-# Remove invalid values (e.g., zero depth)
-valid_depth = depth_image[depth_image > 0]  # Exclude zero values
+        self.table = np.zeros(max_tracks, dtype=TRACK_DTYPE)
+        self.active = np.zeros(max_tracks, dtype=bool)
+        self.next_id = 0
+        self.confirmed = 0  # objects seen so far
 
-# Compute average depth
-average_depth = np.mean(valid_depth) if valid_depth.size > 0 else 0
+    @property
+    def tracks(self):
+        """
+        Confirmed tracks, i.e. the objects currently followed.
 
-print(f"Average Depth: {average_depth:.2f}")
\ No newline at end of file
+        :return: structured array with TRACK_DTYPE.
+        """
+        return self.table[self.active & (self.table["hits"] >= self.min_hits)]
+
+    def update(self, hotspots):
+        """
+        Moves the tracks on by one frame.
+
+        :param hotspots: structured array with HOTSPOT_DTYPE of one frame, see detect_hotspots_array.
+        :return: (N,) track id of every hotspot, -1 for hotspots left out (beyond max_detections
+            or no room in the table).
+        """
+        ids = np.full(len(hotspots), -1, dtype=np.int64)
+        order = np.argsort(-hotspots["peak"], kind="stable")[:self.max_detections]
+        detections = hotspots[order]
+
+        # constant velocity prediction of every active track
+        table = self.table
+        slots = np.flatnonzero(self.active)
+        table["x"][slots] += table["vx"][slots]
+        table["y"][slots] += table["vy"][slots]
+        table["age"][slots] += 1
+        table["missed"][slots] += 1
+
+        # greedy assignment, cheapest pair first
+        matched = np.zeros(len(detections), dtype=bool)
+        if len(slots) and len(detections):
+            tracks = table[slots]
+            distance = np.hypot(tracks["x"][:, None] - detections["x"][None],
+                                tracks["y"][:, None] - detections["y"][None])
+            cost = distance + self.temperature_weight * np.abs(tracks["peak"][:, None] - detections["peak"][None])
+            cost[distance > self.max_distance] = np.inf
+            taken = np.zeros(len(slots), dtype=bool)
+            for flat in np.argsort(cost, axis=None):
+                t, d = divmod(int(flat), len(detections))
+                if not np.isfinite(cost[t, d]):
+                    break
+                if taken[t] or matched[d]:
+                    continue
+                taken[t] = matched[d] = True
+                self._match(slots[t], detections[d])
+                ids[order[d]] = table["id"][slots[t]]
+
+        # tracks unmatched for too long are gone
+        self.active[slots[table["missed"][slots] > self.max_missed]] = False
+
+        # new tracks for the remaining hotspots
+        for d in np.flatnonzero(~matched):
+            slot = self._free_slot()
+            if slot is None:
+                break
+            ids[order[d]] = self._start(slot, detections[d])
+
+        slots = np.flatnonzero(self.active)
+        hits = np.minimum(table["hits"][slots] / self.min_hits, 1.0)
+        table["confidence"][slots] = hits * (1.0 - table["missed"][slots] / (self.max_missed + 1.0))
+        return ids
+
+    def _match(self, slot, hotspot):
+        row = self.table[slot:slot + 1]
+        a = self.smoothing
+        # position from the hotspot, velocity from the distance to the previous match
+        steps = row["missed"]
+        previous_x = row["x"] - row["vx"] * steps
+        previous_y = row["y"] - row["vy"] * steps
+        row["vx"] = (1 - a) * row["vx"] + a * (hotspot["x"] - previous_x) / steps
+        row["vy"] = (1 - a) * row["vy"] + a * (hotspot["y"] - previous_y) / steps
+        row["x"] = hotspot["x"]
+        row["y"] = hotspot["y"]
+        row["peak"] = (1 - a) * row["peak"] + a * hotspot["peak"]
+        row["area"] = hotspot["area"]
+        row["hits"] += 1
+        row["missed"] = 0
+        if row["hits"][0] == self.min_hits:
+            self.confirmed += 1
+
+    def _free_slot(self):
+        free = np.flatnonzero(~self.active)
+        if len(free):
+            return int(free[0])
+        # full: replace the least confident track not matched in this frame
+        candidates = np.flatnonzero(self.table["missed"] > 0)
+        if len(candidates) == 0:
+            return None
+        return int(candidates[np.argmin(self.table["confidence"][candidates])])
+
+    def _start(self, slot, hotspot):
+        row = self.table[slot:slot + 1]
+        row["id"] = self.next_id
+        row["x"] = hotspot["x"]
+        row["y"] = hotspot["y"]
+        row["vx"] = row["vy"] = 0
+        row["peak"] = hotspot["peak"]
+        row["area"] = hotspot["area"]
+        row["age"] = 0
+        row["hits"] = 1
+        row["missed"] = 0
+        self.active[slot] = True
+        self.next_id += 1
+        if self.min_hits <= 1:
+            self.confirmed += 1
+        return row["id"][0]
+
+
+if __name__ == "__main__":
+    thermal_image = "1.png"
+    hotspot_image, thermal_hotspot_centers = detect_hotspots(thermal_image, threshold=200)
+
+    # Save and display the thermal hotspots
+    cv2.imwrite("hotspot_detected.jpg", hotspot_image)
+    cv2.waitKey(0)
+    cv2.destroyAllWindows()
+
+    depth_image_path = "depth_test.png"  # Replace with actual depth image
+
+    depth_to_check = []
+    imageT = cv2.imread(thermal_image)
+    depth_image = cv2.imread(depth_image_path)
+    wT, hT = imageT.shape[1], imageT.shape[0]
+    wD, hD = depth_image.shape[1], depth_image.shape[0]
+    width_conversion, height_conversion = wD/wT, hD/hT
+
+    # convert coordinates from the thermal image size to depth image size
+    for x, y in thermal_hotspot_centers:
+        depth_to_check.append((int(x*width_conversion), int(y*height_conversion)))
+
+    # check the hotspots from the thermal in the depth, the average of the valid
+    # (non-zero) depth comes out of the same pass
+    depth_gray = cv2.cvtColor(depth_image, cv2.COLOR_BGR2GRAY)
+    depth_values, average_depth = sample_depth(depth_gray, np.array(depth_to_check).reshape(-1, 2))
+
+    # Print extracted depth values
+    for point, depth in zip(depth_to_check, depth_values):
+        print(f"Depth at {point}: {depth} units")
+
+    print(f"Average Depth: {average_depth:.2f}")
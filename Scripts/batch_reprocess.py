@@ -0,0 +1,406 @@
+"""
+Batch reprocessing of archived captures on a process pool.
+
+The archives in image_archive/ (and any capture directory or tar of one) are
+read member by member straight out of the tar stream, nothing is extracted to
+disk and nothing is deleted. Every frame is handed to a pool worker, which
+renders it and writes the image under the output directory, in the same
+directory as the member (<out>/<archive>/images/thermal_image_X.png):
+
+    - thermal .npz: OpenCV render and hotspots from the temperatures
+    - depth .npz:   coloured depth with its timestamp, like process_depth_data.py
+    - rgb .npz:     the image without its alpha channel
+    - rendered images (.png/.jpg): re-encoded in the output format only, the
+      matplotlib figures of the archives (white background, colour bar) hold
+      no temperatures to search for hotspots
+
+    python3 batch_reprocess.py ../image_archive/*.tar.gz --out reprocessed --format jpeg
+
+Progress is checkpointed in <out>/reprocess.jsonl, one JSON line per finished
+frame (its output and detections) written once the image is on disk. A run
+that was stopped, crashed or got new archives resumes where it was: frames
+already in the checkpoint are skipped, failed ones are tried again. Use a new
+output directory (or --restart) after changing the processing options.
+
+Members are read in archive order, and only `in_flight` frames are held in
+memory at a time, so compressed archives (which can only be read front to
+back) are decompressed once and never loaded whole.
+"""
+import argparse
+import functools
+import io
+import json
+import multiprocessing as mp
+import os
+import signal
+import sys
+import tarfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "HotspotDetection"))
+
+from frame_scheduler import export_sys_path
+from image_writer import IMAGE_FORMATS, encode_params
+from process_depth_data import DepthColorizer, draw_timestamp
+from sensor_sources import SENSOR_PREFIXES, TIMESTAMP_PATTERN
+from thermal_hotspot import detect_hotspots_array
+from thermal_render import ThermalRenderer
+
+# file name prefixes of the images, the same as the pipeline's
+OUTPUT_PREFIXES = {"thermal": "thermal_image_", "depth": "depth_", "rgb": "rgb_"}
+MEMBER_EXTENSIONS = (".npz", ".png", ".jpg", ".jpeg")
+ARCHIVE_EXTENSIONS = (".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar")
+
+# modules the forkserver imports once for all workers
+PRELOAD = ["process_depth_data", "thermal_render", "thermal_hotspot"]
+
+
+def member_sensor(name: str) -> Optional[str]:
+    """The sensor of an archive member from its file name, None if it is not a frame."""
+    base = os.path.basename(name)
+    if not base.lower().endswith(MEMBER_EXTENSIONS):
+        return None
+    for sensor, prefixes in SENSOR_PREFIXES.items():
+        if base.startswith(prefixes):
+            return sensor
+    return None
+
+
+def archive_name(path: str) -> str:
+    """Name of an archive or directory without its extension, e.g. image_test1."""
+    base = os.path.basename(os.path.normpath(path))
+    for extension in ARCHIVE_EXTENSIONS:
+        if base.endswith(extension):
+            return base[:-len(extension)]
+    return os.path.splitext(base)[0] if os.path.isfile(path) else base
+
+
+def output_name(member: str, sensor: str) -> str:
+    """Path (without extension) of a member's image relative to its archive's output, e.g.
+    thermal/thermal_image_17-39-27.341.
+
+    The image keeps the member's directory, so a raw capture and the image rendered
+    from it (thermal/mlx90640_X.npz and images/thermal_image_X.png) do not overwrite
+    each other. Directories leading out of the archive are dropped.
+    """
+    directory, base = os.path.split(os.path.normpath(member))
+    if os.path.isabs(directory) or directory.split(os.sep)[0] in (os.pardir, os.curdir):
+        directory = ""
+    stamp = TIMESTAMP_PATTERN.search(base)
+    name = OUTPUT_PREFIXES[sensor] + stamp.group(0) if stamp else os.path.splitext(base)[0]
+    return os.path.join(directory, name)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _read_member(tar: tarfile.TarFile, member: tarfile.TarInfo) -> bytes:
+    return tar.extractfile(member).read()
+
+
+def archive_members(path: str, sensors: Sequence[str]) -> Iterator[Tuple[str, str, Callable[[], bytes]]]:
+    """Lists the frames of an archive, directory or single capture in storage order.
+
+    Tar archives are read as a stream, the data of a member can only be read
+    before moving on to the next one.
+
+    Args:
+        path (str): tar archive (compressed or not), capture directory or single file
+        sensors (Sequence[str]): sensors to list
+
+    Yields:
+        Tuple[str, str, Callable]: (member name, sensor, function returning the member's bytes)
+    """
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                sensor = member_sensor(name)
+                if sensor in sensors:
+                    full = os.path.join(root, name)
+                    yield os.path.relpath(full, path), sensor, functools.partial(_read_file, full)
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path, "r|*") as tar:
+            for member in tar:
+                sensor = member_sensor(member.name) if member.isfile() else None
+                if sensor in sensors:
+                    yield os.path.normpath(member.name), sensor, functools.partial(_read_member, tar, member)
+    elif os.path.isfile(path):
+        sensor = member_sensor(path)
+        if sensor in sensors:
+            yield os.path.basename(path), sensor, functools.partial(_read_file, path)
+    else:
+        raise FileNotFoundError(path)
+
+
+class Checkpoint:
+    """The frames already reprocessed, as JSON lines appended when they finish."""
+
+    def __init__(self, path: str, resume: bool = True, fsync_every: int = 32):
+        """
+        Args:
+            path (str): checkpoint file, created if missing
+            resume (bool): keep the finished frames of earlier runs, False starts over
+            fsync_every (int): lines between syncs to the disk
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self.done = set()
+        self._lock = threading.Lock()
+        self._unsynced = 0
+
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # last line of a run that was killed mid-write
+                    if "error" not in record:
+                        self.done.add(record["key"])
+        self._file = open(path, "a" if resume else "w")
+        if self._file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")  # do not append to a torn line
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.done
+
+    def __len__(self) -> int:
+        return len(self.done)
+
+    def record(self, record: Dict):
+        """Appends the record of a finished (or failed) frame."""
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            if "error" not in record:
+                self.done.add(record["key"])
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
+# ------------------------------------------------------------------------------
+# pool side, renderers are created once per worker process
+# ------------------------------------------------------------------------------
+
+_thermal_renderer = None
+_depth_colorizer = None
+
+
+def _ignore_interrupt():
+    # Ctrl-C reaches the whole process group, the parent stops the pool and keeps the checkpoint
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _hotspot_records(hotspots: np.ndarray):
+    return [{name: row[name].tolist() for name in hotspots.dtype.names if name != "frame"} for row in hotspots]
+
+
+def _render_arrays(sensor: str, arrays: Dict[str, np.ndarray], timestamp: str, options: Dict) -> Tuple[np.ndarray, Dict]:
+    global _thermal_renderer, _depth_colorizer
+    if sensor == "thermal":
+        temperature = arrays["temperature"]
+        if _thermal_renderer is None or _thermal_renderer.shape != temperature.shape:
+            _thermal_renderer = ThermalRenderer(shape=temperature.shape, interpolation="bilinear")
+        hotspots = detect_hotspots_array(temperature, options.get("hotspot_threshold"), options["delta"])
+        return _thermal_renderer.render(temperature), {"hotspots": _hotspot_records(hotspots)}
+    if sensor == "depth":
+        if _depth_colorizer is None:
+            _depth_colorizer = DepthColorizer()
+        image = _depth_colorizer.colorize(arrays["depth"], arrays["confidence"])
+        draw_timestamp(image, timestamp)
+        return image, {}
+    return arrays["rgb"], {}
+
+
+def _write_image(image: np.ndarray, path: str, format: str, params):
+    """Writes an image under a temporary name first, a stopped run never leaves half an image."""
+    partial = path + ".part"
+    with open(partial, "wb") as f:
+        if format == "raw":
+            np.save(f, image)
+        else:
+            ok, encoded = cv2.imencode(IMAGE_FORMATS[format], image, params)
+            if not ok:
+                raise ValueError(f"Could not encode {path}")
+            f.write(encoded.data)
+    os.replace(partial, path)
+
+
+def reprocess_member(task: Dict, options: Dict) -> Dict:
+    """Renders one archived frame and writes its image, runs on the pool.
+
+    Args:
+        task (Dict): "key", "member", "sensor", "data" (the member's bytes) and "output" (path without extension)
+        options (Dict): "format", "quality", "delta", "hotspot_threshold"
+
+    Returns:
+        Dict: checkpoint record with the output path and the detections, or the error
+    """
+    member, sensor = task["member"], task["sensor"]
+    record = {"key": task["key"], "sensor": sensor}
+    stamp = TIMESTAMP_PATTERN.search(os.path.basename(member))
+    if stamp:
+        record["timestamp"] = stamp.group(0)
+    try:
+        if member.endswith(".npz"):
+            with np.load(io.BytesIO(task["data"])) as data:
+                arrays = {key: data[key] for key in data.files}
+            image, detections = _render_arrays(sensor, arrays, record.get("timestamp", ""), options)
+        else:
+            image = cv2.imdecode(np.frombuffer(task["data"], dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            if image is None:
+                raise ValueError(f"Could not decode {member}")
+            detections = {}
+        if image.ndim == 3 and image.shape[-1] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+
+        path = task["output"] + IMAGE_FORMATS[options["format"]]
+        _write_image(image, path, options["format"], encode_params(options["format"], options.get("quality")))
+        record["output"] = path
+        record.update(detections)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    return record
+
+
+# ------------------------------------------------------------------------------
+# parent side
+# ------------------------------------------------------------------------------
+
+def reprocess(inputs: Sequence[str], out_dir: str = "reprocessed", workers: Optional[int] = None,
+              in_flight: Optional[int] = None, sensors: Sequence[str] = ("thermal", "depth", "rgb"),
+              format: str = "png", quality: Optional[int] = None, delta: float = 5.0,
+              hotspot_threshold: Optional[float] = None,
+              resume: bool = True, start_method: Optional[str] = "forkserver", verbose: bool = True) -> Dict:
+    """Reprocesses every frame of the inputs that is not in the checkpoint yet.
+
+    Args:
+        inputs (Sequence[str]): tar archives, capture directories or single captures
+        out_dir (str): images go to <out_dir>/<archive name>/, the checkpoint to <out_dir>/reprocess.jsonl
+        workers (int, optional): pool processes, one per core but one by default
+        in_flight (int, optional): frames read ahead of the pool, 2 per worker by default
+        sensors (Sequence[str]): sensors to reprocess
+        format (str): image format, see image_writer.IMAGE_FORMATS
+        quality (int, optional): JPEG / WebP quality
+        delta (float): hotspot threshold in C above the frame median (thermal .npz)
+        hotspot_threshold (float, optional): absolute hotspot threshold in C (thermal .npz)
+        resume (bool): skip the frames in the checkpoint, False reprocesses everything
+        start_method (str, optional): how the pool workers start, see FrameScheduler
+        verbose (bool): print every finished frame
+
+    Returns:
+        Dict: processed, skipped and failed frames, elapsed seconds
+    """
+    workers = workers or max(1, mp.cpu_count() - 1)
+    in_flight = in_flight or 2 * workers
+    options = {"format": format, "quality": quality, "delta": delta,
+               "hotspot_threshold": hotspot_threshold}
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(out_dir, "reprocess.jsonl"), resume)
+
+    counts = {"processed": 0, "skipped": 0, "failed": 0}
+    lock = threading.Lock()
+    capacity = threading.Semaphore(in_flight)
+
+    def finished(record: Dict):
+        checkpoint.record(record)
+        with lock:
+            counts["failed" if "error" in record else "processed"] += 1
+        capacity.release()
+        if "error" in record:
+            print(f"Failed {record['key']}: {record['error']}")
+        elif verbose:
+            print(f"Processed {record['key']} saved as {record['output']}")
+
+    def crashed(error: BaseException):
+        # the task itself catches processing errors, this is a worker that died
+        with lock:
+            counts["failed"] += 1
+        capacity.release()
+        print(f"Worker error: {error}")
+
+    context = mp.get_context(start_method)
+    if context.get_start_method() == "forkserver":
+        export_sys_path()
+        context.set_forkserver_preload(PRELOAD)
+    started = time.monotonic()
+    pool = context.Pool(processes=workers, initializer=_ignore_interrupt)
+    try:
+        for path in inputs:
+            name = archive_name(path)
+            os.makedirs(os.path.join(out_dir, name), exist_ok=True)
+            for member, sensor, read in archive_members(path, sensors):
+                key = f"{name}/{member}"
+                if key in checkpoint:
+                    counts["skipped"] += 1
+                    continue
+                capacity.acquire()
+                output = os.path.join(out_dir, name, output_name(member, sensor))
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                task = {"key": key, "member": member, "sensor": sensor, "data": read(), "output": output}
+                pool.apply_async(reprocess_member, (task, options), callback=finished, error_callback=crashed)
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        # a second Ctrl-C while the pool stops would leave the workers behind
+        handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        print("Stopped, run again to resume")
+        pool.terminate()
+        pool.join()
+        signal.signal(signal.SIGINT, handler)
+    finally:
+        checkpoint.close()
+    return dict(counts, elapsed=time.monotonic() - started, checkpoint=checkpoint.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocess archived captures on a process pool, "
+                                                 "resuming from the checkpoint; nothing is extracted or deleted")
+    parser.add_argument("inputs", nargs="+", help="tar archives, capture directories or single captures")
+    parser.add_argument("--out", default="reprocessed", help="output directory (default: reprocessed)")
+    parser.add_argument("--workers", type=int, help="pool processes (default: cores - 1)")
+    parser.add_argument("--in-flight", type=int, help="frames read ahead of the pool (default: 2 per worker)")
+    parser.add_argument("--sensors", nargs="+", choices=list(OUTPUT_PREFIXES), default=list(OUTPUT_PREFIXES),
+                        help="sensors to reprocess (default: all)")
+    parser.add_argument("--format", choices=list(IMAGE_FORMATS), default="png", help="image format (default: png)")
+    parser.add_argument("--quality", type=int, help="JPEG / WebP quality (default 90)")
+    parser.add_argument("--delta", type=float, default=5.0, help="hotspots: degrees above the frame median")
+    parser.add_argument("--threshold", type=float, help="hotspots: absolute temperature in C")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and reprocess everything")
+    parser.add_argument("--start-method", choices=mp.get_all_start_methods(), default="forkserver",
+                        help="how the pool workers start (default: forkserver)")
+    parser.add_argument("--quiet", action="store_true", help="only print the failures and the summary")
+    args = parser.parse_args()
+
+    results = reprocess(args.inputs, args.out, args.workers, args.in_flight, args.sensors, args.format,
+                        args.quality, args.delta, args.threshold, not args.restart,
+                        args.start_method, not args.quiet)
+    rate = results["processed"] / results["elapsed"] if results["elapsed"] > 0 else 0.0
+    print(f"Processed {results['processed']} frames in {results['elapsed']:.2f}s ({rate:.1f} frames/s), "
+          f"skipped {results['skipped']} already done, failed {results['failed']}")
+    print(f"Checkpoint: {results['checkpoint']}")
+    return 1 if results["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
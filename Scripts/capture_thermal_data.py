@@ -1,38 +1,77 @@
-import time
-import board
-import busio
+import argparse
 import numpy as np
-import adafruit_mlx90640
-from datetime import datetime
 import os
 
-# Setup I2C
-i2c = busio.I2C(board.SCL, board.SDA, frequency=1000000)
-mlx = adafruit_mlx90640.MLX90640(i2c)
-mlx.refresh_rate = adafruit_mlx90640.RefreshRate.REFRESH_64_HZ
-mlx_shape = (24, 32)
+from sensor_sources import ThermalSource, make_timestamp
 
 # Setup directory for storing the data
 save_directory = "thermalImage"
+mlx_shape = (24, 32)
+
+
+def capture_frame(source: ThermalSource):
+    """Captures a single thermal frame and saves it to a .npz file."""
+    frame = source.read()  # Read MLX temperatures, re-reads on errors
+    npz_path = os.path.join(save_directory, f"thermal_data_{frame['timestamp']}.npz")
+    np.savez(npz_path, temperature=frame["arrays"]["temperature"])
+    print(f"Thermal data saved as {npz_path}")
+
+
+def capture_continuous(source: ThermalSource, seconds: float):
+    """Captures frames at the sensor's refresh rate for the given time.
+
+    Frames are kept in a preallocated stack and saved together with their
+    monotonic timestamps in one .npz file at the end.
+
+    Args:
+        source (ThermalSource): opened thermal camera
+        seconds (float): capture duration
+    """
+    # room for every frame the sensor can produce, with some margin
+    capacity = int(seconds / source.frame_period * 1.2) + 1
+    temperature = np.empty((capacity,) + mlx_shape)
+    t_mono = np.empty((capacity,))
+
+    timestamp = make_timestamp()
+    count = 0
+    start = None
+    while count < capacity:
+        frame = source.read()
+        if start is None:
+            start = frame["t_mono"]
+        elif frame["t_mono"] - start > seconds:
+            break
+        temperature[count] = frame["arrays"]["temperature"]
+        t_mono[count] = frame["t_mono"]
+        count += 1
+
+    stats = source.stats()
+    npz_path = os.path.join(save_directory, f"thermal_stream_{timestamp}.npz")
+    np.savez(npz_path, temperature=temperature[:count], t_mono=t_mono[:count],
+             dropped=stats["dropped"], skipped=stats["skipped"], retries=stats["retries"])
+    print(f"{count} thermal frames saved as {npz_path}")
+    print(f"Achieved {stats['fps']:.2f} fps (sensor {stats['expected_fps']:.2f} fps), "
+          f"retries: {stats['retries']}, dropped frames: {stats['dropped']}, skipped between reads: {stats['skipped']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture MLX90640 thermal data")
+    parser.add_argument("--refresh", default="REFRESH_64_HZ",
+                        help="adafruit_mlx90640.RefreshRate name, e.g. REFRESH_16_HZ")
+    parser.add_argument("--seconds", type=float, default=0,
+                        help="capture continuously for this many seconds instead of a single frame")
+    args = parser.parse_args()
+
+    # Setup I2C
+    source = ThermalSource(refresh_rate=args.refresh)
+    source.open()
+
+    # Capture thermal data
+    if args.seconds > 0:
+        capture_continuous(source, args.seconds)
+    else:
+        capture_frame(source)
 
-# Setup frame for storing temperatures
-frame = np.zeros((24 * 32,))
-
-# Capture thermal data
-elapsed_time = 0
-while elapsed_time < 1:
-    try:
-        mlx.getFrame(frame)  # Read MLX temperatures into frame var
-        data_array = np.reshape(frame, mlx_shape)  # Reshape to 24x32
-        now = datetime.now()
-        timestamp = now.strftime("%H-%M-%S") + f".{now.microsecond // 1000:03d}"
-        
-        # Save data to .npz file
-        npz_path = os.path.join(save_directory, f"thermal_data_{timestamp}.npz")
-        np.savez(npz_path, temperature=data_array)
-        print(f"Thermal data saved as {npz_path}")
-
-        elapsed_time = 1
-    except ValueError:
-        continue  # If error, just read again
 
+if __name__ == "__main__":
+    main()
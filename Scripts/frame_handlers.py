@@ -0,0 +1,185 @@
+"""
+Per-sensor frame handling shared by the test harness and the pipeline runner.
+
+The collector side reads a frame from its source and publishes it into shared
+memory (read_frame, publish_frame); the pool side turns the published frame
+into an image and hands it to the process's ImageWriter (process_*_data).
+
+    scheduler = FrameScheduler(SENSOR_HANDLERS, priorities=SENSOR_PRIORITIES).start(queue)
+    frame = read_frame(source, metrics)
+    publish_frame(frame, queue, transport, metrics)
+
+The handlers run in pool workers; renderers and writers are created once per
+worker process and reused for every frame.
+"""
+import os
+import time
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+
+from frame_transport import FrameTransport, load_frame, release_frame
+from image_writer import shared_writer
+from pipeline_metrics import NULL_METRICS
+from process_depth_data import DepthColorizer
+from sensor_sources import SensorSource
+from thermal_render import ThermalRenderer, PublicationRenderer
+
+
+def read_frame(source: SensorSource, metrics=NULL_METRICS):
+    """ Reads the next frame of a source, timing the capture stage when metrics are on """
+    if not metrics.enabled:
+        return source.read()
+    start = time.monotonic()
+    frame = source.read()
+    if frame is not None:
+        metrics.record("capture", frame["sensor"], time.monotonic() - start)
+    return frame
+
+
+def publish_frame(frame: Dict, queue, transport: FrameTransport, metrics=NULL_METRICS) -> Dict:
+    """ Copies a sensor frame into shared memory and queues its descriptor for processing
+
+    Args:
+        frame (Dict): frame returned by a SensorSource
+        queue (MP.Queue): Multiprocessing Queue that is thread-safe
+        transport (FrameTransport): shared memory rings of the sensors
+        metrics (PipelineMetrics): records the publish and enqueue stages
+
+    Returns:
+        Dict: the queued descriptor
+    """
+    if not metrics.enabled:
+        # add the slot descriptor to the process queue, the arrays stay in shared memory
+        descriptor = transport.publish(frame)
+        queue.put(descriptor)
+        return descriptor
+    start = time.monotonic()
+    descriptor = transport.publish(frame)
+    published = time.monotonic()
+    queue.put(descriptor)
+    metrics.record("publish", frame["sensor"], published - start)
+    metrics.record("enqueue", frame["sensor"], time.monotonic() - published)
+    return descriptor
+
+
+def _image_directory(directory: Optional[str]) -> str:
+    return directory or os.getcwd() + '/data/images'
+
+
+# depth colorizer shared with Scripts/process_depth_data.py, buffers are reused per worker
+_depth_colorizer = DepthColorizer()
+
+
+def process_tof_data(data: Dict, directory: Optional[str] = None):
+    """Process a single depth frame, apply image processing, and save the result.
+
+    Args:
+        data (Dict): frame descriptor from the queue
+        directory (str, optional): where the images go, data/images by default
+    """
+    # use the data packet given
+    timestamp = data["timestamp"]
+
+    try:
+        # Map the frame from shared memory (or load an older .npz capture)
+        arrays = load_frame(data)
+        depth_buf = arrays['depth']
+        confidence_buf = arrays['confidence']
+
+        # colour the depth with the shared depth LUT, low-confidence areas are black
+        result_image = _depth_colorizer.colorize(depth_buf, confidence_buf)
+    finally:
+        # the shared memory slot can be reused once the frame has been read
+        release_frame(data)
+
+    # Save the processed image
+    image_path = _image_directory(directory)
+    if not os.path.exists(image_path):
+        os.makedirs(image_path)
+
+    # encoded and written by the writer threads while this worker moves on
+    save_path = shared_writer().submit(result_image, os.path.join(image_path, f"depth_{timestamp}.png"))
+    print(f"Processed tof image saved as {save_path}")
+
+
+# thermal renderers, created once per worker process and reused for every frame
+_thermal_renderer = None
+_publication_renderer = None
+
+
+def process_thermal_data(data: Dict, publication: bool = False, directory: Optional[str] = None):
+    """Process thermal data and save the processed image.
+
+    Args:
+        data (Dict): frame descriptor from the queue
+        publication (bool): save the 300 dpi matplotlib figure instead of the fast OpenCV render
+        directory (str, optional): where the images go, data/images by default
+    """
+    global _thermal_renderer, _publication_renderer
+
+    # use the data packet given
+    timestamp = data["timestamp"]
+
+    try:
+        # Copy the temperatures out of shared memory, they are tiny
+        temperature_data = np.array(load_frame(data)['temperature'])
+    finally:
+        release_frame(data)
+
+    image_path = _image_directory(directory)
+    save_path = os.path.join(image_path, f"thermal_image_{timestamp}.png")
+
+    if publication:
+        if _publication_renderer is None:
+            _publication_renderer = PublicationRenderer()
+        image = _publication_renderer.render(temperature_data)
+    else:
+        # flipped left to right with the bounds set to the frame min/max, like the figure
+        if _thermal_renderer is None:
+            _thermal_renderer = ThermalRenderer(shape=temperature_data.shape, interpolation="bilinear")
+        # the renderer reuses its canvas, the writer gets its own copy
+        image = _thermal_renderer.render(temperature_data).copy()
+    save_path = shared_writer().submit(image, save_path)
+    print(f"Processed thermal image saved as {save_path}")
+
+
+def process_rgb_data(data: Dict, directory: Optional[str] = None):
+    """Process a single RGB frame, apply image processing, and save the result.
+
+    Args:
+        data (Dict): frame descriptor from the queue
+        directory (str, optional): where the images go, data/images by default
+    """
+    # use the data packet given to the function
+    timestamp = data["timestamp"]
+
+    try:
+        # remove the unused alpha channel (unless the capture already did), this
+        # also copies the image out of shared memory
+        rgb_image = load_frame(data)["rgb"]
+        if rgb_image.shape[-1] == 4:
+            rgb_image = cv2.cvtColor(rgb_image, cv2.COLOR_BGRA2BGR)
+        else:
+            rgb_image = rgb_image.copy()
+    finally:
+        release_frame(data)
+
+    # get save path
+    image_path = _image_directory(directory)
+    save_path = os.path.join(image_path, f"rgb_{timestamp}.png")
+
+    # convert rgb array into an image on the writer threads
+    save_path = shared_writer().submit(rgb_image, save_path)
+    print(f"Processed rgb image saved as {save_path}")
+
+
+# functions processing each sensor type, and the order they are handed to the pool
+# when frames are waiting (hotspots come from thermal, rgb is the slowest to encode)
+SENSOR_HANDLERS = {
+    "thermal": process_thermal_data,
+    "depth": process_tof_data,
+    "rgb": process_rgb_data,
+}
+SENSOR_PRIORITIES = {"thermal": 2, "depth": 1, "rgb": 0}
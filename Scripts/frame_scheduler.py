@@ -0,0 +1,232 @@
+"""
+Streaming scheduler that feeds queued sensor frames to a process pool.
+
+The scheduler runs next to the collectors: it blocks on the frame queue, keeps
+at most `max_in_flight` frames in the pool and hands frames to the workers by
+sensor priority. While the pool is full it stops reading the queue, so a
+bounded queue (and the shared memory rings behind it) pushes back on the
+collectors instead of growing without limit.
+
+    scheduler = FrameScheduler({"depth": process_tof_data, "thermal": process_thermal_data},
+                               priorities={"depth": 2, "thermal": 1})
+    scheduler.start(queue)
+    ...                      # collectors put frames on the queue
+    queue.put(None)          # or {"sensor": "Off"}
+    stats = scheduler.join()
+
+The pool's start method is a parameter: with "forkserver" the workers are
+forked from a small server process that imported only the `preload` modules
+(the handlers), so they start in milliseconds without inheriting the
+collectors' threads, hardware handles or anything else the parent imported.
+Settings a worker needs (e.g. configure_writer's) then go through
+`initializer`, module globals of the parent are not copied.
+"""
+import heapq
+import itertools
+import multiprocessing as mp
+import os
+import queue as queue_module
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence
+
+from pipeline_metrics import NULL_METRICS, timed_call
+
+
+def export_sys_path():
+    """Adds the script directories on sys.path to PYTHONPATH for processes started with `python -c`.
+
+    The forkserver is such a process and Python 3.11 ignores the sys.path it
+    is handed, so modules next to the scripts would not be found and the
+    preload would silently do nothing.
+    """
+    prefixes = {sys.prefix, sys.base_prefix, sys.exec_prefix}
+    paths = [path for path in sys.path
+             if path and os.path.isdir(path) and not any(path.startswith(prefix) for prefix in prefixes)]
+    current = [path for path in os.environ.get("PYTHONPATH", "").split(os.pathsep) if path]
+    os.environ["PYTHONPATH"] = os.pathsep.join(current + [path for path in paths if path not in current])
+
+# sensor name of the sentinel put on the queue by the harness
+STOP_SENSOR = "Off"
+
+
+class FrameScheduler:
+    """Dispatches frames from a queue to a multiprocessing pool."""
+
+    def __init__(self, handlers: Dict[str, Callable], processes: Optional[int] = None,
+                 max_in_flight: Optional[int] = None, priorities: Optional[Dict[str, int]] = None,
+                 on_result: Optional[Callable] = None, on_error: Optional[Callable] = None,
+                 window: int = 16, metrics=None, start_method: Optional[str] = None,
+                 initializer: Optional[Callable] = None, initargs: tuple = (), preload: Sequence[str] = ()):
+        """
+        Args:
+            handlers (Dict[str, Callable]): sensor name -> function run on the pool with the frame
+            processes (int, optional): pool size, defaults to one core less than the board has
+            max_in_flight (int, optional): frames submitted to the pool at once, defaults to 2x the pool size
+            priorities (Dict[str, int], optional): higher priority sensors are dispatched first
+            on_result (Callable, optional): called with (frame, result) when a frame is done
+            on_error (Callable, optional): called with (frame, exception) when a frame failed
+            window (int): frames read ahead of the pool to choose the next one by priority
+            metrics (PipelineMetrics, optional): records the wait, process and end_to_end
+                stages, the queue depths and the workers' busy time
+            start_method (str, optional): "fork", "forkserver" or "spawn", the platform default if None
+            initializer (Callable, optional): run with initargs in every worker when it starts
+            initargs (tuple): arguments of the initializer
+            preload (Sequence[str]): modules the forkserver imports once for all workers
+        """
+        self.handlers = handlers
+        self.processes = processes or max(1, mp.cpu_count() - 1)
+        self.max_in_flight = max_in_flight or 2 * self.processes
+        self.priorities = priorities or {}
+        self.on_result = on_result
+        self.on_error = on_error
+        self.window = window
+        self.metrics = metrics or NULL_METRICS
+        self.metrics.workers = self.processes
+        self.start_method = start_method
+        self.initializer = initializer
+        self.initargs = initargs
+        self.preload = list(preload)
+
+        self._capacity = threading.Semaphore(self.max_in_flight)
+        self._idle = threading.Condition()
+        self._in_flight = 0
+        self._order = itertools.count()
+        self._pool = None
+        self._thread = None
+
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "skipped": 0,
+            "max_in_flight": 0,
+            "per_sensor": {},
+        }
+
+    # --------------------------------------------------------------------------
+    # pool callbacks, run on the pool's result handler thread
+    # --------------------------------------------------------------------------
+
+    def _finished(self):
+        with self._idle:
+            self._in_flight -= 1
+            self._idle.notify_all()
+        self._capacity.release()
+
+    def _done(self, frame: Dict, result):
+        self.stats["completed"] += 1
+        if self.metrics.enabled:
+            result, start, end, worker = result
+            self.metrics.record("process", frame["sensor"], end - start)
+            self.metrics.worker_busy(worker, end - start)
+            if "t_publish" in frame:
+                self.metrics.record("end_to_end", frame["sensor"], time.monotonic() - frame["t_publish"])
+        self._finished()
+        if self.on_result is not None:
+            self.on_result(frame, result)
+
+    def _failed(self, frame: Dict, error: BaseException):
+        self.stats["failed"] += 1
+        self.metrics.count("failed", frame.get("sensor", ""))
+        self._finished()
+        if self.on_error is not None:
+            self.on_error(frame, error)
+        else:
+            print(f"Error processing {frame.get('sensor')} frame {frame.get('timestamp')}: {error!r}")
+
+    # --------------------------------------------------------------------------
+
+    def _submit(self, frame: Dict, queue, pending: list):
+        sensor = frame["sensor"]
+        with self._idle:
+            self._in_flight += 1
+            in_flight = self._in_flight
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], in_flight)
+        self.stats["submitted"] += 1
+        self.stats["per_sensor"][sensor] = self.stats["per_sensor"].get(sensor, 0) + 1
+
+        handler, args = self.handlers[sensor], (frame,)
+        if self.metrics.enabled:
+            if "t_publish" in frame:
+                self.metrics.record("wait", sensor, time.monotonic() - frame["t_publish"])
+            self.metrics.gauge("in_flight", in_flight)
+            self.metrics.gauge("read_ahead", len(pending))
+            try:
+                self.metrics.gauge("queue", queue.qsize())
+            except NotImplementedError:
+                pass  # qsize() is not available on macOS
+            # the worker reports its own timing along with the result
+            handler, args = timed_call, (handler, frame)
+        self._pool.apply_async(handler, args,
+                               callback=lambda result: self._done(frame, result),
+                               error_callback=lambda error: self._failed(frame, error))
+
+    def _accept(self, frame, pending: list) -> bool:
+        """Adds a queued frame to the pending heap, returns False on the sentinel."""
+        if frame is None or frame.get("sensor") == STOP_SENSOR:
+            return False
+        sensor = frame.get("sensor")
+        if sensor not in self.handlers:
+            print(f"Skipping frame of unknown sensor type: {sensor}")
+            self.stats["skipped"] += 1
+            return True
+        priority = self.priorities.get(sensor, 0)
+        heapq.heappush(pending, (-priority, next(self._order), frame))
+        return True
+
+    def run(self, queue):
+        """Dispatches frames until the sentinel is read and every frame is done.
+
+        Args:
+            queue (multiprocessing.Queue): frames put by the collectors
+        """
+        pending = []
+        running = True
+        while running or pending:
+            # wait until the pool can take another frame
+            self._capacity.acquire()
+
+            if running and not pending:
+                running = self._accept(queue.get(), pending)
+            # read ahead without blocking so the next frame can be picked by priority
+            while running and len(pending) < self.window:
+                try:
+                    running = self._accept(queue.get_nowait(), pending)
+                except queue_module.Empty:
+                    break
+
+            if not pending:
+                self._capacity.release()
+                continue
+            self._submit(heapq.heappop(pending)[2], queue, pending)
+
+        # wait for the frames still in the pool
+        with self._idle:
+            while self._in_flight > 0:
+                self._idle.wait()
+
+    def start(self, queue) -> "FrameScheduler":
+        """Creates the pool and runs the scheduler on a background thread.
+
+        The pool is created on the calling thread, before the collectors start,
+        so even forked workers come from a quiet process.
+        """
+        context = mp.get_context(self.start_method)
+        if context.get_start_method() == "forkserver" and self.preload:
+            export_sys_path()
+            context.set_forkserver_preload(self.preload)
+        self._pool = context.Pool(processes=self.processes, initializer=self.initializer, initargs=self.initargs)
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self.run, args=(queue,), daemon=True)
+        self._thread.start()
+        return self
+
+    def join(self) -> Dict:
+        """Waits for the scheduler to drain, shuts the pool down and returns the stats."""
+        self._thread.join()
+        self._pool.close()
+        self._pool.join()
+        self.stats["elapsed"] = time.monotonic() - self._started
+        return self.stats
@@ -0,0 +1,205 @@
+"""
+Time synchronization of the thermal, depth and rgb streams.
+
+FrameSynchronizer takes frames of every sensor as they arrive and emits
+bundles: one frame of the reference sensor together with the frame of every
+other sensor closest to it in time (or interpolated between the two frames
+around it), as long as it lies within the tolerance window.
+
+    sync = FrameSynchronizer(reference="thermal", tolerance=0.1)
+    for frame in frames:
+        for bundle in sync.push(frame):
+            fuse(bundle["frames"]["thermal"], bundle["frames"]["depth"])
+    for bundle in sync.flush():
+        ...
+
+Frames are matched on their "t_mono" monotonic timestamp. Every sensor keeps a
+bounded buffer, so memory stays constant no matter how long the survey runs.
+"""
+import heapq
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from sensor_sources import SensorSource
+
+
+class FrameSynchronizer:
+    """Pairs frames of several sensors by their monotonic timestamps."""
+
+    def __init__(self, sensors=("thermal", "depth", "rgb"), reference: str = "thermal",
+                 tolerance: float = 0.1, max_buffer: int = 16, interpolate: bool = False,
+                 require_all: bool = True):
+        """
+        Args:
+            sensors (tuple): sensors that make up a bundle
+            reference (str): sensor every bundle is built around, usually the slowest one
+            tolerance (float): largest time difference in seconds between the reference and a matched frame
+            max_buffer (int): frames kept per sensor while waiting for a match
+            interpolate (bool): linearly interpolate the arrays of the two frames around the
+                reference time instead of taking the nearest frame
+            require_all (bool): drop bundles missing a sensor, otherwise emit them with None
+        """
+        if reference not in sensors:
+            raise ValueError(f"Reference sensor {reference} is not one of {sensors}")
+        self.sensors = tuple(sensors)
+        self.reference = reference
+        self.tolerance = tolerance
+        self.interpolate = interpolate
+        self.require_all = require_all
+        self._buffers = {sensor: deque(maxlen=max_buffer) for sensor in self.sensors}
+
+        self.stats = {
+            "bundles": 0,
+            "dropped_bundles": 0,
+            "evicted": {sensor: 0 for sensor in self.sensors},
+            "unmatched": {sensor: 0 for sensor in self.sensors if sensor != reference},
+            "max_skew": {sensor: 0.0 for sensor in self.sensors if sensor != reference},
+            "mean_skew": {sensor: 0.0 for sensor in self.sensors if sensor != reference},
+        }
+
+    def push(self, frame: Dict) -> List[Dict]:
+        """Adds a frame and returns the bundles that became complete.
+
+        Args:
+            frame (Dict): frame with "sensor" and "t_mono" keys
+
+        Returns:
+            List[Dict]: bundles, see _bundle()
+        """
+        buffer = self._buffers.get(frame["sensor"])
+        if buffer is None:
+            return []
+        if buffer and frame["t_mono"] < buffer[-1]["t_mono"]:
+            return []  # out of order frame, the stream has already moved on
+        bundles = []
+        if len(buffer) == buffer.maxlen:
+            if frame["sensor"] == self.reference:
+                # the others are too far behind, bundle the oldest reference with what there is
+                bundle = self._bundle(buffer.popleft())
+                if bundle is not None:
+                    bundles.append(bundle)
+            else:
+                self.stats["evicted"][frame["sensor"]] += 1
+        buffer.append(frame)
+        return bundles + self._emit(final=False)
+
+    def flush(self) -> List[Dict]:
+        """Emits the remaining reference frames with whatever frames are buffered."""
+        return self._emit(final=True)
+
+    def _ready(self, t_ref: float) -> bool:
+        """True once every other sensor has a frame at or past the reference time.
+
+        Only a sensor's own stream tells whether a closer frame may still come, so a
+        reference stream running ahead (e.g. a burst after a stall) waits for the
+        others; a sensor that stopped is handled by flush() or by the reference
+        buffer filling up, see push().
+        """
+        for sensor in self.sensors:
+            if sensor == self.reference:
+                continue
+            buffer = self._buffers[sensor]
+            if not buffer or buffer[-1]["t_mono"] < t_ref:
+                return False
+        return True
+
+    def _emit(self, final: bool) -> List[Dict]:
+        bundles = []
+        references = self._buffers[self.reference]
+        while references:
+            t_ref = references[0]["t_mono"]
+            if not final and not self._ready(t_ref):
+                break
+            bundle = self._bundle(references.popleft())
+            if bundle is not None:
+                bundles.append(bundle)
+        return bundles
+
+    def _match(self, sensor: str, t_ref: float):
+        """Finds the frames of a sensor around the reference time and forgets older ones."""
+        buffer = self._buffers[sensor]
+        before = after = None
+        for frame in buffer:
+            if frame["t_mono"] <= t_ref:
+                before = frame
+            else:
+                after = frame
+                break
+
+        # frames older than the one before the reference time can not match later references
+        while buffer and before is not None and buffer[0] is not before:
+            buffer.popleft()
+        return before, after
+
+    def _bundle(self, reference: Dict) -> Optional[Dict]:
+        """Builds the bundle of a reference frame.
+
+        Returns:
+            Optional[Dict]: {"t_mono", "frames": {sensor: frame}, "skew": {sensor: seconds}}
+                or None when a sensor has no frame within the tolerance
+        """
+        t_ref = reference["t_mono"]
+        frames = {self.reference: reference}
+        skews = {}
+        for sensor in self.sensors:
+            if sensor == self.reference:
+                continue
+            before, after = self._match(sensor, t_ref)
+            candidates = [f for f in (before, after) if f is not None and abs(f["t_mono"] - t_ref) <= self.tolerance]
+            if not candidates:
+                self.stats["unmatched"][sensor] += 1
+                frames[sensor] = None
+                continue
+
+            if self.interpolate and len(candidates) == 2:
+                frames[sensor] = self._interpolated(before, after, t_ref)
+                skews[sensor] = 0.0
+            else:
+                nearest = min(candidates, key=lambda f: abs(f["t_mono"] - t_ref))
+                frames[sensor] = nearest
+                skews[sensor] = nearest["t_mono"] - t_ref
+
+        if self.require_all and any(frame is None for frame in frames.values()):
+            self.stats["dropped_bundles"] += 1
+            return None
+
+        # running skew statistics
+        self.stats["bundles"] += 1
+        count = self.stats["bundles"]
+        for sensor, skew in skews.items():
+            self.stats["max_skew"][sensor] = max(self.stats["max_skew"][sensor], abs(skew))
+            self.stats["mean_skew"][sensor] += (abs(skew) - self.stats["mean_skew"][sensor]) / count
+        return {"t_mono": t_ref, "frames": frames, "skew": skews}
+
+    @staticmethod
+    def _interpolated(before: Dict, after: Dict, t_ref: float) -> Dict:
+        """Linearly interpolates the arrays of two frames at the reference time."""
+        weight = (t_ref - before["t_mono"]) / (after["t_mono"] - before["t_mono"])
+        arrays = {}
+        for key, value in before["arrays"].items():
+            if np.issubdtype(value.dtype, np.floating):
+                arrays[key] = value + (after["arrays"][key] - value) * weight
+            else:
+                arrays[key] = (after if weight >= 0.5 else before)["arrays"][key]
+        frame = dict(before)
+        frame.update({"t_mono": t_ref, "arrays": arrays, "interpolated": True})
+        return frame
+
+
+def bundle_sources(sources: Dict[str, SensorSource], **kwargs) -> Iterator[Dict]:
+    """Bundles recorded sources offline, reading the streams in time order.
+
+    Args:
+        sources (Dict[str, SensorSource]): opened sources keyed by sensor, e.g. from open_replay_sources()
+        **kwargs: FrameSynchronizer options
+
+    Yields:
+        Dict: bundles in time order
+    """
+    sync = FrameSynchronizer(sensors=tuple(sources), **kwargs)
+    streams: Iterable[Dict] = heapq.merge(*sources.values(), key=lambda frame: frame["t_mono"])
+    for frame in streams:
+        yield from sync.push(frame)
+    yield from sync.flush()
@@ -0,0 +1,328 @@
+"""
+Shared-memory frame transport between the collectors and the processing workers.
+
+Collectors copy each frame once into a slot of a SharedFrameRing and only a small
+descriptor dictionary goes over the multiprocessing queue. Workers map the same
+slot and read the arrays in place, then release the slot so it can be reused.
+
+    transport = FrameTransport(slots=8)
+    descriptor = transport.publish(frame)        # collector
+    queue.put(descriptor)
+
+    arrays = load_frame(descriptor)              # worker
+    ...
+    release_frame(descriptor)
+
+A slot is only reused once every holder (the processing worker and, when raw
+frames are persisted, the AsyncNpzSink) has released it, so a full ring blocks
+the collector instead of growing memory.
+"""
+import os
+import queue
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from pipeline_metrics import NULL_METRICS
+
+# holders of a slot, each one only ever clears its own flag
+HOLD_PROCESS = 0
+HOLD_SINK = 1
+NUM_HOLDERS = 2
+
+# npz file name prefix of each sensor, same names the collectors always used
+NPZ_PREFIXES = {
+    "thermal": "mlx90640",
+    "depth": "tof",
+    "rgb": "rgb",
+}
+
+_ALIGNMENT = 64
+
+# rings this process has attached to, keyed by shared memory name
+_attached: Dict[str, "SharedFrameRing"] = {}
+
+
+def _align(size: int) -> int:
+    return (size + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class SharedFrameRing:
+    """A fixed number of frame slots in one shared memory block.
+
+    Every slot holds all the arrays of one frame (e.g. depth and confidence)
+    laid out back to back. The block starts with a small header holding the
+    holder flags and the sequence number of every slot.
+    """
+
+    def __init__(self, layout: Dict[str, Tuple[Tuple[int, ...], str]], slots: int = 8,
+                 name: Optional[str] = None, create: bool = True):
+        """
+        Args:
+            layout (Dict): array name -> (shape, dtype string) of one frame
+            slots (int): number of frames the ring can hold
+            name (str, optional): shared memory name, generated when creating
+            create (bool): create the block, attach to an existing one otherwise
+        """
+        self.layout = {key: (tuple(shape), np.dtype(dtype).str) for key, (shape, dtype) in layout.items()}
+        self.slots = slots
+
+        # offsets of every array inside a slot
+        self._offsets = {}
+        offset = 0
+        for key, (shape, dtype) in self.layout.items():
+            self._offsets[key] = offset
+            offset += _align(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self.slot_size = offset
+
+        self._header_size = _align(NUM_HOLDERS * slots + 8 * slots)
+        size = self._header_size + self.slot_size * slots
+        self._shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.name = self._shm.name
+        self.owner = create
+
+        buf = self._shm.buf
+        self._holders = np.ndarray((NUM_HOLDERS, slots), dtype=np.uint8, buffer=buf)
+        self._seq = np.ndarray((slots,), dtype=np.int64, buffer=buf, offset=NUM_HOLDERS * slots)
+        if create:
+            self._holders[:] = 0
+            self._seq[:] = -1
+
+        self._next_slot = 0
+        self._next_seq = 0
+        _attached[self.name] = self
+
+    @classmethod
+    def for_frame(cls, arrays: Dict[str, np.ndarray], slots: int = 8) -> "SharedFrameRing":
+        """Creates a ring sized for frames shaped like the given arrays."""
+        return cls({key: (value.shape, value.dtype.str) for key, value in arrays.items()}, slots)
+
+    @classmethod
+    def attach(cls, name: str, layout: Dict, slots: int) -> "SharedFrameRing":
+        """Returns the ring with the given name, attaching to it once per process."""
+        ring = _attached.get(name)
+        if ring is None:
+            ring = cls(layout, slots, name=name, create=False)
+        return ring
+
+    def __reduce__(self):
+        # rings are sent between processes by name only
+        return (SharedFrameRing.attach, (self.name, self.layout, self.slots))
+
+    def _views(self, slot: int) -> Dict[str, np.ndarray]:
+        base = self._header_size + slot * self.slot_size
+        return {
+            key: np.ndarray(shape, dtype=dtype, buffer=self._shm.buf, offset=base + self._offsets[key])
+            for key, (shape, dtype) in self.layout.items()
+        }
+
+    def _acquire(self, timeout: Optional[float]) -> int:
+        """Finds a slot no holder is using, waiting for one when the ring is full."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for i in range(self.slots):
+                slot = (self._next_slot + i) % self.slots
+                if not self._holders[:, slot].any():
+                    self._next_slot = (slot + 1) % self.slots
+                    return slot
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"No free slot in frame ring {self.name}")
+            time.sleep(0.001)
+
+    def write(self, arrays: Dict[str, np.ndarray], holders=(HOLD_PROCESS,),
+              timeout: Optional[float] = None) -> Tuple[int, int]:
+        """Copies a frame into a free slot.
+
+        Only a single thread may write to a ring.
+
+        Args:
+            arrays (Dict[str, np.ndarray]): arrays of the frame, must match the layout
+            holders (tuple): holders that have to release the slot before it is reused
+            timeout (float, optional): seconds to wait for a free slot, forever if None
+
+        Returns:
+            Tuple[int, int]: slot index and sequence number of the frame
+        """
+        slot = self._acquire(timeout)
+        views = self._views(slot)
+        for key, view in views.items():
+            value = arrays[key]
+            if value.shape != view.shape:
+                raise ValueError(f"{key} has shape {value.shape}, ring expects {view.shape}")
+            np.copyto(view, value, casting="same_kind")
+
+        seq = self._next_seq
+        self._next_seq += 1
+        self._seq[slot] = seq
+        for holder in holders:
+            self._holders[holder, slot] = 1
+        return slot, seq
+
+    def read(self, slot: int, seq: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Returns views of the arrays in a slot, no data is copied."""
+        if seq is not None and self._seq[slot] != seq:
+            raise RuntimeError(f"Slot {slot} of {self.name} was reused before it was released")
+        return self._views(slot)
+
+    def release(self, slot: int, holder: int = HOLD_PROCESS):
+        self._holders[holder, slot] = 0
+
+    def in_use(self) -> int:
+        """Number of slots still held by a worker or the sink."""
+        return int(self._holders.any(axis=0).sum())
+
+    def close(self):
+        _attached.pop(self.name, None)
+        # drop the numpy views before closing the mapping
+        self._holders = None
+        self._seq = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass  # a caller still holds a view, the mapping goes away with it
+        if self.owner:
+            self._shm.unlink()
+
+
+def load_frame(data: Dict) -> Dict[str, np.ndarray]:
+    """Returns the arrays of a queued frame.
+
+    Shared memory descriptors return views into the ring; packets carrying a
+    "path" (older captures) are loaded from the .npz file.
+    """
+    if "ring" in data:
+        return data["ring"].read(data["slot"], data.get("seq"))
+    with np.load(data["path"]) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def release_frame(data: Dict):
+    """Releases the slot of a queued frame once the worker is done with it."""
+    if "ring" in data:
+        data["ring"].release(data["slot"], HOLD_PROCESS)
+
+
+class AsyncNpzSink:
+    """Persists raw frames as .npz files on a background thread.
+
+    Frames are saved straight from their ring slot; the slot is released once
+    the file is written. When the sink falls behind, frames are dropped from
+    persistence instead of stalling the collectors.
+    """
+
+    def __init__(self, directory: str, max_pending: int = 16, metrics=None):
+        """
+        Args:
+            directory (str): data directory, files go to <directory>/<sensor>/
+            max_pending (int): frames waiting to be written before frames are dropped
+            metrics (PipelineMetrics, optional): records the save stage and dropped frames
+        """
+        self.directory = directory
+        self.metrics = metrics or NULL_METRICS
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, descriptor: Dict) -> bool:
+        """Queues a frame for saving, returns False if it was dropped."""
+        try:
+            self._queue.put_nowait(descriptor)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            self.metrics.count("save_dropped", descriptor["sensor"])
+            descriptor["ring"].release(descriptor["slot"], HOLD_SINK)
+            return False
+
+    def _run(self):
+        while True:
+            descriptor = self._queue.get()
+            if descriptor is None:
+                return
+            sensor = descriptor["sensor"]
+            path = os.path.join(self.directory, sensor,
+                                f"{NPZ_PREFIXES.get(sensor, sensor)}_{descriptor['timestamp']}.npz")
+            try:
+                start = time.monotonic()
+                np.savez(path, **descriptor["ring"].read(descriptor["slot"], descriptor["seq"]))
+                self.metrics.record("save", sensor, time.monotonic() - start)
+                self.written += 1
+            except Exception as e:
+                print(f"Error saving {path}: {e}")
+            finally:
+                descriptor["ring"].release(descriptor["slot"], HOLD_SINK)
+
+    def close(self):
+        """Writes the pending frames and stops the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+class FrameTransport:
+    """Publishes collector frames into one SharedFrameRing per sensor."""
+
+    def __init__(self, slots: int = 8, sink: Optional[AsyncNpzSink] = None,
+                 timeout: Optional[float] = None):
+        """
+        Args:
+            slots (int): slots per sensor ring
+            sink (AsyncNpzSink, optional): also persist every raw frame
+            timeout (float, optional): seconds a collector waits for a free slot
+        """
+        self.slots = slots
+        self.sink = sink
+        self.timeout = timeout
+        self.rings: Dict[str, SharedFrameRing] = {}
+        self._lock = threading.Lock()
+
+        # start the resource tracker now so worker processes created later share
+        # it; a worker starting its own tracker would unlink the rings on exit
+        resource_tracker.ensure_running()
+
+    def _ring(self, sensor: str, arrays: Dict[str, np.ndarray]) -> SharedFrameRing:
+        ring = self.rings.get(sensor)
+        if ring is None:
+            with self._lock:
+                ring = self.rings.get(sensor)
+                if ring is None:
+                    ring = SharedFrameRing.for_frame(arrays, self.slots)
+                    self.rings[sensor] = ring
+        return ring
+
+    def publish(self, frame: Dict) -> Dict:
+        """Copies a sensor frame into shared memory.
+
+        Args:
+            frame (Dict): frame returned by a SensorSource
+
+        Returns:
+            Dict: descriptor to put on the processing queue
+        """
+        ring = self._ring(frame["sensor"], frame["arrays"])
+        holders = (HOLD_PROCESS, HOLD_SINK) if self.sink is not None else (HOLD_PROCESS,)
+        slot, seq = ring.write(frame["arrays"], holders, self.timeout)
+        descriptor = {
+            "sensor": frame["sensor"],
+            "timestamp": frame["timestamp"],
+            "t_mono": frame["t_mono"],
+            "t_publish": time.monotonic(),
+            "ring": ring,
+            "slot": slot,
+            "seq": seq,
+        }
+        if self.sink is not None:
+            self.sink.submit(descriptor)
+        return descriptor
+
+    def close(self):
+        """Flushes the sink and frees the shared memory."""
+        if self.sink is not None:
+            self.sink.close()
+        for ring in self.rings.values():
+            ring.close()
+        self.rings.clear()
@@ -0,0 +1,234 @@
+"""
+Background image encoding and writing for the processing workers.
+
+Processing functions hand their finished image to an ImageWriter and carry on
+with the next frame; a small thread pool encodes and writes it (OpenCV
+releases the GIL while encoding, so the threads really run in parallel). The
+queue in front of the pool is bounded, so a slow SD card holds the workers back
+instead of filling the memory.
+
+    writer = ImageWriter(format="jpeg", quality=90)
+    path = writer.submit(image, "data/images/rgb_17-39-27.341.png")   # -> rgb_17-39-27.341.jpg
+    writer.close()
+
+Formats:
+    - png:  lossless, `compression` 0 to 9 (smallest), OpenCV's fast default if not given
+    - jpeg: `quality` 0-100
+    - webp: `quality` 1-100, above 100 is lossless
+    - raw:  the array itself as .npy, no encoding at all
+
+Files are written straight away but only fsync'ed in batches (every
+`fsync_every` files and on flush/close), so durability costs one sync per batch
+instead of one per image.
+
+Worker processes share the settings through configure_writer() and each one
+gets its own writer from shared_writer(), flushed when the process exits.
+"""
+import os
+import queue
+import threading
+import time
+from multiprocessing import util
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+
+# file extension of every format
+IMAGE_FORMATS = {
+    "png": ".png",
+    "jpeg": ".jpg",
+    "webp": ".webp",
+    "raw": ".npy",
+}
+
+
+def encode_params(format: str, quality: Optional[int] = None, compression: Optional[int] = None) -> List[int]:
+    """OpenCV imencode parameters of a format."""
+    if format == "png":
+        # OpenCV's default (level 1 with the RLE strategy) is several times faster than any explicit level
+        return [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, compression]
+    if format == "jpeg":
+        return [cv2.IMWRITE_JPEG_QUALITY, 90 if quality is None else quality]
+    if format == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, 90 if quality is None else quality]
+    if format == "raw":
+        return []
+    raise ValueError(f"Unknown image format: {format}, expected one of {list(IMAGE_FORMATS)}")
+
+
+class ImageWriter:
+    """Encodes and writes images on a thread pool behind a bounded queue."""
+
+    def __init__(self, format: str = "png", quality: Optional[int] = None, compression: Optional[int] = None,
+                 threads: int = 2, max_pending: int = 16, fsync_every: int = 0, block: bool = True):
+        """
+        Args:
+            format (str): "png", "jpeg", "webp" or "raw"
+            quality (int, optional): JPEG / WebP quality
+            compression (int, optional): PNG compression level, OpenCV's fast default if None
+            threads (int): encoding threads
+            max_pending (int): images queued before submit() waits (or drops, see block)
+            fsync_every (int): fsync the written files in batches of this many, 0 never syncs
+            block (bool): wait for room in the queue, otherwise drop the image
+        """
+        self.format = format
+        self.params = encode_params(format, quality, compression)
+        self.fsync_every = fsync_every
+        self.block = block
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.encode_time = 0.0
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._unsynced: List[str] = []
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def path_for(self, path: str, format: Optional[str] = None) -> str:
+        """The path with the extension of the format."""
+        return os.path.splitext(path)[0] + IMAGE_FORMATS[format or self.format]
+
+    def submit(self, image: np.ndarray, path: str, format: Optional[str] = None,
+               params: Optional[List[int]] = None) -> Optional[str]:
+        """Queues an image for writing.
+
+        The writer keeps a reference to the array, so it must not be modified
+        afterwards (pass a copy when the buffer is reused).
+
+        Args:
+            image (np.ndarray): BGR(A) or grayscale image
+            path (str): destination, the extension is replaced by the format's
+            format (str, optional): format of this image instead of the writer's
+            params (List[int], optional): imencode parameters instead of the writer's
+
+        Returns:
+            Optional[str]: path the image will be written to, None if it was dropped
+        """
+        format = format or self.format
+        if params is None:
+            params = self.params if format == self.format else encode_params(format)
+        path = self.path_for(path, format)
+        try:
+            self._queue.put((image, path, format, params), block=self.block)
+        except queue.Full:
+            self.dropped += 1
+            return None
+        return path
+
+    def _write(self, image: np.ndarray, path: str, format: str, params: List[int]):
+        start = time.monotonic()
+        if format == "raw":
+            with open(path, "wb") as f:
+                np.save(f, image)
+        else:
+            ok, encoded = cv2.imencode(IMAGE_FORMATS[format], image, params)
+            if not ok:
+                raise ValueError(f"Could not encode {path}")
+            with open(path, "wb") as f:
+                f.write(encoded.data)
+
+        batch = None
+        with self._lock:
+            self.written += 1
+            self.encode_time += time.monotonic() - start
+            if self.fsync_every:
+                self._unsynced.append(path)
+                if len(self._unsynced) >= self.fsync_every:
+                    batch, self._unsynced = self._unsynced, []
+        if batch is not None:
+            _fsync(batch)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.failed += 1
+                print(f"Error writing {item[1]}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Waits until every queued image is written and synced."""
+        self._queue.join()
+        with self._lock:
+            batch, self._unsynced = self._unsynced, []
+        _fsync(batch)
+
+    def close(self):
+        """Writes the pending images and stops the threads."""
+        if not self._threads:
+            return
+        self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self) -> Dict:
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "encode_ms": 1e3 * self.encode_time / self.written if self.written else 0.0,
+        }
+
+
+def _fsync(paths: List[str]):
+    """Syncs a batch of files and the directories holding them."""
+    directories = set()
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(path) or ".")
+        except OSError:
+            pass
+    for directory in directories:
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass  # directories can not be opened on every platform
+
+
+# ------------------------------------------------------------------------------
+# one writer per process
+# ------------------------------------------------------------------------------
+
+_settings = {}
+_writer = None
+_writer_pid = None
+
+
+def configure_writer(**settings):
+    """Sets the ImageWriter options of shared_writer(); pass it as the pool initializer (with
+    functools.partial) so forkserver and spawn workers get the settings too."""
+    global _settings
+    _settings = settings
+
+
+def shared_writer() -> ImageWriter:
+    """The ImageWriter of the current process, created on first use after a fork."""
+    global _writer, _writer_pid
+    if _writer is None or _writer_pid != os.getpid():
+        _writer = ImageWriter(**_settings)
+        _writer_pid = os.getpid()
+        # pool workers exit without running atexit handlers, finalizers do run
+        util.Finalize(_writer, _writer.close, exitpriority=10)
+    return _writer
@@ -0,0 +1,347 @@
+"""
+Lightweight instrumentation of the capture -> transport -> processing -> save pipeline.
+
+Every stage records how long it took for each frame into a log-linear latency
+histogram (HDR style: fixed relative precision from microseconds to hours in
+about a thousand counters), keyed by stage and sensor. Queue depths are
+sampled as gauges, drops and errors are plain counters and the time the pool
+workers spend in the handlers gives their utilization.
+
+    metrics = PipelineMetrics()
+    t0 = time.monotonic()
+    frame = source.read()
+    metrics.record("capture", "thermal", time.monotonic() - t0)
+    metrics.gauge("queue", queue.qsize())
+    metrics.count("dropped", "thermal")
+
+    print(metrics.format_table())
+    metrics.export("metrics.json")      # or .csv
+
+Instrumented code takes NULL_METRICS when metrics are off: its methods do
+nothing and `enabled` is False so callers can skip taking timestamps at all.
+MetricsDashboard prints the table every few seconds while the pipeline runs.
+
+Stages recorded by the harness (tests/all_sensor_test.py):
+    - capture:    SensorSource.read()
+    - publish:    copy into the shared memory ring, including waiting for a free slot
+    - enqueue:    putting the descriptor on the bounded queue (back pressure)
+    - wait:       publish -> handed to a pool worker by the scheduler
+    - process:    handler run time in the worker (decode, render and save the image)
+    - end_to_end: publish -> handler done
+    - save:       raw frame written by the sink
+"""
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# percentiles reported in the table and the exports
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """Log-linear histogram of durations with a fixed relative precision.
+
+    Values are counted in integer microseconds. The first 2 * 2**sub_bits
+    microseconds have one counter each, every further power of two is split
+    into 2**sub_bits counters, so a value is known to within 1 / 2**sub_bits
+    (about 3 % for the default) whatever its magnitude.
+    """
+
+    def __init__(self, sub_bits: int = 5, max_seconds: float = 3600.0):
+        """
+        Args:
+            sub_bits (int): log2 of the counters per power of two
+            max_seconds (float): longest duration counted exactly, longer ones go in the last counter
+        """
+        self.sub_bits = sub_bits
+        self._sub = 1 << sub_bits
+        self._max_index = self._index(int(max_seconds * 1e6))
+        self.counts = np.zeros(self._max_index + 1, dtype=np.int64)
+        self.total = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def _index(self, micros: int) -> int:
+        if micros < 2 * self._sub:
+            return micros
+        shift = micros.bit_length() - self.sub_bits - 1
+        return (shift + 1) * self._sub + (micros >> shift) - self._sub
+
+    def _lower(self, index: np.ndarray) -> np.ndarray:
+        """Smallest value in microseconds counted by each index."""
+        index = np.asarray(index, dtype=np.int64)
+        shift = np.maximum(index // self._sub - 1, 0)
+        mantissa = np.where(index < 2 * self._sub, index, index % self._sub + self._sub)
+        return mantissa << shift
+
+    def record(self, seconds: float):
+        micros = max(int(seconds * 1e6), 0)
+        self.counts[min(self._index(micros), self._max_index)] += 1
+        self.total += 1
+        self.sum += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: "LatencyHistogram"):
+        self.counts += other.counts
+        self.total += other.total
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q: float) -> float:
+        """Value in seconds below which q percent of the recorded durations lie."""
+        if self.total == 0:
+            return 0.0
+        rank = max(int(np.ceil(q / 100.0 * self.total)), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        # middle of the counter, but never outside what was actually recorded
+        lower = float(self._lower(index))
+        upper = float(self._lower(index + 1))
+        return min(max((lower + upper) / 2e6, self.min), self.max)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.total if self.total else 0.0
+
+    def summary(self) -> Dict:
+        summary = {
+            "count": self.total,
+            "mean": self.mean,
+            "min": self.min if self.total else 0.0,
+            "max": self.max,
+        }
+        for q in PERCENTILES:
+            summary[f"p{q:g}"] = self.percentile(q)
+        return summary
+
+
+class Gauge:
+    """Samples of a level such as a queue depth."""
+
+    def __init__(self):
+        self.samples = 0
+        self.last = 0.0
+        self.max = 0.0
+        self.sum = 0.0
+
+    def set(self, value: float):
+        self.samples += 1
+        self.last = value
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def summary(self) -> Dict:
+        return {
+            "samples": self.samples,
+            "last": self.last,
+            "mean": self.sum / self.samples if self.samples else 0.0,
+            "max": self.max,
+        }
+
+
+class PipelineMetrics:
+    """Latency histograms, gauges, counters and worker busy time of one run."""
+
+    enabled = True
+
+    def __init__(self, sub_bits: int = 5):
+        """
+        Args:
+            sub_bits (int): histogram precision, see LatencyHistogram
+        """
+        self.sub_bits = sub_bits
+        self.histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+        self.gauges: Dict[str, Gauge] = {}
+        self.counters: Dict[Tuple[str, str], int] = {}
+        self.busy: Dict[int, float] = {}
+        self.workers = 0
+        self.started = time.monotonic()
+        self.stopped = None
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, sensor: str, seconds: float):
+        """Adds the duration of one frame in one stage."""
+        key = (stage, sensor)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram(self.sub_bits)
+            histogram.record(seconds)
+
+    def gauge(self, name: str, value: float):
+        """Samples a level, e.g. the number of frames waiting in a queue."""
+        with self._lock:
+            gauge = self.gauges.get(name)
+            if gauge is None:
+                gauge = self.gauges[name] = Gauge()
+            gauge.set(value)
+
+    def count(self, name: str, sensor: str = "", n: int = 1):
+        """Adds to a counter such as dropped frames."""
+        key = (name, sensor)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def worker_busy(self, worker: int, seconds: float):
+        """Adds time a pool worker (by pid) spent running a handler."""
+        with self._lock:
+            self.busy[worker] = self.busy.get(worker, 0.0) + seconds
+
+    def stop(self):
+        """Ends the measured run, utilization is computed up to here."""
+        self.stopped = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.stopped or time.monotonic()) - self.started
+
+    def utilization(self) -> Dict:
+        """Fraction of the run each worker was busy, and over the whole pool."""
+        elapsed = self.elapsed
+        with self._lock:
+            busy = dict(self.busy)
+        workers = max(self.workers, len(busy), 1)
+        return {
+            "pool": sum(busy.values()) / (elapsed * workers) if elapsed > 0 else 0.0,
+            "workers": {str(pid): seconds / elapsed if elapsed > 0 else 0.0 for pid, seconds in busy.items()},
+        }
+
+    # --------------------------------------------------------------------------
+    # reporting
+    # --------------------------------------------------------------------------
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            latencies = [dict(stage=stage, sensor=sensor, **histogram.summary())
+                         for (stage, sensor), histogram in histograms]
+            gauges = {name: gauge.summary() for name, gauge in sorted(self.gauges.items())}
+            counters = [{"name": name, "sensor": sensor, "count": n}
+                        for (name, sensor), n in sorted(self.counters.items())]
+        return {
+            "elapsed": self.elapsed,
+            "latency": latencies,
+            "gauges": gauges,
+            "counters": counters,
+            "utilization": self.utilization(),
+        }
+
+    def export(self, path: str):
+        """Writes the metrics as JSON, or as CSV rows when the path ends with .csv."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        metrics = self.to_dict()
+        if not path.endswith(".csv"):
+            with open(path, "w") as f:
+                json.dump(metrics, f, indent=2)
+            return
+
+        # one row per latency histogram, gauge and counter
+        fields = ["kind", "name", "sensor", "count", "mean", "min", "max"] + [f"p{q:g}" for q in PERCENTILES]
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            writer.writeheader()
+            for row in metrics["latency"]:
+                writer.writerow(dict(row, kind="latency", name=row["stage"]))
+            for name, gauge in metrics["gauges"].items():
+                writer.writerow({"kind": "gauge", "name": name, "count": gauge["samples"],
+                                 "mean": gauge["mean"], "max": gauge["max"]})
+            for row in metrics["counters"]:
+                writer.writerow(dict(row, kind="counter"))
+            writer.writerow({"kind": "utilization", "name": "pool", "mean": metrics["utilization"]["pool"]})
+
+    def format_table(self) -> str:
+        """Text table of the current metrics, latencies in milliseconds."""
+        metrics = self.to_dict()
+        lines = [f"{'stage':<12}{'sensor':<9}{'count':>7}{'mean':>9}"
+                 + "".join(f"{'p' + format(q, 'g'):>9}" for q in PERCENTILES) + f"{'max':>9}"]
+        for row in metrics["latency"]:
+            lines.append(f"{row['stage']:<12}{row['sensor']:<9}{row['count']:>7}{row['mean'] * 1e3:>9.2f}"
+                         + "".join(f"{row[f'p{q:g}'] * 1e3:>9.2f}" for q in PERCENTILES)
+                         + f"{row['max'] * 1e3:>9.2f}")
+        for name, gauge in metrics["gauges"].items():
+            lines.append(f"{name:<21}now {gauge['last']:>5g}  mean {gauge['mean']:>6.2f}  max {gauge['max']:>5g}")
+        for row in metrics["counters"]:
+            lines.append(f"{row['name']:<12}{row['sensor']:<9}{row['count']:>7}")
+        lines.append(f"workers busy {metrics['utilization']['pool'] * 100:.0f}% over {metrics['elapsed']:.1f}s")
+        return "\n".join(lines)
+
+
+class NullMetrics:
+    """Stand-in for PipelineMetrics when instrumentation is off, every call is a no-op."""
+
+    enabled = False
+    workers = 0
+
+    def record(self, stage: str, sensor: str, seconds: float):
+        pass
+
+    def gauge(self, name: str, value: float):
+        pass
+
+    def count(self, name: str, sensor: str = "", n: int = 1):
+        pass
+
+    def worker_busy(self, worker: int, seconds: float):
+        pass
+
+    def stop(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class MetricsDashboard:
+    """Prints the metrics table on a background thread while the pipeline runs."""
+
+    def __init__(self, metrics: PipelineMetrics, interval: float = 2.0, stream=None):
+        """
+        Args:
+            metrics (PipelineMetrics): metrics to show
+            interval (float): seconds between refreshes
+            stream (file, optional): where to print, stderr by default
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> "MetricsDashboard":
+        self._thread.start()
+        return self
+
+    def _run(self):
+        # redraw in place on a terminal, append otherwise (e.g. piped to a log)
+        clear = "\033[H\033[J" if self.stream.isatty() else ""
+        while not self._stop.wait(self.interval):
+            self.stream.write(f"{clear}------- Pipeline Metrics -------\n{self.metrics.format_table()}\n")
+            self.stream.flush()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def timed_call(handler, frame: Dict):
+    """Runs a handler in a pool worker and returns its result with the worker's timing.
+
+    Returns:
+        Tuple: (result, start, end, pid), start and end from time.monotonic()
+    """
+    start = time.monotonic()
+    result = handler(frame)
+    return result, start, time.monotonic(), os.getpid()
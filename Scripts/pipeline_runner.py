@@ -0,0 +1,748 @@
+"""
+Config driven capture and processing pipeline.
+
+A JSON file describes the whole run: which sensors to read (hardware or a
+replay), the stages every frame goes through, how many pool workers and how
+deep a queue each processing stage gets, where raw frames and images go and
+how long to run. Tuning a deployment is a matter of editing the file:
+
+    python3 pipeline_runner.py ../pipeline.json
+    python3 pipeline_runner.py ../pipeline.json --replay data --frames 100
+    python3 ../tests/all_sensor_test.py --config ../pipeline.json
+
+Example:
+
+    {
+        "run": {"frames": 10, "duration": null, "delay": 1},
+        "sources": {"thermal": {"refresh_rate": "REFRESH_8_HZ"}, "depth": {}, "rgb": {"drop_alpha": true}},
+        "stages": [
+            {"stage": "denoise", "sensors": ["thermal", "depth"], "method": "ema", "alpha": 0.3},
+            {"stage": "detect", "delta": 5.0, "track": true},
+            {"stage": "fuse", "window": 3},
+            {"stage": "map", "speed": 0.3, "export": "data/field.npz"},
+            {"stage": "render", "sensors": ["thermal", "depth"], "workers": 1, "queue": 32},
+            {"stage": "render", "sensors": ["rgb"], "workers": 2, "queue": 8}
+        ],
+        "writer": {"format": "jpeg", "quality": 90, "threads": 2},
+        "sink": {"type": "record", "path": "data/session"},
+        "detections": "data/detections.jsonl",
+        "metrics": {"file": "metrics.json"}
+    }
+
+Stages run in the order given. Collector stages (denoise, rgb, register,
+detect, anomaly, fuse, map) run on the sensor's collector thread right after the
+frame is read, in order and with their state, before the frame is published
+into shared memory. Render stages (render the image and hand it to the
+writer) run on a process pool of their own: every render stage has its own
+worker count, in-flight limit and bounded queue, so a slow sensor can get more
+workers without starving the others. Hotspots, anomalies and fused depths are
+appended to the detections log (one JSON line per frame, and one per thermal
+frame the fuse stage paired with a depth frame through a FrameSynchronizer).
+A map stage after the fuse stage folds its bundles into a probability map of
+the field, saved at the end of the run.
+
+With a "rate" section the collectors do not sleep a fixed delay but are paced
+by a RateController (rate_controller.py) fed by the render pools: the capture
+rates rise while the queues stay short and drop when they fill or the latency
+goes over target, optionally capped by the ground coverage at "speed":
+
+    "rate": {"min_rate": 0.5, "max_rate": 16, "target_latency": 0.5,
+             "speed": 0.3, "footprints": {"thermal": 0.4, "depth": 0.5}}
+
+With a "preview" section the collectors also hand their frames (with the
+stages' hotspots and anomalies) to a PreviewServer (preview_server.py) that
+streams the fused overlay to a browser, without ever slowing the capture:
+
+    "preview": {"port": 8080, "max_fps": 10, "quality": 70}
+
+A run ends after `frames` frames per sensor, after `duration` seconds or when
+the sources run out (end of a replay), whichever comes first; null means no
+limit.
+"""
+import argparse
+import copy
+import functools
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "HotspotDetection"))
+
+from frame_handlers import SENSOR_HANDLERS, SENSOR_PRIORITIES, read_frame, publish_frame, process_thermal_data
+from frame_scheduler import FrameScheduler
+from frame_transport import FrameTransport, AsyncNpzSink, release_frame
+from image_writer import configure_writer
+from pipeline_metrics import PipelineMetrics, MetricsDashboard, NULL_METRICS
+from rate_controller import RateController
+from sensor_sources import (SensorSource, ThermalSource, TofSource, RgbSource, RgbPreprocessor,
+                            open_replay_sources)
+from session_recorder import SessionRecorder, SessionSink
+
+SENSORS = ("thermal", "depth", "rgb")
+
+DEFAULT_CONFIG = {
+    "run": {"frames": 10, "duration": None, "delay": None, "start_method": "forkserver"},
+    "rate": None,                    # adaptive capture rates, RateController options plus "speed"
+    "replay": None,                  # {"path": ..., "rate": 1.0, "loop": false} instead of the hardware
+    "sources": {"thermal": {}, "depth": {}, "rgb": {}},
+    "transport": {"slots": 8},
+    "stages": [{"stage": "render", "sensors": list(SENSORS)}],
+    "writer": {"format": "png", "threads": 2},
+    "images": "data/images",
+    "sink": None,                    # {"type": "record", "path": ..., "compress": false} or {"type": "npz", "directory": ...}
+    "detections": None,              # JSON lines file of the hotspots, anomalies and fused depths
+    "metrics": None,                 # {"file": ..., "dashboard": seconds}
+    "preview": None,                 # PreviewServer options, e.g. {"port": 8080, "max_fps": 10}
+}
+
+
+def load_config(path: Optional[str] = None, overrides: Optional[Dict] = None) -> Dict:
+    """Reads a pipeline config and fills in the defaults.
+
+    Args:
+        path (str, optional): JSON config file, the defaults alone if None
+        overrides (Dict, optional): top level sections merged over the file's
+
+    Returns:
+        Dict: complete config
+    """
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    sections = {}
+    if path is not None:
+        with open(path) as f:
+            sections = json.load(f)
+    for name, value in list(sections.items()) + list((overrides or {}).items()):
+        if name not in DEFAULT_CONFIG:
+            raise ValueError(f"Unknown config section: {name}, expected one of {list(DEFAULT_CONFIG)}")
+        if isinstance(config[name], dict) and isinstance(value, dict) and name != "sources":
+            config[name].update(value)
+        else:
+            config[name] = value
+    for stage in config["stages"]:
+        if stage.get("stage") not in COLLECTOR_STAGES and stage.get("stage") != "render":
+            raise ValueError(f"Unknown stage: {stage.get('stage')}, expected one of "
+                             f"{list(COLLECTOR_STAGES) + ['render']}")
+    return config
+
+
+# ------------------------------------------------------------------------------
+# collector stages, run in order on the collector threads
+#
+# every stage imports what it needs when it is created, a run only loads the
+# modules of the stages in its config
+# ------------------------------------------------------------------------------
+
+class DenoiseStage:
+    """Temporal filter of the thermal and depth frames, see temporal_filter.py."""
+
+    default_sensors = ("thermal", "depth")
+
+    def __init__(self, sensors, method: str = "ema", alpha: float = 0.3, window: int = 5):
+        from temporal_filter import frame_filter
+        self.filters = {sensor: frame_filter(sensor, method, alpha=alpha, window=window) for sensor in sensors}
+
+    def __call__(self, frame: Dict) -> Dict:
+        frame["arrays"] = self.filters[frame["sensor"]](frame["arrays"])
+        return frame
+
+
+class RgbStage:
+    """Crops, downscales and drops the alpha channel of the rgb frames on the CPU."""
+
+    default_sensors = ("rgb",)
+
+    def __init__(self, sensors, roi=None, size=None, drop_alpha: bool = True):
+        self.preprocess = RgbPreprocessor(roi, size, drop_alpha)
+
+    def __call__(self, frame: Dict) -> Dict:
+        frame["arrays"]["rgb"] = self.preprocess(frame["arrays"]["rgb"])
+        return frame
+
+
+def _registration(calibration: Optional[str], src: str, dst: str):
+    from registration import Calibration, Registration, SENSOR_SIZES
+    if calibration:
+        return Calibration.load(calibration)[src, dst]
+    return Registration.scaling(SENSOR_SIZES[src], SENSOR_SIZES[dst])
+
+
+class RegisterStage:
+    """Adds the temperatures warped onto the depth pixels as "temperature_registered"."""
+
+    default_sensors = ("thermal",)
+
+    def __init__(self, sensors, calibration: Optional[str] = None, buffers: int = 4):
+        from registration import SENSOR_SIZES
+        self.registration = _registration(calibration, "thermal", "depth")
+        # frames are published before the buffer comes round again
+        self._buffers = np.empty((buffers,) + SENSOR_SIZES["depth"][::-1], dtype=np.float32)
+        self._next = 0
+
+    def __call__(self, frame: Dict) -> Dict:
+        out = self._buffers[self._next]
+        self._next = (self._next + 1) % len(self._buffers)
+        self.registration.warp(np.asarray(frame["arrays"]["temperature"], dtype=np.float32), dst=out)
+        frame["arrays"]["temperature_registered"] = out
+        return frame
+
+
+class DetectStage:
+    """Hotspots of the thermal frames against a rolling background, optionally tracked."""
+
+    default_sensors = ("thermal",)
+
+    def __init__(self, sensors, threshold: Optional[float] = None, delta: float = 5.0, alpha: float = 0.05,
+                 min_area: int = 1, track: bool = False, **tracker):
+        from thermal_hotspot import HotspotDetector
+        from tracker import HotspotTracker
+        self.detector = HotspotDetector(threshold, delta, alpha, min_area)
+        self.tracker = HotspotTracker(**tracker) if track else None
+
+    def __call__(self, frame: Dict) -> Dict:
+        hotspots = self.detector.detect(frame["arrays"]["temperature"])
+        frame["meta"]["hotspots"] = hotspots
+        if self.tracker is not None:
+            frame["meta"]["track_ids"] = self.tracker.update(hotspots)
+        return frame
+
+
+class AnomalyStage:
+    """Depth anomalies against the ground plane and a running background."""
+
+    default_sensors = ("depth",)
+
+    def __init__(self, sensors, threshold: float = 3.0, min_area: int = 4, **detector):
+        from depth_anomaly import DepthAnomalyDetector, find_anomalies
+        self.find_anomalies = find_anomalies
+        self.detector = DepthAnomalyDetector(threshold=threshold, **detector)
+        self.threshold = threshold
+        self.min_area = min_area
+
+    def __call__(self, frame: Dict) -> Dict:
+        arrays = frame["arrays"]
+        score = self.detector.update(arrays["depth"], arrays.get("confidence"))
+        frame["meta"]["anomalies"] = self.find_anomalies(score, self.detector.height, self.threshold, self.min_area)
+        return frame
+
+
+class FuseStage:
+    """Pairs the thermal frames with the depth frame taken closest to them and samples
+    the depth under each hotspot of the detect stage.
+
+    Runs on the collector threads of its sensors: every frame is pushed (its
+    arrays copied, they are published right after) into a FrameSynchronizer
+    (frame_sync.py) built around the thermal stream, so the pairing, the
+    tolerance, the optional interpolation and the skew and drop statistics are
+    the same as offline. A bundle is only complete once the depth stream has
+    moved past the thermal frame, so it comes out on whichever thread completed
+    it, slightly after the frame itself was published; the fused bundles go to
+    the consumers (the detections log, the map stage) in time order, and
+    close() flushes the last ones at the end of the run.
+    """
+
+    default_sensors = ("thermal", "depth")
+
+    def __init__(self, sensors, calibration: Optional[str] = None, window: int = 3, max_age: float = 0.5,
+                 confidence_value: float = 30, interpolate: bool = False, max_buffer: int = 16):
+        """
+        Args:
+            sensors (list): sensors of the bundles, thermal is the reference
+            calibration (str, optional): calibration file, scaled sensor sizes if None
+            window (int): window of the depth samples, see sample_depth
+            max_age (float): largest time difference in seconds between the paired frames
+            confidence_value (float): lowest valid depth confidence
+            interpolate (bool): interpolate the depth between the frames around the thermal one
+            max_buffer (int): frames kept per sensor while waiting for a match
+        """
+        from depth_hotspot import sample_depth
+        from frame_sync import FrameSynchronizer
+        self.sample_depth = sample_depth
+        self.registration = _registration(calibration, "thermal", "depth")
+        self.window = window
+        self.confidence_value = confidence_value
+        self.sync = FrameSynchronizer(sensors=tuple(sensors), reference="thermal", tolerance=max_age,
+                                      max_buffer=max_buffer, interpolate=interpolate)
+        self.consumers: List[Callable[[Dict], None]] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, frame: Dict) -> Dict:
+        snapshot = {key: frame[key] for key in ("sensor", "timestamp", "t_mono")}
+        snapshot["arrays"] = {key: np.array(value) for key, value in frame["arrays"].items()}
+        snapshot["meta"] = dict(frame["meta"])
+        with self._lock:
+            for bundle in self.sync.push(snapshot):
+                self._fuse(bundle)
+        return frame
+
+    def _fuse(self, bundle: Dict):
+        thermal, depth = bundle["frames"]["thermal"], bundle["frames"].get("depth")
+        bundle["meta"] = {}
+        hotspots = thermal["meta"].get("hotspots")
+        if hotspots is not None and depth is not None:
+            points = self.registration.transform_points(np.stack([hotspots["x"], hotspots["y"]], axis=1))
+            depths, _ = self.sample_depth(depth["arrays"]["depth"], points, depth["arrays"].get("confidence"),
+                                          self.window, self.confidence_value)
+            bundle["meta"]["hotspot_depths"] = depths
+        for consumer in self.consumers:
+            consumer(bundle)
+
+    def close(self):
+        """Fuses the thermal frames still waiting for a match."""
+        with self._lock:
+            for bundle in self.sync.flush():
+                self._fuse(bundle)
+
+    def stats(self) -> Dict:
+        return self.sync.stats
+
+
+class MapStage:
+    """Folds the bundles of the fuse stage before it into a ProbabilityMap (probability_map.py).
+
+    Leaves the frames alone (it sits on the thermal thread only so the run
+    closes it after the fuse stage) and is registered as a consumer of the last
+    fuse stage listed before it. Without odometry the rig is taken to move straight
+    along y at `speed` from `origin`; the ground size of a pixel comes from the
+    along-track footprint of each sensor's frames. The map is exported (.npz or
+    an image) and its spilled tiles removed when the run ends.
+    """
+
+    default_sensors = ("thermal",)
+
+    def __init__(self, sensors, export: Optional[str] = None, speed: float = 0.0, origin=(0.0, 0.0),
+                 footprints: Optional[Dict[str, float]] = None, probability: float = 0.8,
+                 anomaly_probability: float = 0.7, radius: float = 0.1, **field):
+        """
+        Args:
+            sensors (list): unused, the bundles come from the fuse stage
+            export (str, optional): where the map is saved at the end of the run
+            speed (float): ground speed in m/s along y
+            origin (tuple): field position in metres of the first bundle
+            footprints (Dict[str, float], optional): sensor -> along-track frame footprint in m,
+                like the rate section's, thermal 0.4 and depth 0.5 by default
+            probability (float): detection probability of a hotspot
+            anomaly_probability (float): detection probability of a depth anomaly
+            radius (float): radius in metres of the footprint of a detection
+            **field: ProbabilityMap options
+        """
+        from probability_map import ProbabilityMap
+        self.map = ProbabilityMap(**field)
+        self.export = export
+        self.speed = speed
+        self.origin = tuple(origin)
+        self.footprints = footprints or {"thermal": 0.4, "depth": 0.5}
+        self.options = {"probability": probability, "anomaly_probability": anomaly_probability, "radius": radius}
+        self._start = None
+
+    def __call__(self, frame: Dict) -> Dict:
+        return frame
+
+    def fold(self, bundle: Dict):
+        if self._start is None:
+            self._start = bundle["t_mono"]
+        position = (self.origin[0], self.origin[1] + self.speed * (bundle["t_mono"] - self._start))
+        pixel_size = {}
+        for sensor, footprint in self.footprints.items():
+            frame = bundle["frames"].get(sensor)
+            if frame is not None and frame["arrays"]:
+                pixel_size[sensor] = footprint / next(iter(frame["arrays"].values())).shape[0]
+        self.map.fold_bundle(bundle, position, pixel_size, **self.options)
+
+    def close(self):
+        if self.export:
+            directory = os.path.dirname(self.export)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.map.export(self.export)
+        self.map.close()
+
+
+COLLECTOR_STAGES = {
+    "denoise": DenoiseStage,
+    "rgb": RgbStage,
+    "register": RegisterStage,
+    "detect": DetectStage,
+    "anomaly": AnomalyStage,
+    "fuse": FuseStage,
+    "map": MapStage,
+}
+
+
+def build_stages(config: Dict, sensors) -> Dict[str, List[Callable]]:
+    """Collector stages of every sensor, in config order."""
+    stages = {sensor: [] for sensor in sensors}
+    for settings in config["stages"]:
+        settings = dict(settings)
+        name = settings.pop("stage")
+        if name == "render":
+            continue
+        cls = COLLECTOR_STAGES[name]
+        covered = [s for s in settings.pop("sensors", cls.default_sensors) if s in stages]
+        stage = cls(covered, **settings)
+        if isinstance(stage, MapStage):
+            fuse = [s for s in unique_stages(stages) if isinstance(s, FuseStage)]
+            if not fuse:
+                raise ValueError("The map stage folds the bundles of a fuse stage, list one before it")
+            fuse[-1].consumers.append(stage.fold)
+        for sensor in covered:
+            stages[sensor].append(stage)
+    return stages
+
+
+def unique_stages(stages: Dict[str, List[Callable]]) -> List[Callable]:
+    """Every collector stage once, also those shared by several sensors."""
+    seen = {}
+    for sensor_stages in stages.values():
+        for stage in sensor_stages:
+            seen.setdefault(id(stage), stage)
+    return list(seen.values())
+
+
+# ------------------------------------------------------------------------------
+# sources, pools and sinks
+# ------------------------------------------------------------------------------
+
+def build_sources(config: Dict) -> Dict[str, SensorSource]:
+    """The sensors of the config, replayed or read from the hardware."""
+    sensors = [sensor for sensor in SENSORS if sensor in config["sources"]]
+    replay = config["replay"]
+    if replay:
+        if isinstance(replay, str):
+            replay = {"path": replay}
+        return open_replay_sources(replay["path"], rate=replay.get("rate", 1.0), loop=replay.get("loop", False),
+                                   sensors=sensors)
+    hardware = {"thermal": ThermalSource, "depth": TofSource, "rgb": RgbSource}
+    sources = {}
+    for sensor in sensors:
+        options = dict(config["sources"][sensor] or {})
+        for key in ("size", "output_size", "roi"):
+            if options.get(key) is not None:
+                options[key] = tuple(options[key])
+        sources[sensor] = hardware[sensor](**options)
+    return sources
+
+
+def build_sink(config: Dict, metrics):
+    sink = config["sink"]
+    if not sink:
+        return None
+    if sink["type"] == "record":
+        recorder = SessionRecorder(sink["path"], compression="zlib" if sink.get("compress") else None)
+        return SessionSink(recorder, max_pending=sink.get("max_pending", 16), metrics=metrics)
+    if sink["type"] == "npz":
+        directory = sink.get("directory", "data")
+        for sensor in SENSORS:
+            Path(directory, sensor).mkdir(parents=True, exist_ok=True)
+        return AsyncNpzSink(directory, max_pending=sink.get("max_pending", 16), metrics=metrics)
+    raise ValueError(f"Unknown sink type: {sink['type']}, expected record or npz")
+
+
+class RenderPool:
+    """One render stage: a bounded queue feeding its own process pool."""
+
+    def __init__(self, sensors, directory: str, workers: Optional[int] = None, queue: int = 32,
+                 in_flight: Optional[int] = None, publication: bool = False, metrics=None,
+                 on_result: Optional[Callable] = None, start_method: Optional[str] = None,
+                 writer: Optional[Dict] = None):
+        """
+        Args:
+            sensors (list): sensors rendered by this pool
+            directory (str): where the images go
+            workers (int, optional): pool processes, FrameScheduler's default if None
+            queue (int): frames waiting before the collectors are held back
+            in_flight (int, optional): frames in the pool at once, 2x the workers by default
+            publication (bool): render the thermal frames as matplotlib figures
+            metrics (PipelineMetrics, optional): records the scheduling and processing stages
+            on_result (Callable, optional): called with (frame, result) when a frame is done
+            start_method (str, optional): how the pool workers start, see FrameScheduler
+            writer (Dict, optional): configure_writer() settings of the workers
+        """
+        self.sensors = list(sensors)
+        self.queue_size = queue
+        handlers = {}
+        for sensor in self.sensors:
+            handler = SENSOR_HANDLERS[sensor]
+            if sensor == "thermal" and publication:
+                handler = functools.partial(process_thermal_data, publication=True)
+            handlers[sensor] = functools.partial(handler, directory=directory)
+        self.queue = mp.Queue(maxsize=queue)
+        self.scheduler = FrameScheduler(handlers, processes=workers, max_in_flight=in_flight,
+                                        priorities=SENSOR_PRIORITIES, metrics=metrics, on_result=on_result,
+                                        start_method=start_method, preload=["frame_handlers"],
+                                        initializer=functools.partial(configure_writer, **(writer or {})))
+
+    def start(self) -> "RenderPool":
+        self.scheduler.start(self.queue)
+        return self
+
+    def join(self) -> Dict:
+        self.queue.put(None)
+        stats = self.scheduler.join()
+        self.queue.close()
+        return stats
+
+
+class DetectionLog:
+    """Appends the detections of every frame as one JSON line, shared by the collector threads."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def write(self, frame: Dict):
+        record = {"sensor": frame["sensor"], "timestamp": frame["timestamp"], "t_mono": frame["t_mono"]}
+        self._append(record, frame["meta"])
+
+    def write_bundle(self, bundle: Dict):
+        """Appends a fused bundle of the fuse stage, under the thermal frame's timestamp."""
+        thermal = bundle["frames"]["thermal"]
+        record = {"sensor": "fused", "timestamp": thermal["timestamp"], "t_mono": bundle["t_mono"],
+                  "matched": {sensor: frame["timestamp"] for sensor, frame in bundle["frames"].items()
+                              if frame is not None and sensor != "thermal"},
+                  "skew": bundle["skew"]}
+        self._append(record, bundle["meta"])
+
+    def _append(self, record: Dict, meta: Dict):
+        for key, value in meta.items():
+            if isinstance(value, np.ndarray) and value.dtype.names:
+                value = [{name: row[name].tolist() for name in value.dtype.names} for row in value]
+            elif isinstance(value, np.ndarray):
+                value = np.where(np.isnan(value), None, value).tolist() if value.dtype.kind == "f" else value.tolist()
+            record[key] = value
+        line = json.dumps(record)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+def collect(source: SensorSource, stages: List[Callable], queue, transport: FrameTransport,
+            frames: Optional[int], deadline: Optional[float], delay: float, metrics=NULL_METRICS,
+            log: Optional[DetectionLog] = None, controller: Optional[RateController] = None, preview=None) -> int:
+    """Reads, processes and publishes the frames of one sensor until a limit is reached.
+
+    Args:
+        source (SensorSource): sensor or replay
+        stages (List[Callable]): collector stages, in order
+        queue (MP.Queue, optional): queue of the sensor's render pool, None if it is not rendered
+        transport (FrameTransport): shared memory rings of the sensors
+        frames (int, optional): frames to collect, no limit if None
+        deadline (float, optional): time.monotonic() at which to stop, no limit if None
+        delay (float): seconds between frames
+        metrics (PipelineMetrics): records the capture, publish and enqueue stages
+        log (DetectionLog, optional): where the detections of the frames go
+        controller (RateController, optional): paces the captures instead of the fixed delay
+        preview (PreviewServer, optional): live preview the processed frames are offered to
+
+    Returns:
+        int: frames collected
+    """
+    try:
+        source.open()
+    except RuntimeError as e:
+        print(e)
+        return 0
+
+    count = 0
+    try:
+        while (frames is None or count < frames) and (deadline is None or time.monotonic() < deadline):
+            frame = read_frame(source, metrics)
+            if frame is None:
+                break
+            frame["meta"] = {}
+            for stage in stages:
+                frame = stage(frame)
+            if log is not None and frame["meta"]:
+                log.write(frame)
+            if preview is not None:
+                preview.update(frame)
+            if queue is not None:
+                publish_frame(frame, queue, transport, metrics)
+            elif transport.sink is not None:
+                # not rendered, only persisted
+                release_frame(transport.publish(frame))
+            count += 1
+            if controller is not None:
+                controller.wait(frame["sensor"])
+            elif delay:
+                time.sleep(delay)
+    except KeyboardInterrupt:
+        print(f"{source.sensor} collection stopped from KeyboardInterrupt")
+    finally:
+        source.close()
+    return count
+
+
+def run_pipeline(config: Dict) -> Dict:
+    """Runs the pipeline described by a config until its frame or time limit.
+
+    Returns:
+        Dict: frames collected per sensor, per pool scheduler stats, elapsed time
+    """
+    run = config["run"]
+    sources = build_sources(config)
+    stages = build_stages(config, sources)
+    delay = run["delay"] if run["delay"] is not None else (0 if config["replay"] else 1)
+
+    metrics_config = config["metrics"] or {}
+    metrics = PipelineMetrics() if metrics_config else NULL_METRICS
+    dashboard = MetricsDashboard(metrics, metrics_config["dashboard"]).start() \
+        if metrics_config.get("dashboard") else None
+
+    sink = build_sink(config, metrics)
+    transport = FrameTransport(slots=config["transport"].get("slots", 8), sink=sink,
+                               timeout=config["transport"].get("timeout"))
+    log = DetectionLog(config["detections"]) if config["detections"] else None
+    fuse_stages = [stage for stage in unique_stages(stages) if isinstance(stage, FuseStage)]
+    if log is not None:
+        for stage in fuse_stages:
+            stage.consumers.append(log.write_bundle)
+
+    Path(config["images"]).mkdir(parents=True, exist_ok=True)
+
+    preview = None
+    if config["preview"]:
+        from preview_server import PreviewServer
+        preview = PreviewServer(**config["preview"]).start()
+        print(f"Preview on {preview.url}")
+
+    # adaptive capture rates, fed back from the render pools
+    controller = None
+    if config["rate"]:
+        settings = dict(config["rate"])
+        speed = settings.pop("speed", None)
+        settings.setdefault("start_rate", 1.0 / delay if delay > 0 else settings.get("max_rate", 30.0))
+        # the queues are added as the render pools are created
+        controller = RateController(sources, queues={}, queue_size={}, metrics=metrics, **settings)
+        controller.set_speed(speed)
+
+    # one pool per render stage, started before acquisition so both run at the same time
+    pools, routes = [], {}
+    for settings in config["stages"]:
+        if settings["stage"] != "render":
+            continue
+        settings = dict(settings)
+        del settings["stage"]
+        sensors = [s for s in settings.pop("sensors", SENSORS) if s in sources and s not in routes]
+        if not sensors:
+            continue
+        pool = RenderPool(sensors, config["images"], metrics=metrics,
+                          on_result=controller.on_result if controller else None,
+                          start_method=run.get("start_method"), writer=config["writer"], **settings).start()
+        pools.append(pool)
+        for sensor in sensors:
+            routes[sensor] = pool.queue
+            if controller is not None:
+                controller.queues[sensor] = pool.queue
+                controller.queue_size[sensor] = pool.queue_size
+
+    started = time.monotonic()
+    deadline = started + run["duration"] if run["duration"] else None
+    counts = {}
+    def collector(sensor):
+        counts[sensor] = collect(sources[sensor], stages[sensor], routes.get(sensor), transport,
+                                 run["frames"], deadline, delay, metrics, log, controller, preview)
+    threads = [threading.Thread(target=collector, args=(sensor,), daemon=True) for sensor in sources]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    acquisition = time.monotonic() - started
+    for stage in unique_stages(stages):
+        if hasattr(stage, "close"):
+            stage.close()
+
+    pool_stats = [dict(pool.join(), sensors=pool.sensors) for pool in pools]
+    transport.close()
+    if log is not None:
+        log.close()
+    if preview is not None:
+        preview.stop()
+
+    results = {
+        "frames": counts,
+        "pools": pool_stats,
+        "acquisition": acquisition,
+        "elapsed": time.monotonic() - started,
+        "raw_saved": sink.written if sink is not None else 0,
+        "raw_dropped": sink.dropped if sink is not None else 0,
+        "rates": controller.stats() if controller is not None else None,
+        "preview": preview.stats() if preview is not None else None,
+        "sync": [stage.stats() for stage in fuse_stages],
+    }
+    if metrics.enabled:
+        metrics.stop()
+        if dashboard is not None:
+            dashboard.stop()
+        results["metrics"] = metrics
+        if metrics_config.get("file"):
+            metrics.export(metrics_config["file"])
+    return results
+
+
+def print_results(results: Dict):
+    print("------- Pipeline Results -------")
+    print(f"Total time: {results['elapsed']:.2f}s (acquisition {results['acquisition']:.2f}s)")
+    print("Frames collected: " + ", ".join(f"{sensor} {n}" for sensor, n in results["frames"].items()))
+    for stats in results["pools"]:
+        print(f"Render pool {'/'.join(stats['sensors'])}: {stats['completed']} frames "
+              f"(failed {stats['failed']}, max in flight {stats['max_in_flight']})")
+    if results["rates"]:
+        print("Capture rates: " + ", ".join(f"{sensor} {stats['rate']:.2f} Hz"
+                                            for sensor, stats in results["rates"].items()))
+    for stats in results["sync"]:
+        skews = ", ".join(f"{sensor} {stats['mean_skew'][sensor] * 1000:.0f} ms (max {stats['max_skew'][sensor] * 1000:.0f})"
+                          for sensor in stats["mean_skew"])
+        print(f"Fused bundles: {stats['bundles']} (dropped {stats['dropped_bundles']}), skew {skews}")
+    if results["preview"]:
+        print(f"Preview: {results['preview']['encoded']} frames encoded, {results['preview']['sent']} sent")
+    if results["raw_saved"] or results["raw_dropped"]:
+        print(f"Raw Frames Saved: {results['raw_saved']} (dropped {results['raw_dropped']})")
+    if "metrics" in results:
+        print("------- Pipeline Metrics (ms) -------")
+        print(results["metrics"].format_table())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the capture and processing pipeline described by a config file")
+    parser.add_argument("config", nargs="?", help="JSON pipeline config (defaults if not given)")
+    parser.add_argument("--replay", metavar="PATH", help="replay a recorded session instead of the sensors")
+    parser.add_argument("--rate", type=float, default=None, help="replay rate, 0 is as fast as possible")
+    parser.add_argument("--frames", type=int, help="frames per sensor, overrides the config")
+    parser.add_argument("--duration", type=float, help="seconds to run, overrides the config")
+    parser.add_argument("--delay", type=float, help="seconds between frames, overrides the config (0 when replaying)")
+    parser.add_argument("--preview", type=int, nargs="?", const=8080, metavar="PORT",
+                        help="stream a live preview on this port (8080 if not given)")
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    run = {key: value for key, value in (("frames", args.frames), ("duration", args.duration), ("delay", args.delay))
+           if value is not None}
+    if args.replay:
+        overrides["replay"] = {"path": args.replay, "rate": 1.0 if args.rate is None else args.rate}
+        run.setdefault("delay", 0)  # the replay paces the frames itself
+    if args.duration is not None and args.frames is None:
+        run["frames"] = None  # run for the duration only
+    if run:
+        overrides["run"] = run
+    if args.preview is not None:
+        overrides["preview"] = {"port": args.preview}
+    config = load_config(args.config, overrides)
+
+    print_results(run_pipeline(config))
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+"""
+Live preview of the pipeline as an MJPEG stream over HTTP.
+
+The collectors hand every frame to the preview after their stages ran, the
+preview overlays the latest thermal frame on the latest depth frame (through
+the thermal -> depth registration), draws the hotspot and anomaly boxes the
+stages found and puts the rgb frame next to it:
+
+    preview = PreviewServer(port=8080).start()
+    ...
+    preview.update(frame)        # on the collector threads
+    ...
+    preview.stop()
+
+and a browser on the same network shows http://<pi>:8080/ (the bare stream is
+/stream.mjpg, one JPEG is /frame.jpg).
+
+The capture never waits for a viewer. update() keeps only the newest frame
+of each sensor, and only while someone is watching (a copy, the sources reuse
+their buffers); otherwise it returns straight away. One composer thread builds
+and encodes the overlay at most `max_fps` times a second, whatever the number
+of viewers, and every connection sends that same JPEG. A viewer on a slow link
+skips the frames it had no time for instead of queueing them.
+"""
+import argparse
+import contextlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from image_writer import encode_params
+from process_depth_data import DepthColorizer
+from registration import Calibration, Registration, SENSOR_SIZES
+from sensor_sources import SensorSource
+from thermal_render import colormap_lut
+
+PAGE = b"""<!DOCTYPE html>
+<html><head><title>Pipeline preview</title></head>
+<body style="margin:0;background:#000"><img src="/stream.mjpg" style="max-width:100%"></body></html>
+"""
+
+HOTSPOT_COLOR = (255, 255, 255)
+BUMP_COLOR = (255, 255, 0)
+HOLLOW_COLOR = (255, 0, 255)
+TEXT_COLOR = (255, 255, 255)
+
+
+class LatestFrame:
+    """A single slot holding the newest value, readers wait for one newer than the one they have."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._value = None
+        self.sequence = 0
+
+    def put(self, value: Any):
+        """Replaces the value, never blocks on the readers."""
+        with self._condition:
+            self._value = value
+            self.sequence += 1
+            self._condition.notify_all()
+
+    def get(self, after: int = 0, timeout: Optional[float] = None) -> Optional[Tuple[int, Any]]:
+        """Waits for a value newer than sequence `after`.
+
+        Returns:
+            Tuple[int, Any]: (sequence, value) of the newest value, None on timeout
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.sequence > after, timeout):
+                return None
+            return self.sequence, self._value
+
+
+class PreviewComposer:
+    """Draws the preview image from the latest frame of every sensor."""
+
+    def __init__(self, registration: Optional[Registration] = None, scale: int = 3, blend: float = 0.5):
+        """
+        Args:
+            registration (Registration, optional): thermal -> depth pixels, plain scaling if None
+            scale (int): upscaling of the depth grid in the preview
+            blend (float): weight of the thermal colours over the depth colours
+        """
+        self.registration = registration or Registration.scaling(SENSOR_SIZES["thermal"], SENSOR_SIZES["depth"])
+        self.scale = scale
+        self.blend = blend
+        self.colorizer = DepthColorizer()
+        self.lut = colormap_lut("plasma")
+
+        width, height = self.registration.dst_size
+        self.size = (width * scale, height * scale)
+        self._base = np.zeros((height, width, 3), dtype=np.uint8)
+        self._heat = np.empty((height, width, 3), dtype=np.uint8)
+        self._index = np.empty((height, width), dtype=np.uint8)
+        self._field = None  # depth pixels the thermal camera sees
+        self._errors = set()
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    def _thermal(self, temperature: np.ndarray) -> np.ndarray:
+        warped = self.registration.warp(np.asarray(temperature, dtype=np.float32))
+        if self._field is None:
+            self._field = self.registration.warp(np.ones(temperature.shape, dtype=np.float32)) > 0.5
+        low, high = float(temperature.min()), float(temperature.max())
+        alpha = 255.0 / max(high - low, 1e-3)
+        cv2.convertScaleAbs(warped, self._index, alpha, -low * alpha)
+        cv2.applyColorMap(self._index, self.lut, self._heat)
+        return self._heat
+
+    def compose(self, frames: Dict[str, Dict]) -> np.ndarray:
+        """Builds the preview from the latest frames.
+
+        Args:
+            frames (Dict[str, Dict]): sensor -> latest frame, see PreviewServer.update
+
+        Returns:
+            np.ndarray: BGR preview image
+        """
+        # raw frames make the overlay, images (rgb, rendered thermal / depth) go next to it
+        depth, thermal = frames.get("depth"), frames.get("thermal")
+        depth = depth if depth is not None and "depth" in depth["arrays"] else None
+        thermal = thermal if thermal is not None and "temperature" in thermal["arrays"] else None
+        base = self._base
+        base[:] = 0
+        if depth is not None:
+            try:
+                self.colorizer.colorize(depth["arrays"]["depth"], depth["arrays"]["confidence"], out=base)
+            except Exception as e:
+                self._failed("depth", e)
+                depth = None
+                base[:] = 0
+        if thermal is not None:
+            try:
+                heat = self._thermal(thermal["arrays"]["temperature"])
+                if depth is not None:
+                    blended = cv2.addWeighted(base, 1.0 - self.blend, heat, self.blend, 0)
+                    np.copyto(base, blended, where=self._field[..., None])
+                else:
+                    np.copyto(base, heat)
+            except Exception as e:
+                self._failed("thermal", e)
+                thermal = None
+        panel = cv2.resize(base, self.size, interpolation=cv2.INTER_NEAREST)
+
+        for frame, draw in ((thermal, self._draw_hotspots), (depth, self._draw_anomalies)):
+            if frame is not None:
+                try:
+                    draw(panel, frame["meta"])
+                except Exception as e:
+                    self._failed(frame["sensor"], e)
+        stamps = "  ".join(f"{sensor} {frame['timestamp']}" for sensor, frame in sorted(frames.items()))
+        cv2.putText(panel, stamps, (6, self.height - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.4, TEXT_COLOR, 1, cv2.LINE_AA)
+
+        panels = [panel]
+        for sensor in sorted(frames, key=lambda name: name == "rgb"):
+            arrays = frames[sensor]["arrays"]
+            image = arrays.get("image", arrays.get("rgb"))
+            if image is not None and image.shape[0] == panel.shape[0] and image.ndim == 3:
+                panels.append(image)
+        return cv2.hconcat(panels) if len(panels) > 1 else panel
+
+    def _failed(self, sensor: str, error: Exception):
+        # one bad stream leaves its part of the preview empty, reported once per error
+        message = f"Preview of {sensor} failed: {error!r}"
+        if message not in self._errors:
+            self._errors.add(message)
+            print(message)
+
+    def _draw_hotspots(self, panel: np.ndarray, meta: Dict):
+        hotspots = meta.get("hotspots")
+        if hotspots is None or len(hotspots) == 0:
+            return
+        ids = meta.get("track_ids")
+        # bounding box corners from thermal to depth pixels, then to the preview
+        x, y, w, h = hotspots["bbox"].T
+        corners = self.registration.transform_points(np.stack([np.stack([x, y], 1), np.stack([x + w, y + h], 1)], 1))
+        corners = (corners.reshape(-1, 2, 2) * self.scale).round().astype(int)
+        for i, ((x0, y0), (x1, y1)) in enumerate(corners):
+            cv2.rectangle(panel, (x0, y0), (x1, y1), HOTSPOT_COLOR, 1)
+            label = f"{hotspots['peak'][i]:.1f}C"
+            if ids is not None and ids[i] >= 0:
+                label = f"#{ids[i]} {label}"
+            cv2.putText(panel, label, (x0, max(y0 - 4, 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.4, HOTSPOT_COLOR, 1,
+                        cv2.LINE_AA)
+
+    def _draw_anomalies(self, panel: np.ndarray, meta: Dict):
+        anomalies = meta.get("anomalies")
+        if anomalies is None:
+            return
+        for anomaly in anomalies:
+            x, y, w, h = (anomaly["bbox"] * self.scale).tolist()
+            color = BUMP_COLOR if anomaly["score"] > 0 else HOLLOW_COLOR
+            cv2.rectangle(panel, (x, y), (x + w, y + h), color, 1)
+
+
+class _PreviewHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path in ("/", "/index.html"):
+            self._send(PAGE, "text/html")
+        elif path == "/frame.jpg":
+            self.server.preview.send_frame(self)
+        elif path == "/stream.mjpg":
+            self.server.preview.send_stream(self)
+        else:
+            self.send_error(404)
+
+    def _send(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per request would flood the pipeline output
+
+
+class PreviewServer:
+    """Serves the latest composed frame as MJPEG, see the module docstring."""
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 8080, max_fps: float = 10.0, quality: int = 70,
+                 calibration: Optional[str] = None, scale: int = 3, blend: float = 0.5):
+        """
+        Args:
+            host (str): address to listen on, 0.0.0.0 for every interface
+            port (int): port to listen on, 0 picks a free one (see .port)
+            max_fps (float): highest rate the preview is composed and encoded at
+            quality (int): JPEG quality
+            calibration (str, optional): calibration.npz with the thermal -> depth registration
+            scale (int): upscaling of the depth grid in the preview
+            blend (float): weight of the thermal colours over the depth colours
+        """
+        registration = Calibration.load(calibration)["thermal", "depth"] if calibration else None
+        self.composer = PreviewComposer(registration, scale, blend)
+        self.host = host
+        self.port = port
+        self.interval = 1.0 / max_fps
+        self.params = encode_params("jpeg", quality)
+        self.latest = LatestFrame()
+
+        self.updates = 0   # frames handed to update()
+        self.kept = 0      # of which kept for a viewer
+        self.encoded = 0   # previews composed and encoded
+        self.sent = 0      # JPEGs written to the viewers
+
+        self._frames = {}
+        self._viewers = 0
+        self._lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._server = None
+        self._threads = []
+
+    @property
+    def url(self) -> str:
+        host = "localhost" if self.host in ("", "0.0.0.0") else self.host
+        return f"http://{host}:{self.port}/"
+
+    @property
+    def viewers(self) -> int:
+        return self._viewers
+
+    def start(self) -> "PreviewServer":
+        self._server = ThreadingHTTPServer((self.host, self.port), _PreviewHandler)
+        self._server.daemon_threads = True
+        self._server.preview = self
+        self.port = self._server.server_address[1]
+        self._threads = [threading.Thread(target=self._server.serve_forever, daemon=True),
+                         threading.Thread(target=self._compose, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._dirty.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+
+    def update(self, frame: Dict):
+        """Offers the preview a frame, called on the collector threads after the stages ran.
+
+        Nothing is kept while no one is watching. Otherwise the frame replaces the
+        sensor's previous one: temperatures and depth are copied, rgb and rendered
+        images (the "image" of replayed archives) are scaled to the preview height
+        (which copies them too) and shown next to the overlay.
+        """
+        self.updates += 1
+        if not self._viewers:
+            return
+        arrays = frame["arrays"]
+        if "temperature" in arrays:
+            kept = {"temperature": np.array(arrays["temperature"])}
+        elif "depth" in arrays and "confidence" in arrays:
+            kept = {"depth": np.array(arrays["depth"]), "confidence": np.array(arrays["confidence"])}
+        elif "rgb" in arrays or "image" in arrays:
+            image = arrays.get("rgb", arrays.get("image"))
+            if image.ndim == 2:
+                image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+            elif image.shape[-1] == 4:
+                image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+            height = self.composer.height
+            width = max(1, round(image.shape[1] * height / image.shape[0]))
+            key = "rgb" if "rgb" in arrays else "image"
+            kept = {key: cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)}
+        else:
+            return
+        frame = {"sensor": frame["sensor"], "timestamp": frame["timestamp"], "arrays": kept,
+                 "meta": dict(frame.get("meta") or {})}
+        with self._lock:
+            self._frames[frame["sensor"]] = frame
+            self.kept += 1
+        self._dirty.set()
+
+    def _compose(self):
+        while not self._stop.is_set():
+            self._dirty.wait()
+            if self._stop.is_set():
+                break
+            self._dirty.clear()
+            started = time.monotonic()
+            with self._lock:
+                frames = dict(self._frames)
+            try:
+                ok, jpeg = cv2.imencode(".jpg", self.composer.compose(frames), self.params)
+            except Exception as e:
+                print(f"Preview failed: {e}")
+                ok = False
+            if ok:
+                self.latest.put(jpeg.tobytes())
+                self.encoded += 1
+            # frames arriving meanwhile are folded into the next preview
+            self._stop.wait(max(self.interval - (time.monotonic() - started), 0.0))
+
+    @contextlib.contextmanager
+    def _watching(self):
+        with self._lock:
+            self._viewers += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._viewers -= 1
+                if not self._viewers:
+                    self._frames.clear()
+
+    def send_frame(self, handler: BaseHTTPRequestHandler, timeout: float = 5.0):
+        """Answers a request with the next preview as a single JPEG."""
+        with self._watching():
+            latest = self.latest.get(self.latest.sequence, timeout) or self.latest.get(0, 0)
+        if latest is None:
+            handler.send_error(503, "No frames yet")
+            return
+        handler._send(latest[1], "image/jpeg")
+        self.sent += 1
+
+    def send_stream(self, handler: BaseHTTPRequestHandler):
+        """Answers a request with the multipart MJPEG stream until the viewer leaves."""
+        handler.send_response(200)
+        handler.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+        handler.send_header("Cache-Control", "no-cache, private")
+        handler.end_headers()
+        sequence = 0
+        with self._watching():
+            try:
+                while not self._stop.is_set():
+                    latest = self.latest.get(sequence, timeout=1.0)
+                    if latest is None:
+                        continue
+                    sequence, jpeg = latest
+                    handler.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\n"
+                                        b"Content-Length: %d\r\n\r\n" % len(jpeg))
+                    handler.wfile.write(jpeg)
+                    handler.wfile.write(b"\r\n")
+                    self.sent += 1
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the viewer closed the page
+
+    def stats(self) -> Dict:
+        return {"updates": self.updates, "kept": self.kept, "encoded": self.encoded, "sent": self.sent,
+                "viewers": self._viewers}
+
+
+class PreviewSource(SensorSource):
+    """Hands the frames of another source to a preview as they are read."""
+
+    def __init__(self, source: SensorSource, preview: PreviewServer):
+        self.source = source
+        self.sensor = source.sensor
+        self.preview = preview
+
+    def open(self):
+        self.source.open()
+
+    def read(self) -> Optional[Dict]:
+        frame = self.source.read()
+        if frame is not None:
+            self.preview.update(frame)
+        return frame
+
+    def close(self):
+        self.source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preview a recorded session in the browser")
+    parser.add_argument("path", help="recorded session, data directory or tar archive")
+    parser.add_argument("--port", type=int, default=8080, help="HTTP port (default 8080)")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on (default: every interface)")
+    parser.add_argument("--rate", type=float, default=1.0, help="replay rate, 1 is real time")
+    parser.add_argument("--max-fps", type=float, default=10.0, help="highest preview frame rate")
+    parser.add_argument("--calibration", help="calibration.npz with the thermal -> depth registration")
+    args = parser.parse_args()
+
+    from sensor_sources import open_replay_sources
+
+    preview = PreviewServer(args.host, args.port, args.max_fps, calibration=args.calibration).start()
+    print(f"Preview on {preview.url}")
+    # archives of rendered images are shown as they are
+    sources = open_replay_sources(args.path, rate=args.rate, loop=True, images=True)
+
+    def replay(source):
+        with source:
+            for frame in source:
+                frame.setdefault("meta", {})
+                preview.update(frame)
+
+    threads = [threading.Thread(target=replay, args=(source,), daemon=True) for source in sources.values()]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    preview.stop()
+
+
+if __name__ == "__main__":
+    main()
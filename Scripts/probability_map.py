@@ -0,0 +1,258 @@
+"""
+Probability map of points of interest over the surveyed field.
+
+The map is a grid of log-odds values split into square tiles. Tiles live in
+a preallocated pool and are only created where the rig has looked; when the
+pool is full the least recently updated tile is spilled to disk and loaded
+back if the rig comes back to it, so memory stays the same however long the
+survey runs.
+
+    with ProbabilityMap(cell_size=0.05) as field:
+        field.update_frame(anomaly_probability, origin=(x, y), pixel_size=0.004)
+        field.update_points(hotspot_xy, probability=0.8, radius=0.1)
+        field.fold_bundle(bundle, position=(x, y), pixel_size={"thermal": 0.0125, "depth": 0.0028})
+        probability, origin = field.snapshot()
+        field.export("field.npz")
+
+Spilled tiles go to a temporary directory unless `spill_dir` is given; close()
+(or leaving the with block) removes it.
+
+Coordinates are in metres in the field frame, x to the right and y along the
+direction of travel. Frames are assumed to be axis aligned with the field.
+"""
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+def logit(p):
+    p = np.clip(p, 1e-4, 1 - 1e-4)
+    return np.log(p / (1 - p))
+
+
+def probability(log_odds):
+    return 1.0 / (1.0 + np.exp(-log_odds))
+
+
+class ProbabilityMap:
+    """Tiled log-odds occupancy grid of points of interest."""
+
+    def __init__(self, cell_size: float = 0.05, tile_cells: int = 64, max_tiles: int = 256,
+                 prior: float = 0.01, clamp: float = 10.0, spill_dir: Optional[str] = None):
+        """
+        Args:
+            cell_size (float): cell edge in metres
+            tile_cells (int): cells per tile edge
+            max_tiles (int): tiles kept in memory, older tiles are spilled to disk
+            prior (float): probability of a point of interest before any observation
+            clamp (float): log-odds are kept within +/- clamp so the map can still change its mind
+            spill_dir (str, optional): directory for spilled tiles, a temporary one if None
+        """
+        self.cell_size = cell_size
+        self.tile_cells = tile_cells
+        self.max_tiles = max_tiles
+        self.prior = logit(prior)
+        self.clamp = clamp
+        self.spill_dir = spill_dir
+        self._own_spill_dir = False
+
+        self._pool = np.full((max_tiles, tile_cells, tile_cells), self.prior, dtype=np.float32)
+        self._free = list(range(max_tiles - 1, -1, -1))
+        self._tiles: "OrderedDict[Tuple[int, int], int]" = OrderedDict()  # tile -> pool index, LRU order
+        self._spilled = set()
+        self.updates = 0
+
+    # --------------------------------------------------------------------------
+    # tile storage
+    # --------------------------------------------------------------------------
+
+    def _spill_path(self, key: Tuple[int, int]) -> str:
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="probability_map_")
+            self._own_spill_dir = True
+        return os.path.join(self.spill_dir, f"tile_{key[0]}_{key[1]}.npy")
+
+    def _tile(self, key: Tuple[int, int]) -> np.ndarray:
+        """Returns the in-memory tile, creating or reloading it as needed."""
+        index = self._tiles.get(key)
+        if index is not None:
+            self._tiles.move_to_end(key)
+            return self._pool[index]
+
+        if not self._free:
+            # spill the least recently updated tile
+            old_key, old_index = self._tiles.popitem(last=False)
+            np.save(self._spill_path(old_key), self._pool[old_index])
+            self._spilled.add(old_key)
+            self._free.append(old_index)
+
+        index = self._free.pop()
+        if key in self._spilled:
+            self._pool[index] = np.load(self._spill_path(key))
+            self._spilled.discard(key)
+        else:
+            self._pool[index] = self.prior
+        self._tiles[key] = index
+        return self._pool[index]
+
+    def _read_tile(self, key: Tuple[int, int]) -> np.ndarray:
+        """Reads a tile without changing what is kept in memory."""
+        if key in self._tiles:
+            return self._pool[self._tiles[key]]
+        return np.load(self._spill_path(key))
+
+    def tiles(self):
+        """Keys of every tile that has been observed."""
+        return set(self._tiles) | self._spilled
+
+    # --------------------------------------------------------------------------
+    # updates
+    # --------------------------------------------------------------------------
+
+    def _add(self, cell_x: int, cell_y: int, log_odds: np.ndarray):
+        """Adds a block of log-odds whose top left cell is (cell_x, cell_y)."""
+        rows, cols = log_odds.shape
+        t = self.tile_cells
+        for ty in range(cell_y // t, (cell_y + rows - 1) // t + 1):
+            for tx in range(cell_x // t, (cell_x + cols - 1) // t + 1):
+                # overlap of the block with this tile, in tile and block coordinates
+                y0, y1 = max(cell_y, ty * t), min(cell_y + rows, (ty + 1) * t)
+                x0, x1 = max(cell_x, tx * t), min(cell_x + cols, (tx + 1) * t)
+                tile = self._tile((tx, ty))
+                view = tile[y0 - ty * t:y1 - ty * t, x0 - tx * t:x1 - tx * t]
+                view += log_odds[y0 - cell_y:y1 - cell_y, x0 - cell_x:x1 - cell_x]
+                np.clip(view, -self.clamp, self.clamp, out=view)
+        self.updates += 1
+
+    def update_frame(self, evidence: np.ndarray, origin: Tuple[float, float], pixel_size: float):
+        """Folds a per-pixel probability image of one frame into the map.
+
+        Args:
+            evidence (np.ndarray): (H, W) probability that each pixel shows a point of interest
+            origin (Tuple[float, float]): field position in metres of the frame's top left corner
+            pixel_size (float): ground size of a pixel in metres
+        """
+        height, width = evidence.shape
+        cols = max(1, int(round(width * pixel_size / self.cell_size)))
+        rows = max(1, int(round(height * pixel_size / self.cell_size)))
+        cells = cv2.resize(evidence.astype(np.float32), (cols, rows), interpolation=cv2.INTER_AREA)
+        log_odds = logit(cells).astype(np.float32) - self.prior
+        self._add(int(np.floor(origin[0] / self.cell_size)), int(np.floor(origin[1] / self.cell_size)), log_odds)
+
+    def update_points(self, points: np.ndarray, probability: float = 0.8, radius: float = 0.1):
+        """Folds point detections (e.g. hotspots) into the map.
+
+        Args:
+            points (np.ndarray): (N, 2) field positions in metres
+            probability (float): detection probability at the centre of each point
+            radius (float): radius in metres of the Gaussian footprint of a detection
+        """
+        sigma = max(radius / self.cell_size, 0.5)
+        half = int(np.ceil(2 * sigma))
+        grid = np.arange(-half, half + 1, dtype=np.float32)
+        footprint = np.exp(-(grid[None, :] ** 2 + grid[:, None] ** 2) / (2 * sigma ** 2))
+        # blend from the prior at the edge to the detection probability in the centre
+        log_odds = (footprint * (logit(probability) - self.prior)).astype(np.float32)
+
+        for x, y in np.asarray(points, dtype=np.float64).reshape(-1, 2):
+            cx = int(np.floor(x / self.cell_size))
+            cy = int(np.floor(y / self.cell_size))
+            self._add(cx - half, cy - half, log_odds)
+
+    def fold_hotspots(self, hotspots: np.ndarray, origin: Tuple[float, float], pixel_size: float,
+                      probability: float = 0.8, radius: float = 0.1):
+        """Folds the hotspots of a frame (HOTSPOT_DTYPE rows) into the map.
+
+        Args:
+            hotspots (np.ndarray): detections from detect_hotspots_array()
+            origin (Tuple[float, float]): field position in metres of the frame's top left corner
+            pixel_size (float): ground size of a thermal pixel in metres
+        """
+        if len(hotspots) == 0:
+            return
+        points = np.stack([origin[0] + (hotspots["x"] + 0.5) * pixel_size,
+                           origin[1] + (hotspots["y"] + 0.5) * pixel_size], axis=1)
+        self.update_points(points, probability, radius)
+
+    def fold_bundle(self, bundle: Dict, position: Tuple[float, float], pixel_size: Dict[str, float],
+                    probability: float = 0.8, anomaly_probability: float = 0.7, radius: float = 0.1):
+        """Folds a fused bundle (see frame_sync.FrameSynchronizer) into the map.
+
+        The hotspots of the thermal frame and the anomalies of the depth frame
+        (the "hotspots" and "anomalies" of each frame's "meta") are folded in as
+        points; the frames of a bundle are taken as centred on the same spot.
+
+        Args:
+            bundle (Dict): bundle of the fuse stage, {"frames": {sensor: frame}, ...}
+            position (Tuple[float, float]): field position in metres of the centre of the frames
+            pixel_size (Dict[str, float]): sensor -> ground size of a pixel in metres, other sensors are skipped
+            probability (float): detection probability of a hotspot
+            anomaly_probability (float): detection probability of a depth anomaly
+            radius (float): radius in metres of the footprint of a detection
+        """
+        for sensor, key, p in (("thermal", "hotspots", probability), ("depth", "anomalies", anomaly_probability)):
+            frame = bundle["frames"].get(sensor)
+            if frame is None or sensor not in pixel_size:
+                continue
+            detections = frame.get("meta", {}).get(key)
+            if detections is None or len(detections) == 0:
+                continue
+            height, width = next(iter(frame["arrays"].values())).shape[:2]
+            size = pixel_size[sensor]
+            points = np.stack([position[0] + (detections["x"] + 0.5 - width / 2) * size,
+                               position[1] + (detections["y"] + 0.5 - height / 2) * size], axis=1)
+            self.update_points(points, p, radius)
+
+    # --------------------------------------------------------------------------
+    # snapshots
+    # --------------------------------------------------------------------------
+
+    def snapshot(self, as_probability: bool = True) -> Tuple[np.ndarray, Tuple[float, float]]:
+        """Assembles the observed part of the field into one array.
+
+        Returns:
+            Tuple[np.ndarray, Tuple[float, float]]: the grid and the field position in
+                metres of its top left cell
+        """
+        keys = self.tiles()
+        t = self.tile_cells
+        if not keys:
+            return np.zeros((0, 0), dtype=np.float32), (0.0, 0.0)
+        xs = [k[0] for k in keys]
+        ys = [k[1] for k in keys]
+        min_x, min_y = min(xs), min(ys)
+        grid = np.full(((max(ys) - min_y + 1) * t, (max(xs) - min_x + 1) * t), self.prior, dtype=np.float32)
+        for tx, ty in keys:
+            grid[(ty - min_y) * t:(ty - min_y + 1) * t, (tx - min_x) * t:(tx - min_x + 1) * t] = self._read_tile((tx, ty))
+        origin = (min_x * t * self.cell_size, min_y * t * self.cell_size)
+        return (probability(grid).astype(np.float32) if as_probability else grid), origin
+
+    def export(self, path: str):
+        """Saves the map as .npz (log-odds grid and georeference) or as an image (.png/.jpg)."""
+        grid, origin = self.snapshot(as_probability=False)
+        if path.endswith(".npz"):
+            np.savez_compressed(path, log_odds=grid, origin=np.array(origin), cell_size=self.cell_size)
+        else:
+            image = cv2.applyColorMap((probability(grid) * 255).astype(np.uint8), cv2.COLORMAP_INFERNO)
+            cv2.imwrite(path, image)
+
+    def close(self):
+        """Removes the temporary directory of the spilled tiles, the map is empty afterwards."""
+        if self._own_spill_dir and self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self._own_spill_dir = False
+        self._tiles.clear()
+        self._spilled.clear()
+        self._free = list(range(self.max_tiles - 1, -1, -1))
+
+    def __enter__(self) -> "ProbabilityMap":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,12 +1,123 @@
+import argparse
 import cv2
 import numpy as np
 import os
+from typing import List, Optional
 
+from image_writer import ImageWriter
 
-def getPreviewRGB(preview: np.ndarray, confidence: np.ndarray, confidence_value: int = 30) -> np.ndarray:
-    preview = np.nan_to_num(preview)
-    preview[confidence < confidence_value] = (0, 0, 0)
-    return preview
+
+# Range value in the same units as the depth data; adjust as needed for your camera setup
+DEPTH_RANGE = 1000
+# pixels below this confidence are drawn black
+CONFIDENCE_VALUE = 30
+
+
+def depth_lut(colormap: int = cv2.COLORMAP_RAINBOW) -> np.ndarray:
+    """Returns the shared 256 entry BGR table used to colour depth frames.
+
+    Entry 0 is black and marks masked (no depth or low confidence) pixels, depths are
+    spread over entries 1-255 of the colormap.
+    """
+    lut = cv2.applyColorMap(np.linspace(0, 255, 255).astype(np.uint8).reshape(255, 1), colormap)
+    return np.concatenate([np.zeros((1, 3), dtype=np.uint8), lut.reshape(255, 3)])
+
+
+class DepthColorizer:
+    """Colours stacks of depth frames in one vectorized pass.
+
+    The LUT and the work buffers are kept between calls, so rendering the
+    frames of a capture session allocates nothing once the first batch has
+    been seen.
+    """
+
+    def __init__(self, max_range: float = DEPTH_RANGE, confidence_value: float = CONFIDENCE_VALUE,
+                 colormap: int = cv2.COLORMAP_RAINBOW):
+        """
+        Args:
+            max_range (float): depth drawn with the last colour, None to scale every frame to its own min/max
+            confidence_value (float): pixels with a lower confidence are drawn black
+            colormap (int): OpenCV colormap of the LUT
+        """
+        self.max_range = max_range
+        self.confidence_value = confidence_value
+        self.lut = depth_lut(colormap)
+        self._index = None
+        self._mask = None
+        self._valid = None
+
+    def _buffers(self, shape):
+        if self._index is None or self._index.shape != shape:
+            self._index = np.empty(shape, dtype=np.uint8)
+            self._mask = np.empty(shape, dtype=np.uint8)
+            self._valid = np.empty(shape, dtype=np.uint8)
+        return self._index, self._mask, self._valid
+
+    def colorize(self, depth: np.ndarray, confidence: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """Colours a stack of depth frames.
+
+        Args:
+            depth (np.ndarray): (N, H, W) or (H, W) depth frames
+            confidence (np.ndarray): confidence frames with the same shape
+            out (np.ndarray, optional): (N, H, W, 3) uint8 output buffer
+
+        Returns:
+            np.ndarray: BGR frames, (N, H, W, 3) or (H, W, 3) for a single frame
+        """
+        shape = depth.shape
+        if out is None:
+            out = np.empty(shape + (3,), dtype=np.uint8)
+
+        # the stack is handled as one tall (N*H, W) image so every step is a single OpenCV call
+        width = shape[-1]
+        depth_2d = np.ascontiguousarray(depth).reshape(-1, width)
+        confidence_2d = np.ascontiguousarray(confidence).reshape(-1, width)
+        index, mask, valid = self._buffers(depth_2d.shape)
+
+        # pixels with a depth (NaN, 0 and negative depths have none) and enough confidence,
+        # the others use the black entry 0 of the LUT
+        cv2.compare(depth_2d, 0, cv2.CMP_GT, valid)
+        cv2.compare(confidence_2d, self.confidence_value, cv2.CMP_GE, mask)
+        cv2.bitwise_and(mask, valid, mask)
+
+        # depth -> 1..255 saturating at max_range; convertScaleAbs folds negative values back
+        # up, the mask clears them (and NaN) afterwards
+        if self.max_range is None:
+            frames = depth_2d.reshape(-1, shape[-2], width)
+            frame_valid = valid.reshape(frames.shape)
+            for frame, frame_index, frame_mask in zip(frames, index.reshape(frames.shape), frame_valid):
+                values = frame[frame_mask > 0]
+                values = values[np.isfinite(values)]
+                low, high = (float(values.min()), float(values.max())) if values.size else (0.0, 1.0)
+                alpha = 254.0 / max(high - low, 1e-6)
+                cv2.convertScaleAbs(frame, frame_index, alpha, 1.0 - low * alpha)
+        else:
+            cv2.convertScaleAbs(depth_2d, index, 254.0 / self.max_range, 1.0)
+        cv2.bitwise_and(index, mask, index)
+
+        cv2.applyColorMap(index, self.lut.reshape(256, 1, 3), out.reshape(-1, width, 3))
+        return out
+
+
+def colorize_depth_batch(depth: np.ndarray, confidence: np.ndarray, max_range: float = DEPTH_RANGE,
+                         confidence_value: float = CONFIDENCE_VALUE, out: np.ndarray = None) -> np.ndarray:
+    """Colours an (N, H, W) stack of depth frames, see DepthColorizer."""
+    return DepthColorizer(max_range, confidence_value).colorize(depth, confidence, out)
+
+
+def draw_timestamp(image: np.ndarray, timestamp: str):
+    """Writes the timestamp in the bottom right corner of an image."""
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 0.5
+    thickness = 1
+    color = (255, 255, 255)
+    text_size = cv2.getTextSize(timestamp, font, font_scale, thickness)[0]
+    text_width, text_height = text_size
+    bottom_right = (image.shape[1] - text_width - 10, image.shape[0] - 10)
+    cv2.putText(image, timestamp, bottom_right, font, font_scale, color, thickness, cv2.LINE_AA)
+
+
+_colorizer = DepthColorizer()
 
 
 def process_data(file_path: str):
@@ -17,24 +128,14 @@ def process_data(file_path: str):
     confidence_buf = data['confidence']
     print(f"Data loaded from: {file_path}")
 
-    # Apply depth data normalization and color map
-    r = 1000  # Range value; adjust as needed for your camera setup
-    result_image = (depth_buf * (255.0 / r)).astype(np.uint8)
-    result_image = cv2.applyColorMap(result_image, cv2.COLORMAP_RAINBOW)
-    result_image = getPreviewRGB(result_image, confidence_buf)
+    # Apply depth data normalization, color map and confidence mask
+    result_image = _colorizer.colorize(depth_buf, confidence_buf)
 
     # Get the timestamp for filename
     timestamp = file_path.split('_')[-1].split('.')[0]
 
     # Add timestamp to image
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 0.5
-    thickness = 1
-    color = (255, 255, 255)
-    text_size = cv2.getTextSize(timestamp, font, font_scale, thickness)[0]
-    text_width, text_height = text_size
-    bottom_right = (result_image.shape[1] - text_width - 10, result_image.shape[0] - 10)
-    cv2.putText(result_image, timestamp, bottom_right, font, font_scale, color, thickness, cv2.LINE_AA)
+    draw_timestamp(result_image, timestamp)
 
     # Save the processed image
     save_path = f"depthImage/processed_image_{timestamp}.png"
@@ -46,20 +147,117 @@ def process_data(file_path: str):
     print(f"Deleted {file_path}")
 
 
+def process_batch(file_paths: List[str], batch_size: int = 64):
+    """Processes many NPZ files at once, colouring each batch in one pass.
+
+    Args:
+        file_paths (List[str]): .npz captures of the same camera
+        batch_size (int): frames loaded and coloured together
+    """
+    colorizer = DepthColorizer()
+    writer = ImageWriter()
+    depth_stack = confidence_stack = images = None
+
+    for start in range(0, len(file_paths), batch_size):
+        batch = file_paths[start:start + batch_size]
+
+        # load the batch into preallocated stacks
+        for i, file_path in enumerate(batch):
+            with np.load(file_path) as data:
+                if depth_stack is None:
+                    frame_shape = data['depth'].shape
+                    depth_stack = np.empty((batch_size,) + frame_shape, dtype=np.float32)
+                    confidence_stack = np.empty((batch_size,) + frame_shape, dtype=np.float32)
+                    images = np.empty((batch_size,) + frame_shape + (3,), dtype=np.uint8)
+                depth_stack[i] = data['depth']
+                confidence_stack[i] = data['confidence']
+
+        n = len(batch)
+        colorizer.colorize(depth_stack[:n], confidence_stack[:n], images[:n])
+
+        # the batch is encoded on the writer threads
+        for file_path, image in zip(batch, images[:n]):
+            timestamp = file_path.split('_')[-1].split('.')[0]
+            draw_timestamp(image, timestamp)
+            save_path = writer.submit(image, f"depthImage/processed_image_{timestamp}.png")
+            print(f"Processed image saved as {save_path}")
+
+        # the images buffer is reused and the inputs deleted only once the batch is on disk
+        writer.flush()
+        for file_path in batch:
+            os.remove(file_path)
+            print(f"Deleted {file_path}")
+    writer.close()
+
+
+def process_session(path: str, t_start: Optional[float] = None, t_end: Optional[float] = None,
+                    batch_size: int = 64, out_dir: str = "depthImage"):
+    """Colours the depth frames of a session without deleting anything.
+
+    Frames are read through the session index in batches, so a long recording
+    is never loaded into memory at once.
+
+    Args:
+        path (str): recorded session directory or data directory of .npz captures
+        t_start (float, optional): first frame time of day, seconds since midnight
+        t_end (float, optional): frames at or after this time of day are skipped
+        batch_size (int): frames coloured together
+        out_dir (str): directory for the images
+    """
+    from sensor_sources import format_timestamp
+    from session_reader import SessionReader
+
+    session = SessionReader(path)
+    clock = session.clock_times("depth")
+    indices = session.clock_range("depth", t_start, t_end)
+    first, last = indices.start, indices.stop
+    if not indices and len(clock):
+        print(f"No depth frames in the range, the session's run from {format_timestamp(clock[0])} "
+              f"to {format_timestamp(clock[-1])}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    colorizer = DepthColorizer()
+    writer = ImageWriter()
+    images = None
+    for start in range(first, last, batch_size):
+        stack = session.slice("depth", start, min(start + batch_size, last))
+        n = len(stack["t_mono"])
+        if images is None:
+            images = np.empty((batch_size,) + stack["depth"].shape[1:] + (3,), dtype=np.uint8)
+        colorizer.colorize(stack["depth"], stack["confidence"], images[:n])
+
+        for image, t in zip(images[:n], clock[start:start + n]):
+            timestamp = format_timestamp(t)
+            draw_timestamp(image, timestamp)
+            save_path = writer.submit(image, os.path.join(out_dir, f"processed_image_{timestamp}.png"))
+            print(f"Processed image saved as {save_path}")
+        writer.flush()  # before the images buffer is reused
+    writer.close()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Colour the depth captures in depthImage/")
+    parser.add_argument("--session", help="render a recorded session or data directory instead; "
+                                          "nothing is deleted")
+    parser.add_argument("--start", help="first frame time of the session, e.g. 17-39-00")
+    parser.add_argument("--end", help="only frames before this time of the session, e.g. 17-41-30")
+    args = parser.parse_args()
+
+    if args.session:
+        from sensor_sources import parse_timestamp
+        t_start = parse_timestamp(args.start) if args.start else None
+        t_end = parse_timestamp(args.end) if args.end else None
+        process_session(args.session, t_start, t_end)
+        return
+
     # Folder containing the .npz files
     folder_path = 'depthImage'
     
-    # Iterate through all .npz files in the folder
-    for npz_file in os.listdir(folder_path):
-        if npz_file.endswith('.npz'):
-            # Full file path
-            file_path = os.path.join(folder_path, npz_file)
-            
-            # Process the file and delete after saving the image
-            process_data(file_path)
+    # Colour all .npz files in the folder in batches
+    file_paths = [os.path.join(folder_path, npz_file)
+                  for npz_file in sorted(os.listdir(folder_path)) if npz_file.endswith('.npz')]
+    process_batch(file_paths)
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,26 +1,33 @@
+import argparse
+import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 import os
+from typing import Optional
+
+from image_writer import ImageWriter
+from sensor_sources import format_timestamp, parse_timestamp
+from session_reader import SessionReader
+from thermal_render import ThermalRenderer, PublicationRenderer
+
+# renderers are created once and reused for every frame
+_renderer = None
+_publication_renderer = None
+
+
+def process_data(file_path: str, publication: bool = False):
+    """Process thermal data and save the processed image.
+
+    Args:
+        file_path (str): path of the thermal .npz capture
+        publication (bool): save the 300 dpi matplotlib figure instead of the fast OpenCV render
+    """
+    global _renderer, _publication_renderer
 
-def process_data(file_path: str):
-    """Process thermal data and save the processed image."""
     # Load the saved thermal data from the .npz file
     data = np.load(file_path)
     temperature_data = data['temperature']
     print(f"Data loaded from: {file_path}")
 
-    # Setup the figure for plotting
-    plt.ion()
-    fig, ax = plt.subplots(figsize=(12, 7))
-    therm1 = ax.imshow(np.zeros(temperature_data.shape), cmap='plasma', vmin=0, vmax=60)
-    cbar = fig.colorbar(therm1)
-    cbar.set_label('Temperature [$^{\circ}$C]', fontsize=14)
-
-    # Update the thermal image with the data
-    therm1.set_data(np.fliplr(temperature_data))  # Flip left to right
-    therm1.set_clim(vmin=np.min(temperature_data), vmax=np.max(temperature_data))  # Set bounds
-    cbar.update_normal(therm1)
-
     # Save the processed thermal image
     folder_path = "thermalImage"
     if not os.path.exists(folder_path):
@@ -28,18 +35,77 @@ def process_data(file_path: str):
 
     timestamp = file_path.split('_')[-1].split('.')[0]  # Extract timestamp from the filename
     save_path = os.path.join(folder_path, f"thermal_image_{timestamp}.png")
-    fig.savefig(save_path, dpi=300, facecolor='#FCFCFC', bbox_inches='tight')
-    print(f"Processed thermal image saved as {save_path}")
 
-    # Close the figure to avoid memory issues
-    plt.close(fig)
+    if publication:
+        if _publication_renderer is None:
+            _publication_renderer = PublicationRenderer()
+        _publication_renderer.save(temperature_data, save_path)
+    else:
+        # flipped left to right with the bounds set to the frame min/max, like the figure
+        if _renderer is None:
+            _renderer = ThermalRenderer(shape=temperature_data.shape, interpolation="bilinear")
+        cv2.imwrite(save_path, _renderer.render(temperature_data))
+    print(f"Processed thermal image saved as {save_path}")
 
     # Delete the .npz file after processing
     os.remove(file_path)
     print(f"Deleted {file_path}")
 
 
+def process_session(path: str, t_start: Optional[float] = None, t_end: Optional[float] = None,
+                    publication: bool = False, out_dir: str = "thermalImage"):
+    """Renders the thermal frames of a session without deleting anything.
+
+    Args:
+        path (str): recorded session directory or data directory of .npz captures
+        t_start (float, optional): first frame time of day, seconds since midnight
+        t_end (float, optional): frames at or after this time of day are skipped
+        publication (bool): save the 300 dpi matplotlib figure instead of the fast OpenCV render
+        out_dir (str): directory for the images
+    """
+    global _renderer, _publication_renderer
+
+    session = SessionReader(path)
+    clock = session.clock_times("thermal")
+    indices = session.clock_range("thermal", t_start, t_end)
+    if not indices and len(clock):
+        print(f"No thermal frames in the range, the session's run from {format_timestamp(clock[0])} "
+              f"to {format_timestamp(clock[-1])}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    writer = ImageWriter()
+    for i in indices:
+        temperature_data = session.frame("thermal", i)["arrays"]["temperature"]
+        save_path = os.path.join(out_dir, f"thermal_image_{format_timestamp(clock[i])}.png")
+        if publication:
+            if _publication_renderer is None:
+                _publication_renderer = PublicationRenderer()
+            image = _publication_renderer.render(temperature_data)
+        else:
+            if _renderer is None:
+                _renderer = ThermalRenderer(shape=temperature_data.shape, interpolation="bilinear")
+            image = _renderer.render(temperature_data).copy()  # the canvas is reused
+        writer.submit(image, save_path)
+        print(f"Processed thermal image saved as {save_path}")
+    writer.close()
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Render the thermal captures in thermalImage/")
+    parser.add_argument("--publication", action="store_true",
+                        help="save 300 dpi matplotlib figures instead of the fast OpenCV render")
+    parser.add_argument("--session", help="render a recorded session or data directory instead; "
+                                          "nothing is deleted")
+    parser.add_argument("--start", help="first frame time of the session, e.g. 17-39-00")
+    parser.add_argument("--end", help="only frames before this time of the session, e.g. 17-41-30")
+    args = parser.parse_args()
+
+    if args.session:
+        t_start = parse_timestamp(args.start) if args.start else None
+        t_end = parse_timestamp(args.end) if args.end else None
+        process_session(args.session, t_start, t_end, args.publication)
+        return
+
     # Folder containing the .npz files
     folder_path = 'thermalImage'
     
@@ -50,9 +116,8 @@ def main():
             file_path = os.path.join(folder_path, npz_file)
             
             # Process the file and delete after saving the image
-            process_data(file_path)
+            process_data(file_path, args.publication)
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,173 @@
+"""
+Adaptive capture rate of the collectors, driven by the processing backlog.
+
+Instead of sleeping a fixed second between frames, each collector asks the
+controller when to capture next. The controller keeps a capture rate per
+sensor and adjusts it from what the pipeline reports:
+
+    - queue fill:  frames waiting for the pool, as a fraction of the queue bound
+    - latency:     publish -> processed time of the sensor's frames (from the
+                   scheduler's on_result callback)
+
+It is additive increase, multiplicative decrease (as in TCP congestion
+control): while the queue stays short and the latency under target the rate
+creeps up, as soon as the queue fills past `target_fill` or the latency goes
+over `target_latency` it is cut back. The rates settle just below what the pool
+can sustain, without the queue growing and without idle workers.
+
+    controller = RateController(["thermal", "depth"], queues={"thermal": queue, "depth": queue}, queue_size=32)
+    scheduler = FrameScheduler(handlers, on_result=controller.on_result).start(queue)
+    while collecting:
+        frame = source.read()
+        ...
+        controller.wait("thermal")
+
+With a ground speed and the along-track footprint of a sensor's frames the
+rate is also capped at what covers the ground with the requested overlap,
+there is no point in capturing the same patch of soil ten times:
+
+    controller.set_speed(0.3)     # m/s, e.g. from the wheel odometry
+"""
+import threading
+import time
+from typing import Dict, Iterable, Optional, Union
+
+from pipeline_metrics import NULL_METRICS
+
+
+def coverage_rate(speed: float, footprint: float, overlap: float = 0.2) -> float:
+    """Frames per second covering the ground at a speed with the given overlap between frames.
+
+    Args:
+        speed (float): ground speed in m/s
+        footprint (float): along-track length of the ground in one frame in m
+        overlap (float): fraction of a frame seen again in the next one
+
+    Returns:
+        float: capture rate in Hz
+    """
+    return speed / (footprint * (1.0 - overlap))
+
+
+def queue_fill(queue, size: int) -> Optional[float]:
+    """Fraction of a queue in use, None where qsize() is not available (macOS)."""
+    try:
+        return queue.qsize() / size
+    except NotImplementedError:
+        return None
+
+
+class RateController:
+    """Per-sensor capture rates adjusted to the processing backlog."""
+
+    def __init__(self, sensors: Iterable[str], queues: Optional[Dict] = None,
+                 queue_size: Union[int, Dict[str, int]] = 32, min_rate: float = 0.2, max_rate: float = 30.0,
+                 start_rate: float = 1.0, target_fill: float = 0.5, target_latency: Optional[float] = None,
+                 increase: Optional[float] = None, decrease: float = 0.7, update_interval: float = 0.5,
+                 footprints: Optional[Dict[str, float]] = None, overlap: float = 0.2, metrics=None):
+        """
+        Args:
+            sensors (Iterable[str]): sensors to pace
+            queues (Dict, optional): sensor -> processing queue its frames go to
+            queue_size (int or Dict[str, int]): bound of the queues
+            min_rate (float): lowest capture rate in Hz
+            max_rate (float): highest capture rate in Hz
+            start_rate (float): rate before any feedback, 1 Hz like the fixed delay
+            target_fill (float): queue fill above which the rate is cut
+            target_latency (float, optional): publish -> processed seconds above which the rate is cut
+            increase (float, optional): Hz added per update while there is room, (max - min) / 50 by default
+            decrease (float): factor the rate is multiplied by when the pipeline falls behind
+            update_interval (float): seconds between adjustments of one sensor's rate
+            footprints (Dict[str, float], optional): sensor -> along-track frame footprint in m
+            overlap (float): overlap between frames for the coverage cap
+            metrics (PipelineMetrics, optional): samples the rates as rate_<sensor> gauges
+        """
+        self.sensors = list(sensors)
+        self.queues = queues or {}
+        self.queue_size = queue_size
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_fill = target_fill
+        self.target_latency = target_latency
+        self.increase = increase if increase is not None else (max_rate - min_rate) / 50.0
+        self.decrease = decrease
+        self.update_interval = update_interval
+        self.footprints = footprints or {}
+        self.overlap = overlap
+        self.metrics = metrics or NULL_METRICS
+
+        self.speed = None
+        self.rates = {sensor: min(max(start_rate, min_rate), max_rate) for sensor in self.sensors}
+        self.latency = {sensor: None for sensor in self.sensors}
+        self._next = {sensor: None for sensor in self.sensors}
+        self._updated = {sensor: 0.0 for sensor in self.sensors}
+        self._lock = threading.Lock()
+
+    def set_speed(self, speed: Optional[float]):
+        """Ground speed in m/s for the coverage cap, None removes the cap."""
+        self.speed = speed
+
+    def ceiling(self, sensor: str) -> float:
+        """Highest rate of a sensor: max_rate, or less when the ground coverage needs less."""
+        footprint = self.footprints.get(sensor)
+        if self.speed is None or not footprint:
+            return self.max_rate
+        return min(max(coverage_rate(self.speed, footprint, self.overlap), self.min_rate), self.max_rate)
+
+    def on_result(self, frame: Dict, result=None):
+        """FrameScheduler callback, folds the frame's publish -> processed latency into the sensor's average."""
+        sensor = frame.get("sensor")
+        if sensor not in self.latency or "t_publish" not in frame:
+            return
+        latency = time.monotonic() - frame["t_publish"]
+        with self._lock:
+            previous = self.latency[sensor]
+            self.latency[sensor] = latency if previous is None else 0.8 * previous + 0.2 * latency
+
+    def update(self, sensor: str) -> float:
+        """Adjusts the rate of a sensor from the current backlog and returns it."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._updated[sensor] < self.update_interval:
+                return self.rates[sensor]
+            self._updated[sensor] = now
+            latency = self.latency[sensor]
+
+        fill = None
+        if sensor in self.queues:
+            size = self.queue_size[sensor] if isinstance(self.queue_size, dict) else self.queue_size
+            fill = queue_fill(self.queues[sensor], size)
+        behind = (fill is not None and fill > self.target_fill) or \
+                 (self.target_latency is not None and latency is not None and latency > self.target_latency)
+        idle = (fill is None or fill <= self.target_fill / 2) and \
+               (self.target_latency is None or latency is None or latency <= self.target_latency)
+
+        with self._lock:
+            rate = self.rates[sensor]
+            if behind:
+                rate *= self.decrease
+            elif idle:
+                rate += self.increase
+            rate = min(max(rate, self.min_rate), self.ceiling(sensor))
+            self.rates[sensor] = rate
+        self.metrics.gauge(f"rate_{sensor}", rate)
+        return rate
+
+    def wait(self, sensor: str):
+        """Sleeps until the next capture of a sensor is due at its current rate.
+
+        Captures are scheduled from the previous one, so the time spent reading
+        and publishing the frame counts towards the interval.
+        """
+        rate = self.update(sensor)
+        now = time.monotonic()
+        due = self._next[sensor]
+        due = now + 1.0 / rate if due is None else max(due + 1.0 / rate, now)
+        self._next[sensor] = due
+        time.sleep(max(due - now, 0.0))
+
+    def stats(self) -> Dict:
+        return {
+            sensor: {"rate": self.rates[sensor], "latency": self.latency[sensor], "ceiling": self.ceiling(sensor)}
+            for sensor in self.sensors
+        }
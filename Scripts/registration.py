@@ -0,0 +1,276 @@
+"""
+Thermal <-> ToF <-> RGB registration from a one-off calibration session.
+
+Instead of matching features on every image pair (see
+Alignment-not-working/aligning_thermal_tof.py), the transforms between the
+sensors are estimated once and saved. A calibration session is recorded with
+a warm, close target (e.g. a mug of hot water) moved around the field of view:
+in every synchronized bundle the target is the hottest blob of the thermal
+frame and the nearest blob of the depth frame, which gives one point
+correspondence per bundle. A RANSAC homography is fitted to all of them.
+
+    python3 registration.py calibrate data --out calibration.npz
+
+At run time a Registration precomputes the cv2.remap lookup tables once, so
+registering a frame is a single table-driven warp:
+
+    calibration = Calibration.load("calibration.npz")
+    thermal_on_depth = calibration["thermal", "depth"].warp(temperature)
+    depth_points = calibration["thermal", "depth"].transform_points(thermal_points)
+"""
+import argparse
+import csv
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+# (width, height) of the raw sensor frames
+SENSOR_SIZES = {
+    "thermal": (32, 24),
+    "depth": (240, 180),
+    "rgb": (1920, 1080),
+}
+
+
+class Registration:
+    """A homography from one sensor's pixels to another's, with cached remap tables."""
+
+    def __init__(self, homography: np.ndarray, src_size: Tuple[int, int], dst_size: Tuple[int, int]):
+        """
+        Args:
+            homography (np.ndarray): 3x3 matrix mapping source pixels to destination pixels
+            src_size (Tuple[int, int]): (width, height) of the source frames
+            dst_size (Tuple[int, int]): (width, height) of the destination frames
+        """
+        self.homography = np.asarray(homography, dtype=np.float64)
+        self.src_size = tuple(int(v) for v in src_size)
+        self.dst_size = tuple(int(v) for v in dst_size)
+        self._maps = None
+
+    @classmethod
+    def scaling(cls, src_size: Tuple[int, int], dst_size: Tuple[int, int]) -> "Registration":
+        """Plain width/height scaling, the fallback when no calibration is available."""
+        sx = dst_size[0] / src_size[0]
+        sy = dst_size[1] / src_size[1]
+        return cls(np.diag([sx, sy, 1.0]), src_size, dst_size)
+
+    @property
+    def maps(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Fixed point remap tables for every destination pixel, built on first use."""
+        if self._maps is None:
+            width, height = self.dst_size
+            xs, ys = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+            grid = np.stack([xs, ys], axis=-1).reshape(-1, 1, 2)
+            # destination pixel -> source pixel
+            source = cv2.perspectiveTransform(grid, np.linalg.inv(self.homography)).reshape(height, width, 2)
+            self._maps = cv2.convertMaps(source[..., 0], source[..., 1], cv2.CV_16SC2)
+        return self._maps
+
+    def warp(self, image: np.ndarray, interpolation: int = cv2.INTER_LINEAR,
+             border_value: float = 0, dst: Optional[np.ndarray] = None) -> np.ndarray:
+        """Warps a source frame onto the destination sensor's pixel grid."""
+        map1, map2 = self.maps
+        if image.dtype == np.float64:
+            image = image.astype(np.float32)
+        return cv2.remap(image, map1, map2, interpolation, dst=dst,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=border_value)
+
+    def transform_points(self, points: np.ndarray) -> np.ndarray:
+        """Maps (N, 2) source pixel coordinates (x, y) to destination coordinates."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        if len(points) == 0:
+            return np.empty((0, 2))
+        return cv2.perspectiveTransform(points, self.homography).reshape(-1, 2)
+
+    def inverse(self) -> "Registration":
+        return Registration(np.linalg.inv(self.homography), self.dst_size, self.src_size)
+
+
+class Calibration:
+    """The registrations between the sensors, saved to and loaded from one .npz file."""
+
+    def __init__(self, registrations: Optional[Dict[Tuple[str, str], Registration]] = None):
+        self.registrations = dict(registrations or {})
+
+    def __getitem__(self, key: Tuple[str, str]) -> Registration:
+        src, dst = key
+        if key in self.registrations:
+            return self.registrations[key]
+        if (dst, src) in self.registrations:
+            registration = self.registrations[dst, src].inverse()
+        elif src != "depth" and dst != "depth" and (src, "depth") in self and ("depth", dst) in self:
+            # chain through the depth camera, e.g. thermal -> depth -> rgb
+            first, second = self[src, "depth"], self["depth", dst]
+            registration = Registration(second.homography @ first.homography, first.src_size, second.dst_size)
+        else:
+            raise KeyError(f"No registration from {src} to {dst}")
+        self.registrations[key] = registration
+        return registration
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        src, dst = key
+        return key in self.registrations or (dst, src) in self.registrations
+
+    def __setitem__(self, key: Tuple[str, str], registration: Registration):
+        self.registrations[key] = registration
+
+    def save(self, path: str):
+        arrays = {}
+        for (src, dst), registration in self.registrations.items():
+            prefix = f"{src}__{dst}"
+            arrays[prefix + "__homography"] = registration.homography
+            arrays[prefix + "__src_size"] = np.array(registration.src_size)
+            arrays[prefix + "__dst_size"] = np.array(registration.dst_size)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> "Calibration":
+        calibration = cls()
+        with np.load(path) as data:
+            for name in data.files:
+                if name.endswith("__homography"):
+                    src, dst, _ = name.split("__")
+                    prefix = f"{src}__{dst}"
+                    calibration[src, dst] = Registration(data[name], data[prefix + "__src_size"],
+                                                         data[prefix + "__dst_size"])
+        return calibration
+
+
+# ------------------------------------------------------------------------------
+# Calibration target detection
+# ------------------------------------------------------------------------------
+
+def _blob_centroid(mask: np.ndarray, weights: np.ndarray, min_area: int) -> Optional[Tuple[float, float]]:
+    """Weighted centroid of the largest connected blob of a mask."""
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    if count < 2:
+        return None
+    largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    if stats[largest, cv2.CC_STAT_AREA] < min_area:
+        return None
+    ys, xs = np.nonzero(labels == largest)
+    w = weights[ys, xs].astype(np.float64)
+    w = w - w.min() + 1e-6
+    return float(np.average(xs, weights=w)), float(np.average(ys, weights=w))
+
+
+def thermal_target(temperature: np.ndarray, delta: float = 3.0, min_area: int = 1) -> Optional[Tuple[float, float]]:
+    """Centroid (x, y) of the hot target: pixels within `delta` C of the hottest one."""
+    hottest = float(np.max(temperature))
+    if hottest - float(np.median(temperature)) < 2 * delta:
+        return None  # no target clearly warmer than the background
+    return _blob_centroid(temperature >= hottest - delta, temperature, min_area)
+
+
+def depth_target(depth: np.ndarray, confidence: np.ndarray, confidence_value: float = 30,
+                 band: float = 50.0, min_area: int = 20) -> Optional[Tuple[float, float]]:
+    """Centroid (x, y) of the nearest object: valid pixels within `band` of the closest depth."""
+    valid = (confidence >= confidence_value) & (depth > 0)
+    if not valid.any():
+        return None
+    nearest = float(np.percentile(depth[valid], 1))
+    return _blob_centroid(valid & (depth <= nearest + band), -depth, min_area)
+
+
+def fit_registration(src_points: np.ndarray, dst_points: np.ndarray, src_size: Tuple[int, int],
+                     dst_size: Tuple[int, int], reprojection_error: float = 3.0) -> Tuple[Registration, np.ndarray]:
+    """Fits a RANSAC homography to point correspondences.
+
+    Returns:
+        Tuple[Registration, np.ndarray]: the registration and the inlier mask
+    """
+    src_points = np.asarray(src_points, dtype=np.float32).reshape(-1, 1, 2)
+    dst_points = np.asarray(dst_points, dtype=np.float32).reshape(-1, 1, 2)
+    if len(src_points) < 4:
+        raise ValueError(f"Need at least 4 correspondences, got {len(src_points)}")
+    homography, mask = cv2.findHomography(src_points, dst_points, cv2.RANSAC, reprojection_error)
+    if homography is None:
+        raise ValueError("Could not fit a homography to the correspondences")
+    return Registration(homography, src_size, dst_size), mask.ravel().astype(bool)
+
+
+def calibrate_session(path: str, tolerance: float = 0.1) -> Tuple[Registration, int, int]:
+    """Estimates the thermal -> depth registration from a recorded calibration session.
+
+    Args:
+        path (str): session directory or archive holding thermal and depth .npz captures
+        tolerance (float): largest time difference in seconds between paired frames
+
+    Returns:
+        Tuple[Registration, int, int]: registration, correspondences found and RANSAC inliers
+    """
+    from frame_sync import bundle_sources
+    from sensor_sources import open_replay_sources
+
+    sources = open_replay_sources(path, rate=0, sensors=("thermal", "depth"))
+    for source in sources.values():
+        source.open()
+
+    src_points, dst_points = [], []
+    depth_size = SENSOR_SIZES["depth"]
+    try:
+        for bundle in bundle_sources(sources, reference="thermal", tolerance=tolerance):
+            thermal = bundle["frames"]["thermal"]["arrays"]
+            depth = bundle["frames"]["depth"]["arrays"]
+            src = thermal_target(thermal["temperature"])
+            dst = depth_target(depth["depth"], depth["confidence"])
+            if src is not None and dst is not None:
+                src_points.append(src)
+                dst_points.append(dst)
+                depth_size = depth["depth"].shape[::-1]
+    finally:
+        for source in sources.values():
+            source.close()
+
+    registration, inliers = fit_registration(src_points, dst_points, SENSOR_SIZES["thermal"], depth_size)
+    return registration, len(src_points), int(inliers.sum())
+
+
+def load_points(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Reads manual correspondences from a CSV with src_x,src_y,dst_x,dst_y columns."""
+    with open(path, newline="") as f:
+        rows = [[float(row[k]) for k in ("src_x", "src_y", "dst_x", "dst_y")] for row in csv.DictReader(f)]
+    points = np.array(rows).reshape(-1, 4)
+    return points[:, :2], points[:, 2:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate and save the registration between the sensors")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    session = sub.add_parser("calibrate", help="thermal -> depth from a recorded calibration session")
+    session.add_argument("session", help="session directory or archive with thermal and depth captures")
+    session.add_argument("--tolerance", type=float, default=0.1, help="pairing window in seconds")
+    session.add_argument("--out", default="calibration.npz")
+
+    points = sub.add_parser("points", help="any sensor pair from manual correspondences")
+    points.add_argument("src", choices=SENSOR_SIZES)
+    points.add_argument("dst", choices=SENSOR_SIZES)
+    points.add_argument("csv", help="CSV with src_x,src_y,dst_x,dst_y columns")
+    points.add_argument("--out", default="calibration.npz")
+
+    args = parser.parse_args()
+
+    # add to an existing calibration instead of replacing it
+    try:
+        calibration = Calibration.load(args.out)
+    except FileNotFoundError:
+        calibration = Calibration()
+
+    if args.command == "calibrate":
+        registration, found, inliers = calibrate_session(args.session, args.tolerance)
+        calibration["thermal", "depth"] = registration
+        print(f"Calibrated thermal -> depth from {found} target positions ({inliers} inliers)")
+    else:
+        src_points, dst_points = load_points(args.csv)
+        registration, inliers = fit_registration(src_points, dst_points, SENSOR_SIZES[args.src], SENSOR_SIZES[args.dst])
+        calibration[args.src, args.dst] = registration
+        print(f"Calibrated {args.src} -> {args.dst} from {len(src_points)} points ({int(inliers.sum())} inliers)")
+
+    calibration.save(args.out)
+    print(f"Calibration saved as {args.out}")
+
+
+if __name__ == "__main__":
+    main()
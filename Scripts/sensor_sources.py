@@ -0,0 +1,601 @@
+"""
+Sensor sources used by the capture scripts.
+
+Every sensor (thermal, depth, rgb) is read through the same small interface so
+the capture -> process pipeline does not care whether frames come from the
+hardware on the Pi or from a recorded session on any Linux box.
+
+    source = ReplaySource("thermal", "data/thermal", rate=4.0)
+    with source:
+        for frame in source:
+            print(frame["timestamp"], frame["arrays"]["temperature"].shape)
+
+A frame is a dictionary:
+    - "sensor":    "thermal", "depth" or "rgb"
+    - "timestamp": "%H-%M-%S.mmm" string used in the file names
+    - "t_mono":    time.monotonic() when the frame was read (recorded time for replays)
+    - "arrays":    the named arrays, same keys as the .npz captures
+                   ("temperature", "depth"/"confidence", "rgb")
+"""
+import io
+import os
+import re
+import tarfile
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# file name prefixes written by the collectors and the older capture scripts
+SENSOR_PREFIXES = {
+    "thermal": ("mlx90640_", "thermal_data_", "thermal_image_"),
+    "depth": ("tof_", "captured_data_", "depth_", "processed_image_"),
+    "rgb": ("rgb_",),
+}
+
+# timestamp format used in every file name, e.g. 17-39-27.341
+TIMESTAMP_PATTERN = re.compile(r"(\d{2})-(\d{2})-(\d{2})(?:\.(\d{1,6}))?")
+
+
+def make_timestamp(now: Optional[datetime] = None) -> str:
+    """Returns the "%H-%M-%S.mmm" timestamp used for the data file names."""
+    if now is None:
+        now = datetime.now()
+    return now.strftime("%H-%M-%S") + f".{now.microsecond // 1000:03d}"
+
+
+def format_timestamp(seconds: float) -> str:
+    """Formats seconds since midnight as a "%H-%M-%S.mmm" timestamp, see parse_timestamp()."""
+    millis = int(round(seconds * 1000)) % (24 * 3600 * 1000)
+    minutes, millis = divmod(millis, 60000)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}-{minutes:02d}-{millis // 1000:02d}.{millis % 1000:03d}"
+
+
+def parse_timestamp(name: str) -> Optional[float]:
+    """Parses the timestamp out of a file name into seconds since midnight.
+
+    Args:
+        name (str): file name such as "tof_17-39-27.341.npz"
+
+    Returns:
+        Optional[float]: seconds since midnight or None if there is no timestamp
+    """
+    match = TIMESTAMP_PATTERN.search(os.path.basename(name))
+    if match is None:
+        return None
+    hours, minutes, seconds, fraction = match.groups()
+    value = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    if fraction:
+        value += int(fraction) / (10 ** len(fraction))
+    return float(value)
+
+
+class SensorSource:
+    """Common interface of all sensor backends.
+
+    Subclasses implement read() and optionally open()/close(). read() returns a
+    frame dictionary or None once the source is exhausted.
+    """
+
+    sensor = ""
+
+    def open(self):
+        pass
+
+    def read(self) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _frame(self, arrays: Dict[str, np.ndarray], timestamp: Optional[str] = None) -> Dict:
+        return {
+            "sensor": self.sensor,
+            "timestamp": timestamp if timestamp is not None else make_timestamp(),
+            "t_mono": time.monotonic(),
+            "arrays": arrays,
+        }
+
+    def __iter__(self) -> Iterator[Dict]:
+        while True:
+            frame = self.read()
+            if frame is None:
+                return
+            yield frame
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+# ------------------------------------------------------------------------------
+# Hardware backends. The vendor SDKs are only imported when a device is opened
+# so the replay backend works on machines without them.
+# ------------------------------------------------------------------------------
+
+def refresh_rate_hz(name: str) -> float:
+    """Returns the rate of an adafruit_mlx90640.RefreshRate name, e.g. "REFRESH_0_5_HZ" -> 0.5."""
+    return float(name[len("REFRESH_"):-len("_HZ")].replace("_", "."))
+
+
+class ThermalSource(SensorSource):
+    """MLX90640 thermal camera over I2C.
+
+    Frames are read into a small ring of preallocated buffers, the returned
+    temperature array is reused `buffers` frames later so consumers have to
+    copy (or publish) it before then. Every frame is timestamped with the
+    monotonic clock and the source keeps count of retries and of the frames it
+    missed, see stats(): frames the sensor produced while the caller was away
+    between reads (a --delay, the rate controller, slow processing) are
+    "skipped", frames missed while read() itself was running are "dropped".
+    """
+
+    sensor = "thermal"
+    shape = (24, 32)
+
+    def __init__(self, mlx=None, refresh_rate: str = "REFRESH_8_HZ", frequency: int = 1000000,
+                 buffers: int = 4):
+        """
+        Args:
+            mlx (MLX90640, optional): already created device, created on open() otherwise
+            refresh_rate (str): name of the adafruit_mlx90640.RefreshRate to use
+            frequency (int): I2C bus frequency used when the device is created here
+            buffers (int): number of frame buffers reused in turn
+        """
+        self.mlx = mlx
+        self.refresh_rate = refresh_rate
+        self.frequency = frequency
+
+        # getFrame() reads both subpages, so a full frame takes two refresh periods
+        self.frame_period = 2.0 / refresh_rate_hz(refresh_rate)
+
+        self._buffers = np.zeros((buffers, self.shape[0] * self.shape[1]))
+        self._next_buffer = 0
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.frames = 0
+        self.retries = 0
+        self.dropped = 0
+        self.skipped = 0
+        self._t_first = None
+        self._t_last = None
+        self._t_return = None
+
+    def open(self):
+        import adafruit_mlx90640 as thermal_cam
+
+        if self.mlx is None:
+            import board
+            import busio
+
+            i2c = busio.I2C(board.SCL, board.SDA, frequency=self.frequency)
+            self.mlx = thermal_cam.MLX90640(i2c)
+        self.mlx.refresh_rate = getattr(thermal_cam.RefreshRate, self.refresh_rate)
+        self._reset_stats()
+
+    def read(self) -> Optional[Dict]:
+        called = time.monotonic()
+        frame = self._buffers[self._next_buffer]
+        self._next_buffer = (self._next_buffer + 1) % len(self._buffers)
+        while True:
+            try:
+                self.mlx.getFrame(frame)  # Read MLX temperatures into frame var
+                break
+            except ValueError:
+                self.retries += 1
+                continue  # If error, just read again
+
+        # frames the sensor produced since the last one were skipped as long as the caller
+        # was away, the rest were dropped while reading
+        now = time.monotonic()
+        if self._t_last is not None:
+            missed = int((now - self._t_last) / self.frame_period + 0.5) - 1
+            if missed > 0:
+                skipped = min(missed, int((called - self._t_return) / self.frame_period + 0.5))
+                self.skipped += skipped
+                self.dropped += missed - skipped
+        if self._t_first is None:
+            self._t_first = now
+        self._t_last = now
+        self.frames += 1
+
+        result = self._frame({"temperature": frame.reshape(self.shape)})
+        result["t_mono"] = now
+        self._t_return = time.monotonic()
+        return result
+
+    def stats(self) -> Dict:
+        """Acquisition counters since the source was opened, the rate over the frames read."""
+        # frame to frame intervals between the first and the last read, so time spent
+        # before the first read or after the last one does not lower the rate
+        elapsed = self._t_last - self._t_first if self._t_first is not None else 0.0
+        return {
+            "frames": self.frames,
+            "fps": (self.frames - 1) / elapsed if elapsed > 0 else 0.0,
+            "expected_fps": 1.0 / self.frame_period,
+            "retries": self.retries,
+            "dropped": self.dropped,
+            "skipped": self.skipped,
+        }
+
+
+class TofSource(SensorSource):
+    """Arducam ToF depth camera over CSI."""
+
+    sensor = "depth"
+
+    def __init__(self, tof=None, timeout: int = 2000, max_index: int = 15):
+        """
+        Args:
+            tof (ArducamCamera, optional): already created camera, created on open() otherwise
+            timeout (int): frame request timeout in ms
+            max_index (int): number of CSI indices to try when opening the camera
+        """
+        self.tof = tof
+        self.timeout = timeout
+        self.max_index = max_index
+        self._started = False
+
+    def open(self):
+        import ArducamDepthCamera as ac
+
+        self._ac = ac
+        if self.tof is None:
+            self.tof = ac.ArducamCamera()
+
+        ret = -1
+        for i in range(self.max_index):
+            try:
+                ret = self.tof.open(ac.Connection.CSI, i)
+                if ret == 0:
+                    break
+            except Exception:
+                continue
+        if ret != 0:
+            raise RuntimeError(f"Failed to open camera. Error code: {ret}")
+
+        ret = self.tof.start(ac.FrameType.DEPTH)
+        if ret != 0:
+            self.tof.close()
+            raise RuntimeError(f"Failed to start camera. Error code: {ret}")
+        self._started = True
+
+    def read(self) -> Optional[Dict]:
+        while True:
+            frame = self.tof.requestFrame(self.timeout)
+            if frame is not None and isinstance(frame, self._ac.DepthData):
+                break
+        # the SDK owns the buffers, copy them out before releasing the frame
+        arrays = {
+            "depth": np.array(frame.depth_data, copy=True),
+            "confidence": np.array(frame.confidence_data, copy=True),
+        }
+        self.tof.releaseFrame(frame)
+        return self._frame(arrays)
+
+    def close(self):
+        if self._started:
+            self.tof.stop()
+            self.tof.close()
+            self._started = False
+
+
+class RgbPreprocessor:
+    """Crops, downscales and drops the alpha channel of RGB frames on the CPU.
+
+    Cropping and dropping the alpha channel are views of the capture buffer,
+    only the downscale writes pixels, into a small ring of preallocated
+    buffers (reused `buffers` frames later, like ThermalSource).
+    """
+
+    def __init__(self, roi: Optional[Tuple[int, int, int, int]] = None, size: Optional[Tuple[int, int]] = None,
+                 drop_alpha: bool = True, buffers: int = 4):
+        """
+        Args:
+            roi (Tuple[int, int, int, int], optional): (x, y, width, height) of the region to keep
+            size (Tuple[int, int], optional): (width, height) to downscale the region to
+            drop_alpha (bool): keep only the BGR channels of XRGB8888 frames
+            buffers (int): number of output buffers reused in turn
+        """
+        self.roi = roi
+        self.size = tuple(size) if size is not None else None
+        self.drop_alpha = drop_alpha
+        self._buffers = None
+        self._count = buffers
+        self._next_buffer = 0
+
+    def __call__(self, image: np.ndarray) -> np.ndarray:
+        if self.roi is not None:
+            x, y, width, height = self.roi
+            image = image[y:y + height, x:x + width]
+
+        if self.size is not None and (image.shape[1], image.shape[0]) != self.size:
+            import cv2
+            shape = (self.size[1], self.size[0]) + image.shape[2:]
+            if self._buffers is None or self._buffers.shape[1:] != shape:
+                self._buffers = np.empty((self._count,) + shape, dtype=image.dtype)
+            out = self._buffers[self._next_buffer]
+            self._next_buffer = (self._next_buffer + 1) % self._count
+            cv2.resize(image, self.size, dst=out, interpolation=cv2.INTER_AREA)
+            image = out
+
+        if self.drop_alpha and image.ndim == 3 and image.shape[2] == 4:
+            image = image[..., :3]
+        return image
+
+
+class RgbSource(SensorSource):
+    """Raspberry Pi camera through picamera2.
+
+    Without preprocessing the full XRGB8888 still is returned. With a region
+    of interest and/or an output size the frame is reduced at capture time:
+        - "isp": the camera's ISP crops (ScalerCrop) and scales into a BGR888
+          stream of the output size, nothing is done on the CPU
+        - "cpu": the full still is captured and reduced by an RgbPreprocessor
+    """
+
+    sensor = "rgb"
+
+    def __init__(self, cam=None, size: Tuple[int, int] = (1920, 1080), roi: Optional[Tuple[int, int, int, int]] = None,
+                 output_size: Optional[Tuple[int, int]] = None, drop_alpha: bool = False, mode: str = "isp"):
+        """
+        Args:
+            cam (Picamera2, optional): already created camera, created on open() otherwise
+            size (Tuple[int, int]): (width, height) of the still capture
+            roi (Tuple[int, int, int, int], optional): (x, y, width, height) of the region to keep,
+                in pixels of the full still
+            output_size (Tuple[int, int], optional): (width, height) of the returned frames
+            drop_alpha (bool): return BGR frames instead of XRGB
+            mode (str): "isp" or "cpu", where the region and size are applied
+        """
+        if mode not in ("isp", "cpu"):
+            raise ValueError(f"Unknown preprocessing mode: {mode}")
+        self.cam = cam
+        self.size = size
+        self.roi = roi
+        self.output_size = output_size
+        self.drop_alpha = drop_alpha
+        self.mode = mode
+        self.preprocess = None
+        if mode == "cpu" and (roi is not None or output_size is not None or drop_alpha):
+            self.preprocess = RgbPreprocessor(roi, output_size, drop_alpha)
+
+    def open(self):
+        import picamera2 as pi_cam
+        from libcamera import controls
+
+        if self.cam is None:
+            self.cam = pi_cam.Picamera2()
+
+        main = {"size": self.size, "format": "XRGB8888"}
+        if self.mode == "isp":
+            if self.output_size is not None:
+                main["size"] = self.output_size
+            elif self.roi is not None:
+                main["size"] = self.roi[2:]
+            if self.drop_alpha:
+                main["format"] = "RGB888"  # 3 bytes per pixel in BGR order, no alpha to strip
+        config = self.cam.create_still_configuration(main=main)
+        self.cam.configure(config)
+        self.cam.start()
+
+        camera_controls = {"AfMode": controls.AfModeEnum.Continuous}
+        if self.mode == "isp" and self.roi is not None:
+            # the crop is given in pixels of the still, ScalerCrop wants sensor pixels
+            sensor_x, sensor_y, sensor_width, sensor_height = self.cam.camera_properties["ScalerCropMaximum"]
+            sx, sy = sensor_width / self.size[0], sensor_height / self.size[1]
+            x, y, width, height = self.roi
+            camera_controls["ScalerCrop"] = (sensor_x + int(x * sx), sensor_y + int(y * sy),
+                                             int(width * sx), int(height * sy))
+        self.cam.set_controls(camera_controls)
+
+    def read(self) -> Optional[Dict]:
+        image = self.cam.capture_array("main")
+        if self.preprocess is not None:
+            image = self.preprocess(image)
+        return self._frame({"rgb": image})
+
+    def close(self):
+        if self.cam is not None:
+            self.cam.close()
+
+
+class PreprocessedSource(SensorSource):
+    """Applies a preprocessing step to the frames of another source, e.g. a replay.
+
+    With a key the callable gets and returns that one array (an RgbPreprocessor on
+    "rgb"), without one it gets and returns the frame's whole arrays dictionary
+    (a temporal_filter.FrameFilter).
+    """
+
+    def __init__(self, source: SensorSource, preprocess: Callable, key: Optional[str] = "rgb"):
+        self.source = source
+        self.sensor = source.sensor
+        self.preprocess = preprocess
+        self.key = key
+
+    def open(self):
+        self.source.open()
+
+    def read(self) -> Optional[Dict]:
+        frame = self.source.read()
+        if frame is None:
+            return None
+        if self.key is None:
+            frame["arrays"] = self.preprocess(frame["arrays"])
+        elif self.key in frame["arrays"]:
+            frame["arrays"][self.key] = self.preprocess(frame["arrays"][self.key])
+        return frame
+
+    def close(self):
+        self.source.close()
+
+
+class ReplaySource(SensorSource):
+    """Streams recorded frames of one sensor at a configurable rate.
+
+    The recording can be:
+        - a directory of captures, e.g. "data/thermal" or "data" (searched recursively)
+        - a single .npz capture
+        - a .tar / .tar.gz archive such as the ones in image_archive/
+
+    Replayed frames carry the recorded time (seconds since midnight) as "t_mono".
+    .npz members replay their arrays as saved. Rendered images (.png/.jpg, e.g.
+    the archives in image_archive/) hold no raw data the pipeline can process:
+    open() refuses a recording with only images for the sensor unless
+    `images=True`, which replays them decoded under the "image" key.
+    """
+
+    def __init__(self, sensor: str, path: str, rate: Optional[float] = 1.0,
+                 loop: bool = False, interval: float = 1.0, limit: Optional[int] = None,
+                 images: bool = False):
+        """
+        Args:
+            sensor (str): "thermal", "depth" or "rgb"
+            path (str): directory, .npz file or tar archive to replay
+            rate (float, optional): 1.0 is real time, N is N times faster,
+                None or 0 replays as fast as possible
+            loop (bool): start over once the recording is exhausted
+            interval (float): spacing in seconds for frames without a timestamp
+            limit (int, optional): stop after this many frames
+            images (bool): replay rendered images when there are no raw captures
+        """
+        if sensor not in SENSOR_PREFIXES:
+            raise ValueError(f"Unknown sensor type: {sensor}")
+        self.sensor = sensor
+        self.path = path
+        self.rate = rate
+        self.loop = loop
+        self.interval = interval
+        self.limit = limit
+        self.images = images
+
+        self._tar = None
+        self._members: List[Tuple[float, str]] = []
+        self._position = 0
+        self._count = 0
+        self._wall_start = None
+        self._record_start = None
+        self._record_offset = 0.0
+
+    def _matches(self, name: str) -> bool:
+        base = os.path.basename(name)
+        return base.startswith(SENSOR_PREFIXES[self.sensor]) and \
+            base.lower().endswith((".npz", ".png", ".jpg", ".jpeg"))
+
+    def open(self):
+        names = []
+        if os.path.isdir(self.path):
+            for root, _, files in os.walk(self.path):
+                names.extend(os.path.join(root, f) for f in files if self._matches(f))
+        elif tarfile.is_tarfile(self.path):
+            self._tar = tarfile.open(self.path, "r:*")
+            names = [m.name for m in self._tar.getmembers() if m.isfile() and self._matches(m.name)]
+        elif os.path.isfile(self.path):
+            names = [self.path]
+        else:
+            raise FileNotFoundError(self.path)
+
+        # prefer the raw captures when a session holds rendered images as well
+        if any(name.endswith(".npz") for name in names):
+            names = [name for name in names if name.endswith(".npz")]
+        elif names and not self.images:
+            self.close()
+            raise RuntimeError(f"{self.path} holds only rendered {self.sensor} images, no raw captures (.npz) to "
+                               f"replay; Scripts/batch_reprocess.py re-encodes them")
+
+        # order by recorded time, frames without a timestamp keep their listing order
+        members = []
+        for i, name in enumerate(sorted(names)):
+            stamp = parse_timestamp(name)
+            members.append((stamp if stamp is not None else i * self.interval, name))
+        self._members = sorted(members, key=lambda m: m[0])
+        self._position = 0
+        self._count = 0
+        self._wall_start = None
+        self._record_offset = 0.0
+
+    def close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def _load(self, name: str) -> Dict[str, np.ndarray]:
+        if self._tar is not None:
+            raw = self._tar.extractfile(name).read()
+        else:
+            with open(name, "rb") as f:
+                raw = f.read()
+
+        if name.endswith(".npz"):
+            with np.load(io.BytesIO(raw)) as data:
+                return {key: data[key] for key in data.files}
+
+        import cv2
+        image = cv2.imdecode(np.frombuffer(raw, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        return {"image": image}
+
+    def _pace(self, record_time: float):
+        """Sleeps until the recorded frame is due at the configured rate."""
+        if not self.rate:
+            return
+        if self._wall_start is None:
+            self._wall_start = time.monotonic()
+            self._record_start = record_time
+        elapsed = record_time - self._record_start
+        if elapsed < 0:
+            elapsed += 24 * 3600  # recording went past midnight
+        due = self._wall_start + elapsed / self.rate
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def read(self) -> Optional[Dict]:
+        if self.limit is not None and self._count >= self.limit:
+            return None
+        if self._position >= len(self._members):
+            if not self.loop or not self._members:
+                return None
+            # keep the clock running forward across loops
+            first, last = self._members[0][0], self._members[-1][0]
+            self._record_offset += (last - first) + self.interval
+            self._position = 0
+
+        record_time, name = self._members[self._position]
+        self._position += 1
+        self._pace(record_time + self._record_offset)
+
+        arrays = self._load(name)
+        self._count += 1
+        stamp = TIMESTAMP_PATTERN.search(os.path.basename(name))
+        frame = self._frame(arrays, stamp.group(0) if stamp else None)
+        # replayed frames keep the recording's clock so the sensors of a session line up
+        frame["t_mono"] = record_time + self._record_offset
+        return frame
+
+
+def open_replay_sources(path: str, rate: Optional[float] = 1.0, loop: bool = False,
+                        sensors=("thermal", "depth", "rgb"), images: bool = False) -> Dict[str, ReplaySource]:
+    """Creates one replay source per sensor for a recorded session.
+
+    Args:
+        path (str): session directory (e.g. "data") or tar archive
+        rate (float, optional): replay rate, see ReplaySource
+        loop (bool): replay the session over and over for load tests
+        sensors (tuple): sensors to create sources for
+        images (bool): replay rendered images when there are no raw captures, see ReplaySource
+
+    Returns:
+        Dict[str, ReplaySource]: sources keyed by sensor name
+    """
+    return {sensor: ReplaySource(sensor, path, rate=rate, loop=loop, images=images) for sensor in sensors}
@@ -0,0 +1,248 @@
+"""
+Random access to a capture session by sensor and time.
+
+SessionReader opens either a recorded session (see session_recorder.py) or an
+older data directory of one .npz per frame, and answers time queries from an
+index instead of listing directories and parsing file names every time.
+
+    session = SessionReader("data/session_17-39")
+    for frame in session.frames("thermal", t_start, t_end):
+        ...
+    stack = session.window("depth", t_start, t_start + 2.0)   # {"depth": (N, H, W), ...}
+    for t, stack in session.windows("depth", width=1.0, step=0.5):
+        ...
+
+Two clocks are kept per frame. times(), frames(), window() and windows() use
+"t_mono", the clock the frames were synchronised on: the capture's monotonic
+clock for live recordings, seconds since midnight for .npz directories and
+recordings of a replay, so these only compare within one session.
+clock_times() and clock_range() use the time of day of the capture in seconds
+since midnight for every kind of session, the same time as the file names and
+the --start/--end options of the processing scripts.
+
+Recorded sessions are memory-mapped, so frames and windows that fall inside one
+uncompressed chunk are views into the file and a 30 minute sweep never has to
+fit in RAM. For older .npz directories the file names are parsed once and the
+index is saved next to the data (.session_index.npz) for the next run.
+"""
+import json
+import os
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from sensor_sources import SENSOR_PREFIXES, parse_timestamp
+from session_recorder import SensorReader
+
+INDEX_FILE = ".session_index.npz"
+
+
+def stack_frames(reader, start: int, stop: int) -> Dict[str, np.ndarray]:
+    """Copies frames start..stop-1 of a reader into one array per key."""
+    stack = {}
+    for n, i in enumerate(range(start, stop)):
+        for key, value in reader[i].items():
+            if n == 0:
+                stack[key] = np.empty((stop - start,) + value.shape, dtype=value.dtype)
+            stack[key][n] = value
+    return stack
+
+
+class _NpzSensor:
+    """Index over a directory of .npz captures of one sensor."""
+
+    def __init__(self, sensor: str, names: List[str], times: np.ndarray):
+        order = np.argsort(times, kind="stable")
+        self.sensor = sensor
+        self.names = [names[i] for i in order]
+        self.t_mono = np.asarray(times, dtype=np.float64)[order]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, i: int) -> Dict[str, np.ndarray]:
+        with np.load(self.names[i]) as data:
+            return {key: data[key] for key in data.files}
+
+    def time_range(self, t_start: float, t_end: float) -> range:
+        return range(int(np.searchsorted(self.t_mono, t_start, side="left")),
+                     int(np.searchsorted(self.t_mono, t_end, side="left")))
+
+    def window(self, start: int, stop: int) -> Dict[str, np.ndarray]:
+        return stack_frames(self, start, stop)
+
+
+def _index_npz_directory(path: str) -> Dict[str, _NpzSensor]:
+    """Builds (or loads the saved) time index of a directory of .npz captures."""
+    index_path = os.path.join(path, INDEX_FILE)
+    files = []
+    for root, _, names in os.walk(path):
+        files.extend(os.path.join(root, name) for name in names if name.endswith(".npz") and name != INDEX_FILE)
+    files.sort()
+
+    # the saved index is valid as long as the set of files is the same
+    if os.path.exists(index_path):
+        with np.load(index_path, allow_pickle=False) as saved:
+            if list(saved["files"]) == [os.path.relpath(f, path) for f in files]:
+                return {
+                    str(sensor): _NpzSensor(str(sensor), [os.path.join(path, f) for f in saved[f"{sensor}_files"]],
+                                            saved[f"{sensor}_times"])
+                    for sensor in saved["sensors"]
+                }
+
+    sensors = {}
+    for sensor, prefixes in SENSOR_PREFIXES.items():
+        names, times = [], []
+        for name in files:
+            if os.path.basename(name).startswith(prefixes):
+                stamp = parse_timestamp(name)
+                if stamp is not None:
+                    names.append(name)
+                    times.append(stamp)
+        if names:
+            sensors[sensor] = _NpzSensor(sensor, names, np.array(times))
+
+    arrays = {
+        "files": np.array([os.path.relpath(f, path) for f in files]),
+        "sensors": np.array(list(sensors)),
+    }
+    for sensor, index in sensors.items():
+        arrays[f"{sensor}_files"] = np.array([os.path.relpath(f, path) for f in index.names])
+        arrays[f"{sensor}_times"] = index.t_mono
+    try:
+        np.savez(index_path, **arrays)
+    except OSError:
+        pass  # read-only data, the index is rebuilt next time
+    return sensors
+
+
+class SessionReader:
+    """Time indexed access to the frames of every sensor of a session."""
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): recorded session directory (with session.json) or a data
+                directory of .npz captures
+        """
+        self.path = path
+        if os.path.exists(os.path.join(path, "session.json")):
+            with open(os.path.join(path, "session.json")) as f:
+                sensors = json.load(f)["sensors"]
+            self._sensors = {sensor: SensorReader(path, sensor) for sensor in sensors}
+            self.recorded = True
+        else:
+            self._sensors = _index_npz_directory(path)
+            self.recorded = False
+
+    @property
+    def sensors(self) -> List[str]:
+        return list(self._sensors)
+
+    def __len__(self) -> int:
+        return sum(len(sensor) for sensor in self._sensors.values())
+
+    def count(self, sensor: str) -> int:
+        return len(self._sensors[sensor])
+
+    def times(self, sensor: str) -> np.ndarray:
+        """The "t_mono" of every frame of a sensor, in order, see the module docstring."""
+        return self._sensors[sensor].t_mono
+
+    def clock_times(self, sensor: str) -> np.ndarray:
+        """Time of day of every frame of a sensor in seconds since midnight, as in the file names."""
+        reader = self._sensors[sensor]
+        if not self.recorded:
+            return reader.t_mono
+        # recorded t_mono may be the capture's monotonic clock, the wall clock of the capture is not
+        wall = reader.index["t_wall"]
+        if len(wall) == 0:
+            return wall
+        midnight = datetime.fromtimestamp(float(wall[0])).replace(hour=0, minute=0, second=0, microsecond=0)
+        return wall - midnight.timestamp()
+
+    def clock_range(self, sensor: str, t_start: Optional[float] = None, t_end: Optional[float] = None) -> range:
+        """Indices of the frames of a sensor with t_start <= time of day < t_end, see clock_times().
+
+        Args:
+            sensor (str): sensor to read
+            t_start (float, optional): first time of day in seconds since midnight, defaults to the first frame
+            t_end (float, optional): frames at or after this time of day are left out, defaults to none
+
+        Returns:
+            range: frame indices for frame() and slice()
+        """
+        clock = self.clock_times(sensor)
+        first = 0 if t_start is None else int(np.searchsorted(clock, t_start, side="left"))
+        last = len(clock) if t_end is None else int(np.searchsorted(clock, t_end, side="left"))
+        return range(first, max(first, last))
+
+    def span(self) -> Tuple[float, float]:
+        """First and last timestamp over all sensors."""
+        times = [s.t_mono for s in self._sensors.values() if len(s)]
+        if not times:
+            return 0.0, 0.0
+        return min(float(t[0]) for t in times), max(float(t[-1]) for t in times)
+
+    def frame(self, sensor: str, i: int) -> Dict:
+        """Frame i of a sensor as a frame dictionary."""
+        reader = self._sensors[sensor]
+        return {"sensor": sensor, "t_mono": float(reader.t_mono[i]), "arrays": reader[i]}
+
+    def nearest(self, sensor: str, t: float) -> Optional[Dict]:
+        """The frame of a sensor closest to time t."""
+        times = self.times(sensor)
+        if len(times) == 0:
+            return None
+        i = int(np.searchsorted(times, t))
+        if i == len(times) or (i > 0 and t - times[i - 1] <= times[i] - t):
+            i -= 1
+        return self.frame(sensor, i)
+
+    def frames(self, sensor: str, t_start: float = -np.inf, t_end: float = np.inf) -> Iterator[Dict]:
+        """Frames of a sensor with t_start <= t_mono < t_end, read one at a time."""
+        for i in self._sensors[sensor].time_range(t_start, t_end):
+            yield self.frame(sensor, i)
+
+    def window(self, sensor: str, t_start: float, t_end: float) -> Dict[str, np.ndarray]:
+        """Frames of a time range stacked per array, plus their "t_mono".
+
+        Windows inside one uncompressed chunk of a recorded session are views
+        into the memory-mapped file; anything else is copied into new arrays.
+        """
+        indices = self._sensors[sensor].time_range(t_start, t_end)
+        return self.slice(sensor, indices.start, indices.stop)
+
+    def slice(self, sensor: str, start: int, stop: int) -> Dict[str, np.ndarray]:
+        """Frames start..stop-1 of a sensor stacked per array, see window()."""
+        reader = self._sensors[sensor]
+        stop = min(stop, len(reader))
+        start = min(start, stop)
+        stack = reader.window(start, stop)
+        stack["t_mono"] = reader.t_mono[start:stop]
+        return stack
+
+    def windows(self, sensor: str, width: float, step: Optional[float] = None,
+                t_start: Optional[float] = None, t_end: Optional[float] = None) -> Iterator[Tuple[float, Dict]]:
+        """Sliding windows over a sensor's frames.
+
+        Args:
+            sensor (str): sensor to read
+            width (float): window length in seconds
+            step (float, optional): seconds between window starts, defaults to width
+            t_start (float, optional): first window start, defaults to the first frame
+            t_end (float, optional): no window starts at or after this time
+
+        Yields:
+            Tuple[float, Dict]: window start time and the stacked frames, see window()
+        """
+        times = self.times(sensor)
+        if len(times) == 0:
+            return
+        step = width if step is None else step
+        t = float(times[0]) if t_start is None else t_start
+        end = float(times[-1]) + 1e-9 if t_end is None else t_end
+        while t < end:
+            yield t, self.window(sensor, t, t + width)
+            t += step
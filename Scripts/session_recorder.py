@@ -0,0 +1,382 @@
+"""
+Chunked, append-only recording format for capture sessions.
+
+A session is a directory with a handful of files instead of one .npz per frame:
+
+    session/
+        session.json          sensors and the layout of their frames
+        thermal.frames        chunks of frames, written back to back
+        thermal.chunks        one record per chunk (offset, size, frames, compression)
+        thermal.index         one record per frame (monotonic time, wall clock time)
+        depth.frames ...
+
+Inside a chunk every array is stored as one column, e.g. all depth frames of
+the chunk followed by all their confidence frames. Frames are buffered in a
+preallocated chunk and written with a single sequential write when the chunk
+is full; a chunk holds at most 32 frames and 8 MiB by default, so a sensor
+with large frames buffers fewer of them and memory stays bounded on the Pi. Chunks can optionally be compressed with zlib (level 1 by default).
+
+    recorder = SessionRecorder("data/session_17-39", compression="zlib")
+    recorder.write(frame)            # frames from a SensorSource
+    recorder.close()
+
+    reader = SensorReader("data/session_17-39", "depth")
+    arrays = reader[120]             # np.memmap views for uncompressed chunks
+    frames = reader.time_range(t0, t1)
+"""
+import json
+import os
+import threading
+import queue
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import numpy as np
+
+from frame_transport import HOLD_SINK
+from pipeline_metrics import NULL_METRICS
+from sensor_sources import parse_timestamp
+
+CHUNK_DTYPE = np.dtype([
+    ("offset", "<u8"),       # byte offset of the chunk in <sensor>.frames
+    ("nbytes", "<u8"),       # bytes stored
+    ("frames", "<u4"),       # frames in the chunk
+    ("compressed", "u1"),    # 1 if the chunk is zlib compressed
+])
+
+INDEX_DTYPE = np.dtype([
+    ("t_mono", "<f8"),       # monotonic time of the frame
+    ("t_wall", "<f8"),       # wall clock time (time.time()) the frame was captured at
+])
+
+FORMAT_VERSION = 1
+
+
+def _layout(arrays: Dict[str, np.ndarray]) -> Dict:
+    return {key: [list(value.shape), value.dtype.str] for key, value in arrays.items()}
+
+
+def capture_time(timestamp: Optional[str], now: Optional[float] = None) -> float:
+    """Wall clock time of a frame from its "%H-%M-%S.mmm" timestamp.
+
+    The timestamp only holds the time of day, the date is the one of `now` that
+    puts the capture closest to it, so a frame taken just before midnight and
+    written just after keeps its day.
+
+    Args:
+        timestamp (str, optional): the frame's "timestamp"
+        now (float, optional): time.time() of the write, the default
+
+    Returns:
+        float: seconds since the epoch, `now` when there is no timestamp
+    """
+    now = time.time() if now is None else now
+    seconds = parse_timestamp(timestamp) if timestamp else None
+    if seconds is None:
+        return now
+    today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+    candidates = [(today + timedelta(days=days, seconds=seconds)).timestamp() for days in (-1, 0, 1)]
+    return min(candidates, key=lambda t: abs(t - now))
+
+
+class _SensorWriter:
+    """Buffers the frames of one sensor into chunks and appends them to its files."""
+
+    def __init__(self, directory: str, sensor: str, layout: Dict, chunk_frames: int, chunk_bytes: int,
+                 compression: Optional[str], level: int, fsync: bool):
+        self.sensor = sensor
+        self.layout = layout
+        frame_nbytes = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in layout.values())
+        self.chunk_frames = max(1, min(chunk_frames, chunk_bytes // max(frame_nbytes, 1)))
+        self.compression = compression
+        self.level = level
+        self.fsync = fsync
+
+        # preallocated columns of the chunk being filled
+        self._columns = {key: np.empty((self.chunk_frames,) + tuple(shape), dtype=dtype)
+                         for key, (shape, dtype) in layout.items()}
+        self._index = np.empty(self.chunk_frames, dtype=INDEX_DTYPE)
+        self._count = 0
+
+        base = os.path.join(directory, sensor)
+        self._frames_file = open(base + ".frames", "ab")
+        self._chunks_file = open(base + ".chunks", "ab")
+        self._index_file = open(base + ".index", "ab")
+        self._offset = self._frames_file.tell()
+        self.frames = 0
+
+    def write(self, arrays: Dict[str, np.ndarray], t_mono: float, t_wall: float):
+        for key, column in self._columns.items():
+            column[self._count] = arrays[key]
+        self._index[self._count] = (t_mono, t_wall)
+        self._count += 1
+        self.frames += 1
+        if self._count == self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered frames as one chunk."""
+        n = self._count
+        if n == 0:
+            return
+        payload = b"".join(memoryview(np.ascontiguousarray(column[:n])).cast("B")
+                           for column in self._columns.values())
+        compressed = self.compression == "zlib"
+        if compressed:
+            payload = zlib.compress(payload, self.level)
+
+        self._frames_file.write(payload)
+        chunk = np.array([(self._offset, len(payload), n, compressed)], dtype=CHUNK_DTYPE)
+        self._offset += len(payload)
+
+        # data first, then the records pointing at it, so a crash leaves no dangling record
+        self._frames_file.flush()
+        self._index_file.write(self._index[:n].tobytes())
+        self._index_file.flush()
+        self._chunks_file.write(chunk.tobytes())
+        self._chunks_file.flush()
+        if self.fsync:
+            for f in (self._frames_file, self._index_file, self._chunks_file):
+                os.fsync(f.fileno())
+        self._count = 0
+
+    def close(self):
+        self.flush()
+        for f in (self._frames_file, self._chunks_file, self._index_file):
+            f.close()
+
+
+class SessionRecorder:
+    """Records frames of any number of sensors into a session directory."""
+
+    def __init__(self, directory: str, chunk_frames: int = 32, chunk_bytes: int = 8 << 20, compression: Optional[str] = None,
+                 level: int = 1, fsync: bool = False):
+        """
+        Args:
+            directory (str): session directory, created if needed
+            chunk_frames (int): most frames per chunk
+            chunk_bytes (int): most uncompressed bytes per chunk, at least one frame per chunk
+            compression (str, optional): None or "zlib"
+            level (int): zlib compression level, 1 is the fastest
+            fsync (bool): fsync the files after every chunk
+        """
+        if compression not in (None, "zlib"):
+            raise ValueError(f"Unknown compression: {compression}")
+        self.directory = directory
+        self.chunk_frames = chunk_frames
+        self.chunk_bytes = chunk_bytes
+        self.compression = compression
+        self.level = level
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+        self._meta_path = os.path.join(directory, "session.json")
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"version": FORMAT_VERSION, "created": time.time(), "sensors": {}}
+        self._writers: Dict[str, _SensorWriter] = {}
+
+    def _writer(self, sensor: str, arrays: Dict[str, np.ndarray]) -> _SensorWriter:
+        writer = self._writers.get(sensor)
+        if writer is None:
+            layout = _layout(arrays)
+            known = self.meta["sensors"].get(sensor)
+            if known is not None and known["layout"] != layout:
+                raise ValueError(f"{sensor} frames do not match the recorded layout {known['layout']}")
+            self.meta["sensors"][sensor] = {"layout": layout}
+            self._save_meta()
+            writer = _SensorWriter(self.directory, sensor, layout, self.chunk_frames, self.chunk_bytes,
+                                   self.compression, self.level, self.fsync)
+            self._writers[sensor] = writer
+        return writer
+
+    def _save_meta(self):
+        with open(self._meta_path, "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+    def write(self, frame: Dict, arrays: Optional[Dict[str, np.ndarray]] = None):
+        """Appends a frame.
+
+        Args:
+            frame (Dict): frame with "sensor", "t_mono" and "arrays" keys, its
+                "timestamp" is recorded as the wall clock time of the capture
+            arrays (Dict, optional): arrays to record instead of frame["arrays"]
+        """
+        arrays = frame["arrays"] if arrays is None else arrays
+        t_wall = capture_time(frame.get("timestamp"))
+        self._writer(frame["sensor"], arrays).write(arrays, frame["t_mono"], t_wall)
+
+    def flush(self):
+        for writer in self._writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+
+class SessionSink:
+    """Records frames from the shared memory rings on a background thread.
+
+    Drop-in replacement for frame_transport.AsyncNpzSink: the ring slot is
+    copied into the recorder's chunk buffer and released straight away.
+    """
+
+    def __init__(self, recorder: SessionRecorder, max_pending: int = 16, metrics=None):
+        self.recorder = recorder
+        self.metrics = metrics or NULL_METRICS
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, descriptor: Dict) -> bool:
+        try:
+            self._queue.put_nowait(descriptor)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            self.metrics.count("save_dropped", descriptor["sensor"])
+            descriptor["ring"].release(descriptor["slot"], HOLD_SINK)
+            return False
+
+    def _run(self):
+        while True:
+            descriptor = self._queue.get()
+            if descriptor is None:
+                return
+            try:
+                start = time.monotonic()
+                arrays = descriptor["ring"].read(descriptor["slot"], descriptor["seq"])
+                self.recorder.write(descriptor, arrays)
+                self.metrics.record("save", descriptor["sensor"], time.monotonic() - start)
+                self.written += 1
+            except Exception as e:
+                print(f"Error recording {descriptor['sensor']} frame: {e}")
+            finally:
+                descriptor["ring"].release(descriptor["slot"], HOLD_SINK)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.recorder.close()
+
+
+class SensorReader:
+    """Random access to the frames of one sensor of a recorded session."""
+
+    def __init__(self, directory: str, sensor: str, cache_chunks: int = 2):
+        """
+        Args:
+            directory (str): session directory
+            sensor (str): sensor to read
+            cache_chunks (int): decompressed chunks kept in memory
+        """
+        with open(os.path.join(directory, "session.json")) as f:
+            meta = json.load(f)
+        if sensor not in meta["sensors"]:
+            raise KeyError(f"No {sensor} frames in {directory}")
+        self.sensor = sensor
+        self.layout = {key: (tuple(shape), np.dtype(dtype)) for key, (shape, dtype) in meta["sensors"][sensor]["layout"].items()}
+        self._frame_bytes = {key: int(np.prod(shape)) * dtype.itemsize for key, (shape, dtype) in self.layout.items()}
+
+        base = os.path.join(directory, sensor)
+        self._frames_path = base + ".frames"
+        # ignore a partly written trailing record
+        chunks = np.fromfile(base + ".chunks", dtype=np.uint8)
+        self.chunks = chunks[:len(chunks) // CHUNK_DTYPE.itemsize * CHUNK_DTYPE.itemsize].view(CHUNK_DTYPE)
+        index = np.fromfile(base + ".index", dtype=np.uint8)
+        self.index = index[:len(index) // INDEX_DTYPE.itemsize * INDEX_DTYPE.itemsize].view(INDEX_DTYPE)
+
+        # only frames whose chunk record made it to disk are readable
+        self._chunk_start = np.concatenate([[0], np.cumsum(self.chunks["frames"], dtype=np.int64)])
+        self.index = self.index[:self._chunk_start[-1]]
+        self.t_mono = self.index["t_mono"]
+
+        self._cache: Dict[int, Dict[str, np.ndarray]] = {}
+        self._cache_chunks = cache_chunks
+        self._mmap = None
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _chunk_arrays(self, chunk: int) -> Dict[str, np.ndarray]:
+        """Column arrays of a chunk: memory-mapped, or decompressed and cached."""
+        cached = self._cache.get(chunk)
+        if cached is not None:
+            return cached
+
+        record = self.chunks[chunk]
+        n = int(record["frames"])
+        if record["compressed"]:
+            with open(self._frames_path, "rb") as f:
+                f.seek(int(record["offset"]))
+                buffer = np.frombuffer(zlib.decompress(f.read(int(record["nbytes"]))), dtype=np.uint8)
+        else:
+            if self._mmap is None or len(self._mmap) < int(record["offset"] + record["nbytes"]):
+                self._mmap = np.memmap(self._frames_path, dtype=np.uint8, mode="r")
+            buffer = self._mmap[int(record["offset"]):int(record["offset"] + record["nbytes"])]
+
+        arrays, position = {}, 0
+        for key, (shape, dtype) in self.layout.items():
+            size = n * self._frame_bytes[key]
+            arrays[key] = buffer[position:position + size].view(dtype).reshape((n,) + shape)
+            position += size
+
+        if record["compressed"]:
+            if len(self._cache) >= self._cache_chunks:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[chunk] = arrays
+        return arrays
+
+    def __getitem__(self, i: int) -> Dict[str, np.ndarray]:
+        """Arrays of frame i, views into the file or the decompressed chunk."""
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        chunk = int(np.searchsorted(self._chunk_start, i, side="right")) - 1
+        arrays = self._chunk_arrays(chunk)
+        offset = i - int(self._chunk_start[chunk])
+        return {key: value[offset] for key, value in arrays.items()}
+
+    def frame(self, i: int) -> Dict:
+        """Frame i as a frame dictionary, like the sensor sources return."""
+        return {"sensor": self.sensor, "t_mono": float(self.t_mono[i]), "arrays": self[i]}
+
+    def window(self, start: int, stop: int) -> Dict[str, np.ndarray]:
+        """Frames start..stop-1 stacked per array.
+
+        A window inside one chunk is a view of the chunk (memory-mapped when
+        uncompressed), a window across chunks is copied.
+        """
+        if start >= stop:
+            return {key: np.empty((0,) + shape, dtype=dtype) for key, (shape, dtype) in self.layout.items()}
+        chunk = int(np.searchsorted(self._chunk_start, start, side="right")) - 1
+        chunk_start = int(self._chunk_start[chunk])
+        if stop <= int(self._chunk_start[chunk + 1]):
+            return {key: column[start - chunk_start:stop - chunk_start]
+                    for key, column in self._chunk_arrays(chunk).items()}
+
+        stack = {key: np.empty((stop - start,) + shape, dtype=dtype) for key, (shape, dtype) in self.layout.items()}
+        position = start
+        while position < stop:
+            chunk = int(np.searchsorted(self._chunk_start, position, side="right")) - 1
+            chunk_start, chunk_end = int(self._chunk_start[chunk]), int(self._chunk_start[chunk + 1])
+            end = min(stop, chunk_end)
+            for key, column in self._chunk_arrays(chunk).items():
+                stack[key][position - start:end - start] = column[position - chunk_start:end - chunk_start]
+            position = end
+        return stack
+
+    def time_range(self, t_start: float, t_end: float):
+        """Frame indices with t_start <= t_mono < t_end."""
+        start = int(np.searchsorted(self.t_mono, t_start, side="left"))
+        end = int(np.searchsorted(self.t_mono, t_end, side="left"))
+        return range(start, end)
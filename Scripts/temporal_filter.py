@@ -0,0 +1,231 @@
+"""
+Streaming temporal denoising of the thermal and depth frames.
+
+The 24x32 thermal frames flicker by a few tenths of a degree from frame to
+frame and single ToF frames are speckled, so thresholds on either (hotspots,
+depth anomalies) come and go between frames. The filters here smooth every
+pixel over time as the frames arrive, keeping only a fixed amount of state:
+
+    - EmaFilter:    exponential moving average, one state frame
+    - MedianFilter: median of the last `window` frames, a ring of frames
+
+Both work in place on preallocated arrays. Pixels that jump by more than
+`reset` (something moved in or out, the rig moved) restart from the new value
+instead of smearing, and masked pixels (e.g. low ToF confidence) keep their
+previous value instead of pulling the average towards noise.
+
+    denoise = frame_filter("depth", method="ema", alpha=0.3)
+    for frame in source:
+        arrays = denoise(frame["arrays"])      # {"depth": ..., "confidence": ...}
+
+In the harness the filter runs on the collector thread, right after the
+frame is read (see sensor_sources.PreprocessedSource), so the workers and the
+hotspot detection only ever see the stable frames.
+"""
+from typing import Dict, Optional
+
+import cv2
+import numpy as np
+
+# default filter settings per sensor
+SENSOR_FILTERS = {
+    # key filtered, key holding the confidence (None if there is none), jump that resets a pixel
+    "thermal": {"keys": ("temperature",), "confidence_key": None, "reset": 4.0},
+    "depth": {"keys": ("depth", "confidence"), "confidence_key": "confidence", "reset": 100.0},
+}
+
+
+class EmaFilter:
+    """Exponential moving average of a stream of frames."""
+
+    def __init__(self, alpha: float = 0.3, reset: Optional[float] = None):
+        """
+        Args:
+            alpha (float): weight of the newest frame, lower is smoother but lags more
+            reset (float, optional): pixels changing by more than this start over from the new value
+        """
+        self.alpha = alpha
+        self.reset = reset
+        self.state = None
+        self._frame = None
+        self._diff = None
+        self._jump = None
+
+    def _allocate(self, shape):
+        self.state = np.empty(shape, dtype=np.float32)
+        self._frame = np.empty(shape, dtype=np.float32)
+        self._diff = np.empty(shape, dtype=np.float32)
+        self._jump = np.empty(shape, dtype=bool)
+
+    def __call__(self, frame: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """Adds a frame and returns the filtered frame (the filter's state, updated in place).
+
+        Args:
+            frame (np.ndarray): new frame
+            mask (np.ndarray, optional): uint8 mask, only non-zero pixels are updated
+        """
+        if self.state is None or self.state.shape != frame.shape:
+            self._allocate(frame.shape)
+            np.copyto(self.state, frame, casting="unsafe")
+            return self.state
+
+        np.copyto(self._frame, frame, casting="unsafe")
+        if self.reset is not None:
+            cv2.absdiff(self._frame, self.state, self._diff)
+            np.greater(self._diff, self.reset, out=self._jump)
+            if mask is not None:
+                np.logical_and(self._jump, mask, out=self._jump)
+        cv2.accumulateWeighted(self._frame, self.state, self.alpha, mask)
+        if self.reset is not None:
+            np.copyto(self.state, self._frame, where=self._jump)
+        return self.state
+
+    def clear(self):
+        self.state = None
+
+
+class MedianFilter:
+    """Per-pixel median of the last `window` frames."""
+
+    def __init__(self, window: int = 5, reset: Optional[float] = None):
+        """
+        Args:
+            window (int): frames in the ring buffer, odd numbers give a true median
+            reset (float, optional): pixels changing by more than this from the current median
+                drop their history and start over from the new value
+        """
+        self.window = window
+        self.reset = reset
+        self.state = None
+        self._ring = None
+        self._count = 0
+        self._next = 0
+        self._jump = None
+        self._diff = None
+        self._masked = None
+
+    def __call__(self, frame: np.ndarray, mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """Adds a frame and returns the median frame (the filter's state, updated in place).
+
+        Args:
+            frame (np.ndarray): new frame
+            mask (np.ndarray, optional): uint8 mask, masked out pixels repeat their current median
+        """
+        if self._ring is None or self._ring.shape[1:] != frame.shape:
+            self._ring = np.empty((self.window,) + frame.shape, dtype=np.float32)
+            self.state = np.empty(frame.shape, dtype=np.float32)
+            self._jump = np.empty(frame.shape, dtype=bool)
+            self._diff = np.empty(frame.shape, dtype=np.float32)
+            self._masked = np.empty(frame.shape, dtype=bool)
+            self._count = self._next = 0
+
+        slot = self._ring[self._next]
+        np.copyto(slot, frame, casting="unsafe")
+        if self._count:
+            if mask is not None:
+                np.equal(mask, 0, out=self._masked)
+                np.copyto(slot, self.state, where=self._masked)
+            if self.reset is not None:
+                # a jump replaces the whole history of the pixel with the new value
+                cv2.absdiff(slot, self.state, self._diff)
+                np.greater(self._diff, self.reset, out=self._jump)
+                np.copyto(self._ring[:self._count], slot, where=self._jump)
+
+        self._next = (self._next + 1) % self.window
+        self._count = min(self._count + 1, self.window)
+        np.median(self._ring[:self._count], axis=0, out=self.state)
+        return self.state
+
+    def clear(self):
+        self._count = self._next = 0
+
+
+class FrameFilter:
+    """Temporal filters applied to the arrays of one sensor's frames.
+
+    The filtered arrays are copied, in the input's dtype, into a small ring of
+    output buffers reused `buffers` frames later (like ThermalSource), so a frame
+    can be published or queued without the next one overwriting it.
+    """
+
+    def __init__(self, filters: Dict[str, object], confidence_key: Optional[str] = None,
+                 confidence_value: float = 30, buffers: int = 4):
+        """
+        Args:
+            filters (Dict[str, object]): array key -> EmaFilter or MedianFilter
+            confidence_key (str, optional): array whose value decides which pixels are updated
+            confidence_value (float): pixels below this confidence keep their filtered value
+            buffers (int): output buffers reused in turn
+        """
+        self.filters = filters
+        self.confidence_key = confidence_key
+        self.confidence_value = confidence_value
+        self._buffers: Dict[str, np.ndarray] = {}
+        self._count = buffers
+        self._next = 0
+        self._mask = None
+
+    def __call__(self, arrays: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        mask = None
+        if self.confidence_key is not None and self.confidence_key in arrays:
+            confidence = np.ascontiguousarray(arrays[self.confidence_key], dtype=np.float32)
+            if self._mask is None or self._mask.shape != confidence.shape:
+                self._mask = np.empty(confidence.shape, dtype=np.uint8)
+            mask = cv2.compare(confidence, self.confidence_value, cv2.CMP_GE, self._mask)
+
+        result = dict(arrays)
+        for key, temporal in self.filters.items():
+            if key not in arrays:
+                continue
+            # the confidence itself is always averaged, otherwise it could never recover
+            filtered = temporal(arrays[key], None if key == self.confidence_key else mask)
+            # outputs keep the sensor's dtype, so the rest of the pipeline sees the usual frames
+            dtype = arrays[key].dtype
+            buffers = self._buffers.get(key)
+            if buffers is None or buffers.shape[1:] != filtered.shape or buffers.dtype != dtype:
+                buffers = self._buffers[key] = np.empty((self._count,) + filtered.shape, dtype=dtype)
+            out = buffers[self._next]
+            if np.issubdtype(dtype, np.integer):
+                np.add(filtered, 0.5, out=out, casting="unsafe")   # rounds, the values are never negative
+            else:
+                np.copyto(out, filtered, casting="unsafe")
+            result[key] = out
+        self._next = (self._next + 1) % self._count
+        return result
+
+    def clear(self):
+        for temporal in self.filters.values():
+            temporal.clear()
+
+
+def frame_filter(sensor: str, method: str = "ema", alpha: float = 0.3, window: int = 5,
+                 reset: Optional[float] = -1, confidence_value: float = 30) -> FrameFilter:
+    """Builds the temporal filter of a sensor's frames.
+
+    Args:
+        sensor (str): "thermal" or "depth"
+        method (str): "ema" or "median"
+        alpha (float): EMA weight of the newest frame
+        window (int): median window in frames
+        reset (float, optional): jump that restarts a pixel, the sensor's default if -1, never if None
+        confidence_value (float): depth pixels below this confidence are not updated
+
+    Returns:
+        FrameFilter: callable taking and returning a frame's arrays
+    """
+    if sensor not in SENSOR_FILTERS:
+        raise ValueError(f"No temporal filter for sensor type: {sensor}")
+    settings = SENSOR_FILTERS[sensor]
+    if reset == -1:
+        reset = settings["reset"]
+
+    filters = {}
+    for key in settings["keys"]:
+        jump = None if key == settings["confidence_key"] else reset
+        if method == "ema":
+            filters[key] = EmaFilter(alpha, jump)
+        elif method == "median":
+            filters[key] = MedianFilter(window, jump)
+        else:
+            raise ValueError(f"Unknown filter method: {method}")
+    return FrameFilter(filters, settings["confidence_key"], confidence_value)
@@ -0,0 +1,209 @@
+"""
+Thermal frame rendering without matplotlib.
+
+ThermalRenderer turns a 24x32 MLX90640 temperature frame into a colour image
+with a colorbar using a precomputed colour lookup table and OpenCV. Everything
+that does not change between frames (the LUT, the colorbar gradient, the
+canvas) is built once and reused, so rendering a frame costs one normalization,
+one resize and one table lookup.
+
+    renderer = ThermalRenderer(scale=20, interpolation="bilinear")
+    image = renderer.render(temperature)     # BGR uint8, ready for cv2.imwrite
+
+PublicationRenderer keeps the original matplotlib figure (12x7in, 300 dpi,
+plasma colormap) for images that go into reports. matplotlib is only imported
+when it is used.
+"""
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+# OpenCV colormaps matching the matplotlib names used in the scripts
+COLORMAPS = {
+    "plasma": cv2.COLORMAP_PLASMA,
+    "inferno": cv2.COLORMAP_INFERNO,
+    "magma": cv2.COLORMAP_MAGMA,
+    "viridis": cv2.COLORMAP_VIRIDIS,
+    "jet": cv2.COLORMAP_JET,
+    "rainbow": cv2.COLORMAP_RAINBOW,
+}
+
+INTERPOLATIONS = {
+    "nearest": cv2.INTER_NEAREST,
+    "bilinear": cv2.INTER_LINEAR,
+}
+
+# same background the matplotlib figures were saved with (#FCFCFC)
+BACKGROUND = (252, 252, 252)
+TEXT_COLOR = (40, 40, 40)
+
+
+def colormap_lut(name: str = "plasma") -> np.ndarray:
+    """Returns the 256 entry BGR lookup table of a colormap, shape (256, 1, 3)."""
+    return cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), COLORMAPS[name])
+
+
+class ThermalRenderer:
+    """Renders temperature frames into a persistent canvas."""
+
+    def __init__(self, shape: Tuple[int, int] = (24, 32), scale: int = 20,
+                 interpolation: str = "nearest", colormap: str = "plasma", flip: bool = True,
+                 colorbar: bool = True, vmin: Optional[float] = None, vmax: Optional[float] = None,
+                 ticks: int = 5):
+        """
+        Args:
+            shape (Tuple[int, int]): (rows, cols) of the temperature frames
+            scale (int): upscaling factor of the heat map
+            interpolation (str): "nearest" or "bilinear" upscaling
+            colormap (str): name of the colormap, see COLORMAPS
+            flip (bool): flip the frame left to right like the original plots
+            colorbar (bool): draw a colorbar with temperature ticks next to the heat map
+            vmin (float, optional): fixed lower bound in C, frame minimum if None
+            vmax (float, optional): fixed upper bound in C, frame maximum if None
+            ticks (int): number of temperature labels on the colorbar
+        """
+        self.shape = shape
+        self.scale = scale
+        self.interpolation = INTERPOLATIONS[interpolation]
+        self.lut = colormap_lut(colormap)
+        self.flip = flip
+        self.colorbar = colorbar
+        self.vmin = vmin
+        self.vmax = vmax
+        self.ticks = ticks
+
+        rows, cols = shape
+        self.map_size = (cols * scale, rows * scale)  # (width, height) for cv2
+
+        # preallocated per-frame buffers
+        self._index = np.empty(shape, dtype=np.uint8)
+        self._index_large = np.empty((self.map_size[1], self.map_size[0]), dtype=np.uint8)
+        self._heatmap = np.empty((self.map_size[1], self.map_size[0], 3), dtype=np.uint8)
+
+        self._build_canvas()
+
+    def _build_canvas(self):
+        """Builds the parts of the output that are the same for every frame."""
+        width, height = self.map_size
+        self.pad = 10
+        self.bar_width = 20 if self.colorbar else 0
+        self.label_width = 80 if self.colorbar else 0
+        gap = self.pad if self.colorbar else 0
+
+        canvas_width = self.pad + width + gap + self.bar_width + self.label_width
+        canvas_height = height + 2 * self.pad
+        self.template = np.empty((canvas_height, canvas_width, 3), dtype=np.uint8)
+        self.template[:] = BACKGROUND
+
+        # heat map position inside the canvas
+        self._map_view = (slice(self.pad, self.pad + height), slice(self.pad, self.pad + width))
+
+        if self.colorbar:
+            # vertical gradient, hottest at the top like the matplotlib colorbar
+            gradient = np.linspace(255, 0, height).astype(np.uint8).reshape(height, 1)
+            bar = cv2.applyColorMap(np.repeat(gradient, self.bar_width, axis=1), self.lut)
+            bar_x = self.pad + width + gap
+            self.template[self.pad:self.pad + height, bar_x:bar_x + self.bar_width] = bar
+            cv2.rectangle(self.template, (bar_x, self.pad), (bar_x + self.bar_width - 1, self.pad + height - 1),
+                          TEXT_COLOR, 1)
+            self._label_x = bar_x + self.bar_width + 6
+            self._label_view = (slice(0, canvas_height), slice(bar_x + self.bar_width + 1, canvas_width))
+            self._tick_y = np.linspace(self.pad, self.pad + height - 1, self.ticks).round().astype(int)
+            for y in self._tick_y:
+                cv2.line(self.template, (bar_x + self.bar_width, y), (bar_x + self.bar_width + 3, y), TEXT_COLOR, 1)
+
+        self.canvas = self.template.copy()
+
+    def _clim(self, temperature: np.ndarray) -> Tuple[float, float]:
+        vmin = float(temperature.min()) if self.vmin is None else self.vmin
+        vmax = float(temperature.max()) if self.vmax is None else self.vmax
+        if vmax <= vmin:
+            vmax = vmin + 1e-3  # flat frame, avoid dividing by zero
+        return vmin, vmax
+
+    def _draw_labels(self, vmin: float, vmax: float):
+        # restore the label area from the template instead of redrawing the canvas
+        self.canvas[self._label_view] = self.template[self._label_view]
+        values = np.linspace(vmax, vmin, self.ticks)
+        for y, value in zip(self._tick_y, values):
+            cv2.putText(self.canvas, f"{value:.1f} C", (self._label_x, int(y) + 4),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.4, TEXT_COLOR, 1, cv2.LINE_AA)
+
+    def _colorize(self, temperature: np.ndarray) -> Tuple[float, float]:
+        """Fills the heat map buffer from a frame, returns the colour bounds used."""
+        frame = np.fliplr(temperature) if self.flip else temperature
+        vmin, vmax = self._clim(frame)
+
+        # temperatures -> 0..255 colour index, saturating outside the bounds
+        alpha = 255.0 / (vmax - vmin)
+        cv2.convertScaleAbs(np.clip(frame, vmin, vmax), self._index, alpha, -vmin * alpha)
+
+        # upscale the index image and look the colours up in the LUT
+        cv2.resize(self._index, self.map_size, self._index_large, interpolation=self.interpolation)
+        cv2.applyColorMap(self._index_large, self.lut, self._heatmap)
+        return vmin, vmax
+
+    def render(self, temperature: np.ndarray) -> np.ndarray:
+        """Renders a temperature frame.
+
+        Args:
+            temperature (np.ndarray): (rows, cols) temperatures in C
+
+        Returns:
+            np.ndarray: the renderer's canvas (BGR uint8), overwritten by the next call
+        """
+        vmin, vmax = self._colorize(temperature)
+        self.canvas[self._map_view] = self._heatmap
+        if self.colorbar:
+            self._draw_labels(vmin, vmax)
+        return self.canvas
+
+    def render_heatmap(self, temperature: np.ndarray) -> np.ndarray:
+        """Renders only the upscaled heat map, overwritten by the next call."""
+        self._colorize(temperature)
+        return self._heatmap
+
+
+class PublicationRenderer:
+    """The original matplotlib thermal figure, kept for report quality images.
+
+    The figure is created once and updated for every frame instead of building
+    a new figure each time.
+    """
+
+    def __init__(self, figsize: Tuple[float, float] = (12, 7), dpi: int = 300, colormap: str = "plasma"):
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+
+        self._plt = plt
+        self.dpi = dpi
+        self.fig, ax = plt.subplots(figsize=figsize)
+        self.fig.set_facecolor('#FCFCFC')
+        self.therm = ax.imshow(np.zeros((24, 32)), cmap=colormap, vmin=0, vmax=60)
+        self.cbar = self.fig.colorbar(self.therm)
+        self.cbar.set_label('Temperature [$^{\\circ}$C]', fontsize=14)
+
+    def _plot(self, temperature: np.ndarray):
+        self.therm.set_data(np.fliplr(temperature))  # Flip left to right
+        self.therm.set_clim(vmin=np.min(temperature), vmax=np.max(temperature))  # Set bounds
+        self.cbar.update_normal(self.therm)
+
+    def save(self, temperature: np.ndarray, save_path: str):
+        """Plots a frame and saves the figure."""
+        self._plot(temperature)
+        self.fig.savefig(save_path, dpi=self.dpi, facecolor='#FCFCFC', bbox_inches='tight')
+
+    def render(self, temperature: np.ndarray) -> np.ndarray:
+        """Plots a frame and returns the figure as a BGR image, e.g. for an ImageWriter.
+
+        Unlike save() the figure keeps its margins (no tight bounding box).
+        """
+        self._plot(temperature)
+        self.fig.set_dpi(self.dpi)
+        self.fig.canvas.draw()
+        return cv2.cvtColor(np.asarray(self.fig.canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
+
+    def close(self):
+        self._plt.close(self.fig)
@@ -8,32 +8,30 @@ Description:
     
     Notes:
     - Please make sure hardware contains at least 4 cores.
-    - Thermal images are not interpolated
-    - A delay of 1 second between each screenshot
+    - Thermal images are rendered with OpenCV and bilinear upscaling, add --publication for the matplotlib figures
+    - A delay of 1 second between each screenshot, or --adaptive to capture as fast as processing keeps up
+    - Frames are handed to the workers through shared memory, add --save-raw to also keep the .npz files
+      or --record <dir> to record them into a chunked session
+    - Images are encoded and written by a thread pool in each worker, --image-format png|jpeg|webp|raw
+      and --image-quality / --png-compression trade size for speed
+    - Add --metrics <file.json|file.csv> for per-stage latency histograms, --dashboard to watch them live
+    - Run with --replay <data dir or tar archive> to replay a recorded session instead of the sensors
+    - Add --preview [port] to watch the thermal/depth overlay and the rgb frames live at http://<pi>:8080/
+    - Add --config <pipeline.json> to run the stages, pools and sinks described by a config file instead
+    - Pool workers are forked from a forkserver that only imported the frame handlers, --start-method fork
+      forks them from this process instead (tests/startup_budget.py measures both)
 
 """
 # import libraries here
-try:
-    import RPi.GPIO as GPIO
-except RuntimeError:
-    print("Error importing RPi.GPIO! This is probably because you need superuser privileges.\
-          You can achieve this by using 'sudo' to run your script")
-
-# sensor libraries
-import adafruit_mlx90640 as thermal_cam
-import ArducamDepthCamera as ac
-import board
-import busio
-import picamera2 as pi_cam
-from libcamera import controls
 # data processing 
-import matplotlib.pyplot as plt
 import numpy as np
 
 # essential libraries
 import os
-import cv2
+import sys
 import time
+import argparse
+import functools
 from typing import *
 from datetime import datetime
 from pathlib import Path
@@ -42,351 +40,305 @@ from pathlib import Path
 import threading
 import multiprocessing as mp
 # from concurrent.futures import ThreadPoolExecutor, as_completed
-mp.set_start_method('fork', force=True)  # 'spawn' or 'forkserver' might also work
 
-def collect_thermal_data(mlx, queue):
-    """ Collects 10 thermal frames on a separate process
+# sensor sources (hardware SDKs are only imported by the hardware backends)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "Scripts"))
+from sensor_sources import SensorSource, ThermalSource, TofSource, RgbSource, RgbPreprocessor, PreprocessedSource, open_replay_sources
+from frame_transport import FrameTransport, AsyncNpzSink
+from frame_scheduler import FrameScheduler
+from frame_handlers import read_frame, publish_frame, process_thermal_data, SENSOR_HANDLERS, SENSOR_PRIORITIES
+from session_recorder import SessionRecorder, SessionSink
+from pipeline_metrics import PipelineMetrics, MetricsDashboard, NULL_METRICS
+from image_writer import IMAGE_FORMATS, configure_writer
+from temporal_filter import frame_filter
+from rate_controller import RateController
+
+def wait(controller, sensor: str, delay: float):
+    """ Waits for the next capture, paced by the rate controller if there is one """
+    if controller is not None:
+        controller.wait(sensor)
+    else:
+        time.sleep(delay)
+
+def collect_thermal_data(source: SensorSource, queue, transport: FrameTransport, num_frames: int = 10, delay: float = 1, metrics=NULL_METRICS, controller=None):
+    """ Collects thermal frames on a separate thread
 
     Args:
+        source (SensorSource): thermal camera or a replay of a recorded session
         queue (_type_): Reference to the Concurrent Queue to add to the post processing
+        transport (FrameTransport): shared memory rings the frames are copied into
+        num_frames (int): number of frames to collect
+        delay (float): delay in seconds between frames for package movement
+        metrics (PipelineMetrics): records the capture, publish and enqueue stages
+        controller (RateController, optional): paces the captures instead of the fixed delay
     """    
-    
-    # set refresh rate
-    mlx.refresh_rate = thermal_cam.RefreshRate.REFRESH_8_HZ
-    mlx_shape = (24, 32)
-    
     try:
-        num_frames = 0
+        source.open()
+    except RuntimeError as e:
+        print(e)
+        return
+
+    try:
+        frame_count = 0
         
-        # collect 10 frames
-        while num_frames < 10:
+        # collect frames
+        while frame_count < num_frames:
             try:
-                # Setup frame for storing temperatures
-                frame = np.zeros((24 * 32,))
-                mlx.getFrame(frame) # Read MLX temperatures into frame var
-                data_array = np.reshape(frame, mlx_shape)
+                frame = read_frame(source, metrics)
+                if frame is None:
+                    break
                 print("Thermal Frame Received")
+                publish_frame(frame, queue, transport, metrics)
                 
-                # timeframe
-                now = datetime.now()
-                timestamp = now.strftime("%H-%M-%S") + f".{now.microsecond // 1000:03d}"
-                
-                # save data to .npz file
-                npz_path = (os.getcwd() + f"/data/thermal/mlx90640_{timestamp}.npz")
-                np.savez(npz_path, temperature=data_array)
-                
-                # package data dictionary
-                data = {
-                    "sensor": "thermal",
-                    "timestamp": timestamp,
-                    "path": npz_path
-                }
-                
-                # add data to process queue
-                queue.put(data)
-                
-                # put a delay for package movement
-                time.sleep(1) # 1 second
+                # put a delay for package movement, or as fast as processing keeps up
+                wait(controller, "thermal", delay)
                 
                 # increase # of frames
-                num_frames += 1
+                frame_count += 1
             except Exception as e:
                 print(f"Error: {e.args}")     
     except KeyboardInterrupt:
-        print(f"ToF Collection stopped from KeyboardInterrupt")
+        print(f"Thermal Collection stopped from KeyboardInterrupt")
+    finally:
+        source.close()
         
-def collect_tof_data(tof, queue):
-    """ Collects 10 depth frames on a separate process.
+def collect_tof_data(source: SensorSource, queue, transport: FrameTransport, num_frames: int = 10, delay: float = 1, metrics=NULL_METRICS, controller=None):
+    """ Collects depth frames on a separate thread.
 
     Args:
+        source (SensorSource): ToF camera or a replay of a recorded session
         queue (_type_): Reference to the Concurrent Queue to add to the post processing
+        transport (FrameTransport): shared memory rings the frames are copied into
+        num_frames (int): number of frames to collect
+        delay (float): delay in seconds between frames for package movement
+        metrics (PipelineMetrics): records the capture, publish and enqueue stages
+        controller (RateController, optional): paces the captures instead of the fixed delay
     """    
-    # Setup Depth Camera
-    ret = -1
-    for i in range(15):
-        try: 
-            ret = tof.open(ac.Connection.CSI, i)
-            if ret == 0: break
-        except:
-            continue
-        
-    if ret != 0:
-        print("Failed to open camera. Error code:", ret)
-        return
-
-    ret = tof.start(ac.FrameType.DEPTH)
-    if ret != 0:
-        print("Failed to start camera. Error code:", ret)
-        tof.close()
+    try:
+        source.open()
+    except RuntimeError as e:
+        print(e)
         return
+    
     try:
         frame_count = 0
-        while frame_count < 10:
-            frame = tof.requestFrame(2000) # set timeout to 2s
+        while frame_count < num_frames:
+            frame = read_frame(source, metrics)
+            if frame is None:
+                break
             print("ToF Frame received")
-            if frame is not None and isinstance(frame, ac.DepthData):
-                depth_buf = frame.depth_data
-                confidence_buf = frame.confidence_data
-                
-                # Get the timestamp
-                now = datetime.now()
-                timestamp = now.strftime("%H-%M-%S") + f".{now.microsecond // 1000:03d}"
-                
-                # save data to .npz file
-                npz_path = (os.getcwd() + f"/data/depth/tof_{timestamp}.npz")
-                np.savez(npz_path, depth=depth_buf, confidence=confidence_buf)
-                
-                # package data
-                data = {
-                    "sensor": "depth",
-                    "timestamp": timestamp,
-                    "path": npz_path
-                }
-                
-                # add to queue
-                queue.put(data)
-                
-                # put a delay for package movement
-                time.sleep(1) # 1 second
-                
-                # release frame
-                tof.releaseFrame(frame)
-                frame_count += 1
-        
-        tof.stop()
-        tof.close()
+            publish_frame(frame, queue, transport, metrics)
+            
+            # put a delay for package movement, or as fast as processing keeps up
+            wait(controller, "depth", delay)
+            frame_count += 1
     except KeyboardInterrupt:
         print(f"Depth Collection stopped from KeyboardInterrupt")
-        tof.stop()
-        tof.close()
+    finally:
+        source.close()
         
-def collect_rgb_data(cam: pi_cam.Picamera2, queue):
-    """Collects 10 RGB Frame data
+def collect_rgb_data(source: SensorSource, queue, transport: FrameTransport, num_frames: int = 10, delay: float = 1, metrics=NULL_METRICS, controller=None):
+    """Collects RGB Frame data
 
     Args:
-        cam (PiCamera2): The PiCamera object to interact with
+        source (SensorSource): PiCamera or a replay of a recorded session
         queue (MP.Queue): Multiprocessing Queue that is thread-safe
+        transport (FrameTransport): shared memory rings the frames are copied into
+        num_frames (int): number of frames to collect
+        delay (float): delay in seconds between frames for package movement
+        metrics (PipelineMetrics): records the capture, publish and enqueue stages
+        controller (RateController, optional): paces the captures instead of the fixed delay
     """
-    
-    # setup PiCamera
-    config = cam.create_still_configuration(main={"size": (1920, 1080), "format": "XRGB8888"})
-    cam.configure(config)
-    cam.start()
-    cam.set_controls({"AfMode": controls.AfModeEnum.Continuous})
-    
     try:
-        num_frame = 0
-        # capture 10 frames
-        while num_frame < 10:
-            
-            # initialize buffer
-            image_buf = np.empty((1920 * 1080 * 3,), dtype=np.uint8)
-            
-            # attempt to capture
-            image_buf = cam.capture_array("main") # attempt to capture frame into bgr format for openCV
+        source.open()
+    except RuntimeError as e:
+        print(e)
+        return
+
+    try:
+        frame_count = 0
+        # capture frames
+        while frame_count < num_frames:
+            frame = read_frame(source, metrics)
+            if frame is None:
+                break
             print(f"Image Frame Captured")
+            publish_frame(frame, queue, transport, metrics)
             
-            # reshape the image buffer into the appropriate size
-            image = image_buf.reshape((1080, 1920, 4))
-            
-            # Get the timestamp
-            now = datetime.now()
-            timestamp = now.strftime("%H-%M-%S") + f".{now.microsecond // 1000:03d}"
-            
-            # save data to .npz file
-            npz_path = (os.getcwd() + f"/data/rgb/rgb_{timestamp}.npz")
-            np.savez(npz_path, rgb=image)
-            
-            # package data
-            data = {
-                "sensor": "rgb",
-                "timestamp": timestamp,
-                "path": npz_path
-            }
-            
-            # add to queue
-            queue.put(data)
+            # put a delay for package movement, or as fast as processing keeps up
+            wait(controller, "rgb", delay)
             
-            # put a delay for package movement
-            time.sleep(1)
-            
-            num_frame += 1
-        cam.close()
+            frame_count += 1
     except KeyboardInterrupt:
         print(f"RGB Collection Stopped from KeyboardInterrupt")
-        cam.close()
-        
-def getPreviewRGB(preview: np.ndarray, confidence: np.ndarray, confidence_value: int = 30) -> np.ndarray:
-    preview = np.nan_to_num(preview)
-    preview[confidence < confidence_value] = (0, 0, 0)
-    return preview
-    
-def process_tof_data(data: Dict):
-    """Process a single NPZ file, apply image processing, and save the result."""
-    
-    # use the data packet given 
-    timestamp =  data["timestamp"]
-    folder_path, npz_file = os.path.split(data["path"])
-    
-    if npz_file.endswith('.npz'):
-        # Full file path
-        file_path = os.path.join(folder_path, npz_file)
+    finally:
+        source.close()
         
-        # Process the file and delete after saving the image
-        # Load the saved data from the .npz file
-        data = np.load(file_path)
-        depth_buf = data['depth']
-        confidence_buf = data['confidence']
-        print(f"Data loaded from: {file_path}")
-        
-        # normalize data to scale from 0 to 255 and converting it into uint8
-        depth_data_normalized = cv2.normalize(depth_buf, None, 0, 255, cv2.NORM_MINMAX)
-        depth_data_uint8 = np.uint8(depth_data_normalized)
+def process_data(queue, publication: bool = False, metrics=None, on_result=None,
+                 start_method: str = "forkserver", writer_settings: Optional[Dict] = None) -> FrameScheduler:
+    """ Starts processing Thermal, Depth, and RGB Data into images on a process pool.
+    Processing runs while the sensors are still collecting, call join() on the
+    returned scheduler after putting the sentinel on the queue.
     
-        # apply confidence mask to weed out lowe-confidence measurements from result
-        confidence_mask = confidence_buf > 0.5  # Adjust threshold as needed
-        depth_data_masked = np.copy(depth_data_uint8)
-        depth_data_masked[~confidence_mask] = 0  # Set low-confidence areas to black
-        
-        # apply color map jet with low numbers being cooler and high numbers being 
-        result_image = cv2.applyColorMap(depth_data_masked, cv2.COLORMAP_JET)
-
-        # Save the processed image
-        image_path = folder_path + '/../images'
-        # Save the processed thermal image
-        if not os.path.exists(image_path):
-            os.makedirs(image_path)
-        
-        save_path = os.path.join(image_path, f"depth_{timestamp}.png")
-        cv2.imwrite(save_path, result_image)
-        print(f"Processed tof image saved as {save_path}")
-
-        # Delete the .npz file after processing
-        # os.remove(file_path)
-        print(f"Deleted {file_path}")
+    Args:
+        queue (multiprocessing.Queue): data packets that needs to be processed
+        publication (bool): render thermal frames with matplotlib instead of OpenCV
+        metrics (PipelineMetrics, optional): record the scheduling and processing stages
+        on_result (Callable, optional): called with (frame, result) when a frame is done
+        start_method (str): how the pool workers are started, forkserver workers only load the handlers
+        writer_settings (Dict, optional): configure_writer() settings of every worker
+    """    
+    handlers = dict(SENSOR_HANDLERS)
+    if publication:
+        handlers["thermal"] = functools.partial(process_thermal_data, publication=True)
+    return FrameScheduler(handlers, priorities=SENSOR_PRIORITIES, metrics=metrics, on_result=on_result,
+                          start_method=start_method, preload=["frame_handlers"],
+                          initializer=functools.partial(configure_writer, **(writer_settings or {}))).start(queue)
 
-def process_thermal_data(data: Dict):
-    """Process thermal data and save the processed image."""
-    
-    # Iterate through all .npz files in the folder
-    timestamp =  data["timestamp"]
-    folder_path, npz_file = os.path.split(data["path"])
+def print_board_info():
+    """Prints the Raspberry Pi board information"""
+    try:
+        import RPi.GPIO as GPIO
+    except RuntimeError:
+        print("Error importing RPi.GPIO! This is probably because you need superuser privileges.\
+              You can achieve this by using 'sudo' to run your script")
+        return
     
-    if npz_file.endswith('.npz'):
-        # Full file path
-        file_path = os.path.join(folder_path, npz_file)
-        
-        # Load the saved thermal data from the .npz file
-        data = np.load(file_path)
-        temperature_data = data['temperature']
-        print(f"Data loaded from: {file_path}")
-
-        # Setup the figure for plotting
-        plt.ion()
-        fig, ax = plt.subplots(figsize=(12, 7))
-        therm1 = ax.imshow(np.zeros(temperature_data.shape), cmap='plasma', vmin=0, vmax=60)
-        cbar = fig.colorbar(therm1)
-        cbar.set_label('Temperature [$^{\circ}$C]', fontsize=14)
-
-        # Update the thermal image with the data
-        therm1.set_data(np.fliplr(temperature_data))  # Flip left to right
-        therm1.set_clim(vmin=np.min(temperature_data), vmax=np.max(temperature_data))  # Set bounds
-        cbar.update_normal(therm1)
+    print("------- Board Information -------")
+    for k,v in GPIO.RPI_INFO.items():
+        print(f"{k}: {v}")
+    print(f"GPIO Version: {GPIO.VERSION}")
+    print("------------------------------------")
 
-        image_path = folder_path + '/../images'
+def parse_size(text: str) -> Tuple[int, int]:
+    width, height = text.lower().split("x")
+    return int(width), int(height)
 
-        save_path = os.path.join(image_path, f"thermal_image_{timestamp}.png")
-        fig.savefig(save_path, dpi=300, facecolor='#FCFCFC', bbox_inches='tight')
-        print(f"Processed thermal image saved as {save_path}")
+def parse_roi(text: str) -> Tuple[int, int, int, int]:
+    x, y, width, height = (int(v) for v in text.split(","))
+    return x, y, width, height
 
-        # Close the figure to avoid memory issues
-        plt.close(fig)
+def parse_footprints(text: str) -> Dict[str, float]:
+    footprints = {}
+    for item in text.split(","):
+        sensor, meters = item.split("=")
+        footprints[sensor.strip()] = float(meters)
+    return footprints
 
-        # Delete the .npz file after processing
-        # os.remove(file_path)
-        print(f"Deleted {file_path}")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Capture frames from the thermal, ToF and RGB sensors")
+    parser.add_argument("--config", metavar="FILE",
+                        help="run the pipeline described by a JSON config instead (see Scripts/pipeline_runner.py), "
+                             "--replay, --rate and --frames still apply")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="replay a recorded session (data directory or tar archive) instead of the sensors")
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="replay rate: 1 is real time, N is N times faster, 0 is as fast as possible")
+    parser.add_argument("--loop", action="store_true", help="loop the replayed session")
+    parser.add_argument("--frames", type=int, default=10, help="number of frames per sensor")
+    parser.add_argument("--delay", type=float,
+                        help="seconds between frames for package movement (default: 1, 0 when replaying)")
+    parser.add_argument("--thermal-refresh", default="REFRESH_8_HZ",
+                        help="MLX90640 refresh rate, e.g. REFRESH_32_HZ with --delay 0 for continuous capture")
+    parser.add_argument("--slots", type=int, default=8, help="shared memory frame slots per sensor")
+    parser.add_argument("--queue-size", type=int, default=32,
+                        help="frames waiting for processing before the collectors are held back")
+    parser.add_argument("--publication", action="store_true",
+                        help="render thermal frames as 300 dpi matplotlib figures (slow)")
+    raw = parser.add_mutually_exclusive_group()
+    raw.add_argument("--save-raw", action="store_true",
+                     help="also save the raw frames as .npz files in data/<sensor>/")
+    raw.add_argument("--record", metavar="DIR",
+                     help="also record the raw frames into a chunked session directory")
+    parser.add_argument("--compress", action="store_true", help="zlib compress the recorded chunks")
+    parser.add_argument("--rgb-size", type=parse_size, metavar="WxH",
+                        help="downscale the rgb frames at capture time, e.g. 640x360")
+    parser.add_argument("--rgb-roi", type=parse_roi, metavar="X,Y,W,H",
+                        help="keep only this region of the rgb frames (pixels of the 1920x1080 still)")
+    parser.add_argument("--rgb-bgr", action="store_true", help="capture BGR frames without the alpha channel")
+    parser.add_argument("--rgb-preprocess", choices=["isp", "cpu"], default="isp",
+                        help="crop/scale in the camera ISP or on the CPU (replays always use the CPU)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adapt the capture rates to the processing backlog instead of the fixed --delay")
+    parser.add_argument("--min-rate", type=float, default=0.2, help="lowest adaptive capture rate in Hz")
+    parser.add_argument("--max-rate", type=float, default=30.0, help="highest adaptive capture rate in Hz")
+    parser.add_argument("--target-latency", type=float,
+                        help="cut the capture rate when frames take longer than this many seconds to process")
+    parser.add_argument("--speed", type=float, help="ground speed in m/s, caps the rates at the ground coverage")
+    parser.add_argument("--footprint", type=parse_footprints, default={}, metavar="SENSOR=M,...",
+                        help="along-track ground footprint of the frames in m, e.g. thermal=0.4,depth=0.5")
+    parser.add_argument("--denoise", choices=["ema", "median"],
+                        help="temporal filter of the thermal and depth frames before processing")
+    parser.add_argument("--denoise-alpha", type=float, default=0.3,
+                        help="EMA weight of the newest frame, lower is smoother (default 0.3)")
+    parser.add_argument("--denoise-window", type=int, default=5, help="median filter window in frames")
+    parser.add_argument("--image-format", choices=list(IMAGE_FORMATS), default="png",
+                        help="format of the processed images (raw saves the arrays as .npy)")
+    parser.add_argument("--image-quality", type=int, help="JPEG / WebP quality (default 90)")
+    parser.add_argument("--png-compression", type=int,
+                        help="PNG compression level 0-9 (default: OpenCV's fast setting)")
+    parser.add_argument("--writer-threads", type=int, default=2, help="image encoding threads per worker")
+    parser.add_argument("--fsync-every", type=int, default=0,
+                        help="fsync the images in batches of this many (0: leave it to the OS)")
+    parser.add_argument("--start-method", choices=mp.get_all_start_methods(), default="forkserver",
+                        help="how pool workers start: forkserver workers only import the handlers (default), "
+                             "fork copies this process")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="record per-stage latencies and queue depths, saved as JSON (or CSV for .csv)")
+    parser.add_argument("--dashboard", type=float, nargs="?", const=2.0, metavar="SECONDS",
+                        help="print the live metrics table every few seconds (default 2)")
+    parser.add_argument("--preview", type=int, nargs="?", const=8080, metavar="PORT",
+                        help="stream a live preview of the frames over HTTP on this port (default 8080)")
+    return parser.parse_args(argv)
 
-def process_rgb_data(data:Dict):
-    """Process a single NPZ file, apply iamge processing, and save the result."""
+def main(argv=None):
+    args = parse_args(argv)
     
-    # use the data packet given to the function
-    timestamp = data["timestamp"]
-    folder_path, npz_file = os.path.split(data["path"])
+    if args.config:
+        # sources, stages, pools and sinks come from the config file
+        argv = [args.config, "--frames", str(args.frames)]
+        if args.replay:
+            argv += ["--replay", args.replay, "--rate", str(args.rate)]
+        if args.delay is not None:
+            argv += ["--delay", str(args.delay)]
+        if args.preview is not None:
+            argv += ["--preview", str(args.preview)]
+        import pipeline_runner
+        return pipeline_runner.main(argv)
     
-    if npz_file.endswith('.npz'):
-        # full file path
-        file_path = os.path.join(folder_path, npz_file)
-        
-        # Process the file
-        data = np.load(file_path)
-        rgb_data = data["rgb"]
-        
-        # remove unused alpha channel and convert to BGR
-        rgb_image = cv2.cvtColor(rgb_data, cv2.COLOR_BGRA2BGR)
-        print(f"Data loaded from: {file_path}")
-        
-        # get save path
-        image_path = folder_path + '/../images'
-        save_path = os.path.join(image_path, f"rgb_{timestamp}.png")
-        
-        # convert rgb array into an image using openCV
-        cv2.imwrite(save_path, rgb_image)
-        print(f"Processed rgb image saved as {save_path}")
-        
-        # Delete the .npz file after processing
-        # os.remove(file_path)
-        print(f"Deleted {file_path}")
-        
-def process_data(queue):
-    """ Processes Thermal, Depth, and RGB Data and converts it into an image using processes
-    Args:
-        queue (multiprocessing.Queue): data packets that needs to be processed
-    """    
-    with mp.Pool(processes=mp.cpu_count() - 1) as pool:        
-        # Add tasks when queue is not empty
-        while True:
-            if not queue.empty():
-                batch = queue.get()
-                
-                # get null batch
-                if batch is None:
-                    break;
-                
-                # pushing to either one
-                type = batch["sensor"]
-                print(f"Batch type: {type}")
-                
-                
-                # transfer batch to the appropriate function
-                if type == "depth":
-                    result = pool.apply_async(process_tof_data,(batch,))
-                elif type == "thermal":
-                    result = pool.apply_async(process_thermal_data, (batch,))
-                elif type == "rgb":
-                    result = pool.apply_async(process_rgb_data, (batch,))
-                else:
-                    break;
-                
-                print(result.get(timeout=2)) 
-                      
-def main():
-    # Create device objects 
-    # Setup Thermal Camera
-    i2c = busio.I2C(board.SCL, board.SDA)
-    mlx = thermal_cam.MLX90640(i2c)
-    
-    # Setup ToF Camera
-    tof_cam = ac.ArducamCamera()
+    if args.replay:
+        # Replay a recorded session, the replay source paces the frames itself
+        sources = open_replay_sources(args.replay, rate=args.rate, loop=args.loop)
+        if args.rgb_size or args.rgb_roi or args.rgb_bgr:
+            sources["rgb"] = PreprocessedSource(sources["rgb"], RgbPreprocessor(args.rgb_roi, args.rgb_size, args.rgb_bgr))
+        delay = 0
+    else:
+        # Create device objects 
+        print_board_info()
+        sources = {
+            "thermal": ThermalSource(refresh_rate=args.thermal_refresh),
+            "depth": TofSource(),
+            "rgb": RgbSource(roi=args.rgb_roi, output_size=args.rgb_size, drop_alpha=args.rgb_bgr,
+                             mode=args.rgb_preprocess),
+        }
+        delay = 1
+    if args.delay is not None:
+        delay = args.delay
+    thermal_source = sources["thermal"]  # the sensor itself, before any wrapping below
     
-    # Setup RGB Camera
-    cam = pi_cam.Picamera2()
+    # temporal denoising on the collector threads, before the frames are published
+    if args.denoise:
+        for sensor in ("thermal", "depth"):
+            denoise = frame_filter(sensor, args.denoise, alpha=args.denoise_alpha, window=args.denoise_window)
+            sources[sensor] = PreprocessedSource(sources[sensor], denoise, key=None)
     
-    # Print System information
-    print("------- Board Information -------")
-    for k,v in GPIO.RPI_INFO.items():
-        print(f"{k}: {v}")
-    print(f"GPIO Version: {GPIO.VERSION}")
-    print("------------------------------------")
+    # live preview of the frames as they are read, never holds the collectors up
+    preview = None
+    if args.preview is not None:
+        from preview_server import PreviewServer, PreviewSource
+        preview = PreviewServer(port=args.preview).start()
+        print(f"Preview on {preview.url}")
+        sources = {sensor: PreviewSource(source, preview) for sensor, source in sources.items()}
     
     # create directories if it doesn't exists
     Path(os.getcwd() + '/data/thermal').mkdir(parents=True, exist_ok=True)
@@ -394,17 +346,46 @@ def main():
     Path(os.getcwd() + '/data/images').mkdir(parents=True, exist_ok=True)
     Path(os.getcwd() + '/data/rgb').mkdir(parents=True, exist_ok=True)
     
+    # instrumentation is off unless asked for
+    metrics = PipelineMetrics() if args.metrics or args.dashboard else NULL_METRICS
+    dashboard = MetricsDashboard(metrics, args.dashboard).start() if args.dashboard else None
+    
     # start time
     t1 = time.time()
     
-    # Create multiprocessing queue
-    queue = mp.Queue()
+    # Create bounded multiprocessing queue, collectors wait when processing falls behind
+    queue = mp.Queue(maxsize=args.queue_size)
+    
+    # Frames go through shared memory
+    sink = None
+    if args.record:
+        sink = SessionSink(SessionRecorder(args.record, compression="zlib" if args.compress else None), metrics=metrics)
+    elif args.save_raw:
+        sink = AsyncNpzSink(os.getcwd() + '/data', metrics=metrics)
+    transport = FrameTransport(slots=args.slots, sink=sink)
+    
+    # image writer settings, every worker creates its own writer with them
+    writer_settings = dict(format=args.image_format, quality=args.image_quality, compression=args.png_compression,
+                           threads=args.writer_threads, fsync_every=args.fsync_every)
+    
+    # capture as fast as processing keeps up, starting from the fixed rate
+    controller = None
+    if args.adaptive:
+        controller = RateController(SENSOR_PRIORITIES, queues={sensor: queue for sensor in SENSOR_PRIORITIES},
+                                    queue_size=args.queue_size, min_rate=args.min_rate, max_rate=args.max_rate,
+                                    start_rate=1.0 / delay if delay > 0 else args.max_rate,
+                                    target_latency=args.target_latency, footprints=args.footprint, metrics=metrics)
+        controller.set_speed(args.speed)
+    
+    # start processing before acquisition so both run at the same time
+    scheduler = process_data(queue, args.publication, metrics, controller.on_result if controller else None,
+                             args.start_method, writer_settings)
     
     # create and start threads
     sensor_threads = [
-        threading.Thread(target=collect_thermal_data, args=(mlx, queue,), daemon=True),
-        threading.Thread(target=collect_tof_data, args=(tof_cam, queue,), daemon=True),
-        threading.Thread(target=collect_rgb_data, args=(cam, queue,), daemon=True)
+        threading.Thread(target=collect_thermal_data, args=(sources["thermal"], queue, transport, args.frames, delay, metrics, controller), daemon=True),
+        threading.Thread(target=collect_tof_data, args=(sources["depth"], queue, transport, args.frames, delay, metrics, controller), daemon=True),
+        threading.Thread(target=collect_rgb_data, args=(sources["rgb"], queue, transport, args.frames, delay, metrics, controller), daemon=True)
     ]
     
     # benchmark data acquisition start
@@ -426,16 +407,17 @@ def main():
         "path": "",
     })
     
-    # benchmark processing the data
+    # benchmark processing the frames left after acquisition
     post_process_t1 = time.time()
     
-    process_data(queue)
+    stats = scheduler.join()
     
     # benchmark processing end
     post_process_total = time.time() - post_process_t1
     
     print("All Processing completed.")
     queue.close()
+    transport.close()
     
     # end time
     t2 = time.time()
@@ -443,7 +425,35 @@ def main():
     print("------- Benchamrk Results -------")
     print(f"Total time: {total:.2f}s")
     print(f"Data Acquisition Time: {data_acq_total:.2f}s")
-    print(f"Post Processing Time: {post_process_total:.2f}s")
+    print(f"Post Processing Time (after acquisition): {post_process_total:.2f}s")
+    print(f"Frames Processed: {stats['completed']} (failed {stats['failed']}, max in flight {stats['max_in_flight']})")
+    if isinstance(thermal_source, ThermalSource):
+        thermal_stats = thermal_source.stats()
+        print(f"Thermal: {thermal_stats['fps']:.2f} fps (sensor {thermal_stats['expected_fps']:.2f} fps), "
+              f"retries {thermal_stats['retries']}, dropped {thermal_stats['dropped']}, "
+              f"skipped by pacing {thermal_stats['skipped']}")
+    if sink is not None:
+        print(f"Raw Frames Saved: {sink.written} (dropped {sink.dropped})")
+    if preview is not None:
+        preview.stop()
+        print(f"Preview: {preview.encoded} frames encoded, {preview.sent} sent")
+    if controller is not None:
+        print("Capture rates: " + ", ".join(f"{sensor} {stats['rate']:.2f} Hz"
+                                            for sensor, stats in controller.stats().items()))
+    
+    if metrics.enabled:
+        metrics.stop()
+        if isinstance(thermal_source, ThermalSource):
+            metrics.count("sensor_dropped", "thermal", thermal_stats["dropped"])
+            metrics.count("sensor_skipped", "thermal", thermal_stats["skipped"])
+            metrics.count("sensor_retries", "thermal", thermal_stats["retries"])
+        if dashboard is not None:
+            dashboard.stop()
+        print("------- Pipeline Metrics (ms) -------")
+        print(metrics.format_table())
+        if args.metrics:
+            metrics.export(args.metrics)
+            print(f"Metrics saved as {args.metrics}")
     return 0;
 
 if __name__ == "__main__":
@@ -0,0 +1,427 @@
+"""
+File: benchmark_pipeline.py
+Description:
+    Benchmarks the capture and processing stages of the pipeline without the sensors, so changes in
+    frames/sec, latency or memory show up before they reach the Pi.
+
+    Notes:
+    - Every stage runs in its own forked process on synthetic frames at the real sensor sizes
+      (24x32 thermal, 180x240 depth, 1080x1920 rgb), or on archived frames with --archive
+    - Reports throughput (frames/s), p50/p99 latency and the peak RSS of each stage
+    - Run with --save-baseline once on a board, later runs compare against tests/benchmark_baseline.json
+      and exit with an error when a stage got slower or bigger than --tolerance allows
+    - Baselines are per machine, a baseline recorded on another machine is only reported, not enforced
+    - Baselines also record their input (synthetic frames or the archive, --frames), a run on other
+      frames is not compared against them
+    - No baseline is shipped, the numbers only mean something on the board they were recorded on:
+      run --save-baseline there first, until then runs only print their results
+
+"""
+# import libraries here
+import numpy as np
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+from typing import *
+from pathlib import Path
+
+import multiprocessing as mp
+
+# the Scripts modules
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "Scripts"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "Scripts" / "HotspotDetection"))
+import cv2
+from depth_anomaly import DepthAnomalyDetector
+from frame_handlers import process_thermal_data, process_tof_data, process_rgb_data
+from frame_transport import FrameTransport, release_frame
+from image_writer import shared_writer
+from pipeline_metrics import LatencyHistogram
+from process_depth_data import DepthColorizer
+from registration import Registration, SENSOR_SIZES
+from sensor_sources import ReplaySource, make_timestamp
+from thermal_hotspot import detect_hotspots, detect_hotspots_array, HotspotDetector
+from thermal_render import ThermalRenderer
+from tracker import HotspotTracker
+
+DEFAULT_BASELINE = str(Path(__file__).resolve().parent / "benchmark_baseline.json")
+
+# ------------------------------------------------------------------------------
+# Frames
+# ------------------------------------------------------------------------------
+
+def synthetic_frames(count: int, seed: int = 0) -> Dict[str, List[Dict]]:
+    """ Builds reproducible frames of every sensor at the real sensor sizes
+
+    Args:
+        count (int): frames per sensor
+        seed (int): random seed, the same seed gives the same frames
+
+    Returns:
+        Dict[str, List[Dict]]: frames keyed by sensor, same layout as a SensorSource
+    """
+    rng = np.random.default_rng(seed)
+    frames = {"thermal": [], "depth": [], "rgb": []}
+    ys, xs = np.mgrid[0:24, 0:32]
+    depth_ys = np.mgrid[0:180, 0:240][0]
+    gradient = np.linspace(0, 200, 1920, dtype=np.float32)[None, :] + np.linspace(0, 55, 1080, dtype=np.float32)[:, None]
+
+    for i in range(count):
+        timestamp = make_timestamp()
+
+        # ground at ~22 C with a couple of warm objects moving through the frame
+        temperature = 22 + rng.normal(0, 0.3, (24, 32))
+        for cx, cy in ((5 + i % 22, 8), (25, 4 + i % 16)):
+            temperature += 12 * np.exp(-((xs - cx) ** 2 + (ys - cy) ** 2) / 4.0)
+        frames["thermal"].append(frame("thermal", timestamp, i, temperature=temperature))
+
+        # ground plane about 600 mm away with a box on it, noisy low-confidence border
+        depth = 600 + 0.5 * depth_ys + rng.normal(0, 4, (180, 240))
+        depth[60:120, 80 + i % 60:140 + i % 60] -= 150
+        confidence = np.clip(rng.normal(120, 40, (180, 240)), 0, 255)
+        confidence[:, :10] = 5
+        frames["depth"].append(frame("depth", timestamp, i, depth=depth.astype(np.float32),
+                                     confidence=confidence.astype(np.float32)))
+
+        # smooth scene with sensor noise, XRGB like the PiCamera still capture
+        rgb = np.empty((1080, 1920, 4), dtype=np.uint8)
+        base = (gradient + 10 * i).astype(np.int16)
+        for c in range(3):
+            rgb[..., c] = np.clip(base + 20 * c + rng.integers(-6, 7, (1080, 1920), dtype=np.int16), 0, 255)
+        rgb[..., 3] = 255
+        frames["rgb"].append(frame("rgb", timestamp, i, rgb=rgb))
+    return frames
+
+def frame(sensor: str, timestamp: str, i: int, **arrays) -> Dict:
+    return {"sensor": sensor, "timestamp": timestamp, "t_mono": float(i), "arrays": arrays}
+
+def archived_frames(path: str, count: int) -> Dict[str, List[Dict]]:
+    """ Reads up to count frames per sensor from a recorded session or tar archive """
+    frames = {}
+    for sensor in ("thermal", "depth", "rgb"):
+        source = ReplaySource(sensor, path, rate=0, limit=count, images=True)
+        try:
+            with source:
+                frames[sensor] = list(source)
+        except FileNotFoundError:
+            frames[sensor] = []
+    return frames
+
+def thermal_images(frames: List[Dict], directory: str) -> List[str]:
+    """ Writes rendered thermal images for the image based detect_hotspots() """
+    renderer = ThermalRenderer(colormap="inferno", colorbar=False)
+    paths = []
+    for i, f in enumerate(frames):
+        path = os.path.join(directory, f"thermal_image_{i}.png")
+        if "temperature" in f["arrays"]:
+            cv2.imwrite(path, renderer.render(f["arrays"]["temperature"]))
+        elif "image" in f["arrays"]:
+            cv2.imwrite(path, f["arrays"]["image"])  # archives only hold rendered images
+        else:
+            continue
+        paths.append(path)
+    return paths
+
+# ------------------------------------------------------------------------------
+# Stages, each one returns a dictionary with
+#   - "run":      function timed once per iteration, called with the iteration number
+#   - "frames":   frames handled per call
+#   - "prepare":  optional untimed function called before each run
+#   - "close":    optional cleanup
+# ------------------------------------------------------------------------------
+
+def stage_publish(frames: Dict[str, List[Dict]], sensor: str):
+    transport = FrameTransport(slots=4)
+    items = frames[sensor]
+    def run(i):
+        release_frame(transport.publish(items[i % len(items)]))
+    return {"run": run, "frames": 1, "close": transport.close}
+
+def stage_handler(frames: Dict[str, List[Dict]], sensor: str, handler: Callable):
+    # the handler releases the slot itself, publishing happens outside the timed call;
+    # the handlers only queue the image, flushing the writer times the encode and write too
+    transport = FrameTransport(slots=4)
+    items = frames[sensor]
+    pending = {}
+    writer = shared_writer()
+    def prepare(i):
+        pending[i] = transport.publish(items[i % len(items)])
+    def run(i):
+        handler(pending.pop(i))
+        writer.flush()
+    return {"run": run, "frames": 1, "prepare": prepare, "close": transport.close}
+
+def stage_colorize_batch(frames: Dict[str, List[Dict]], batch_size: int = 64):
+    depth = np.stack([f["arrays"]["depth"] for f in frames["depth"]])
+    confidence = np.stack([f["arrays"]["confidence"] for f in frames["depth"]])
+    index = np.arange(batch_size) % len(depth)
+    depth, confidence = depth[index], confidence[index]
+    colorizer = DepthColorizer()
+    out = np.empty(depth.shape + (3,), dtype=np.uint8)
+    def run(i):
+        colorizer.colorize(depth, confidence, out)
+    return {"run": run, "frames": batch_size}
+
+def stage_depth_anomaly(frames: Dict[str, List[Dict]]):
+    detector = DepthAnomalyDetector()
+    arrays = [(f["arrays"]["depth"], f["arrays"]["confidence"]) for f in frames["depth"]]
+    def run(i):
+        detector.update(*arrays[i % len(arrays)])
+    return {"run": run, "frames": 1}
+
+def stage_detect_image(frames: Dict[str, List[Dict]], directory: str):
+    paths = thermal_images(frames["thermal"], directory)
+    def run(i):
+        detect_hotspots(paths[i % len(paths)])
+    return {"run": run, "frames": 1}
+
+def stage_detect_array(frames: Dict[str, List[Dict]]):
+    detector = HotspotDetector()
+    temperatures = [f["arrays"]["temperature"] for f in frames["thermal"]]
+    def run(i):
+        detector.detect(temperatures[i % len(temperatures)])
+    return {"run": run, "frames": 1}
+
+def stage_detect_batch(frames: Dict[str, List[Dict]], batch_size: int = 64):
+    temperatures = np.stack([f["arrays"]["temperature"] for f in frames["thermal"]])
+    batch = temperatures[np.arange(batch_size) % len(temperatures)]
+    def run(i):
+        detect_hotspots_array(batch, delta=5.0)
+    return {"run": run, "frames": batch_size}
+
+def stage_track(frames: Dict[str, List[Dict]]):
+    detector = HotspotDetector()
+    hotspots = [detector.detect(f["arrays"]["temperature"]) for f in frames["thermal"]]
+    tracker = HotspotTracker()
+    def run(i):
+        tracker.update(hotspots[i % len(hotspots)])
+    return {"run": run, "frames": 1}
+
+def stage_align(frames: Dict[str, List[Dict]], calibration: Optional[str] = None):
+    if calibration:
+        from registration import Calibration
+        registration = Calibration.load(calibration)["thermal", "depth"]
+    else:
+        registration = Registration.scaling(SENSOR_SIZES["thermal"], SENSOR_SIZES["depth"])
+    temperatures = [f["arrays"]["temperature"].astype(np.float32) for f in frames["thermal"]]
+    registration.maps  # tables are built once per run, not per frame
+    out = np.empty(SENSOR_SIZES["depth"][::-1], dtype=np.float32)
+    def run(i):
+        registration.warp(temperatures[i % len(temperatures)], dst=out)
+    return {"run": run, "frames": 1}
+
+STAGES = {
+    "publish_thermal": lambda frames, args: stage_publish(frames, "thermal"),
+    "publish_depth": lambda frames, args: stage_publish(frames, "depth"),
+    "publish_rgb": lambda frames, args: stage_publish(frames, "rgb"),
+    "process_thermal": lambda frames, args: stage_handler(frames, "thermal", process_thermal_data),
+    "process_tof": lambda frames, args: stage_handler(frames, "depth", process_tof_data),
+    "process_rgb": lambda frames, args: stage_handler(frames, "rgb", process_rgb_data),
+    "colorize_batch": lambda frames, args: stage_colorize_batch(frames),
+    "depth_anomaly": lambda frames, args: stage_depth_anomaly(frames),
+    "detect_hotspots": lambda frames, args: stage_detect_image(frames, os.getcwd()),
+    "hotspots_array": lambda frames, args: stage_detect_array(frames),
+    "hotspots_batch": lambda frames, args: stage_detect_batch(frames),
+    "track_hotspots": lambda frames, args: stage_track(frames),
+    "align": lambda frames, args: stage_align(frames, args.calibration),
+}
+
+# ------------------------------------------------------------------------------
+# Running
+# ------------------------------------------------------------------------------
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_stage(name: str, frames: Dict[str, List[Dict]], args, results):
+    """ Runs one stage in the forked process and puts its results on the queue """
+    workdir = tempfile.mkdtemp(prefix=f"benchmark_{name}_")
+    os.chdir(workdir)
+    Path("data/images").mkdir(parents=True, exist_ok=True)
+    sys.stdout = open(os.devnull, "w")  # the handlers print every saved image
+    try:
+        rss_start = peak_rss_mb()
+        stage = STAGES[name](frames, args)
+        run, per_call, prepare = stage["run"], stage["frames"], stage.get("prepare")
+
+        histogram = LatencyHistogram()
+        busy = 0.0
+        for i in range(args.warmup + args.iterations):
+            if prepare is not None:
+                prepare(i)
+            start = time.perf_counter()
+            run(i)
+            elapsed = time.perf_counter() - start
+            if i >= args.warmup:
+                histogram.record(elapsed)
+                busy += elapsed
+        if "close" in stage:
+            stage["close"]()
+
+        peak = peak_rss_mb()
+        results.put({
+            "stage": name,
+            "iterations": args.iterations,
+            "frames_per_call": per_call,
+            "fps": args.iterations * per_call / busy if busy > 0 else 0.0,
+            "p50_ms": histogram.percentile(50) * 1e3,
+            "p99_ms": histogram.percentile(99) * 1e3,
+            "mean_ms": histogram.mean * 1e3,
+            "peak_rss_mb": peak,
+            "rss_growth_mb": peak - rss_start,
+        })
+    except Exception as e:
+        results.put({"stage": name, "error": repr(e)})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_benchmarks(args) -> List[Dict]:
+    frames = synthetic_frames(args.frames, args.seed)
+    if args.archive:
+        for sensor, items in archived_frames(args.archive, args.frames).items():
+            if items and "image" not in items[0]["arrays"]:
+                frames[sensor] = items
+            elif items and sensor == "thermal":
+                # archives of rendered images can only feed the image based detection
+                frames["thermal_images"] = items
+
+    ctx = mp.get_context("fork")
+    results = []
+    for name in args.stages:
+        stage_frames = frames
+        if name == "detect_hotspots" and "thermal_images" in frames:
+            stage_frames = dict(frames, thermal=frames["thermal_images"])
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_stage, args=(name, stage_frames, args, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        results.append(result)
+    return results
+
+# ------------------------------------------------------------------------------
+# Baseline
+# ------------------------------------------------------------------------------
+
+def machine_id() -> str:
+    return f"{platform.node()} {platform.machine()} {mp.cpu_count()} cores"
+
+def input_id(args) -> Dict:
+    """ The frames a run measured, runs are only comparable on the same input """
+    if args.archive:
+        return {"archive": args.archive, "frames": args.frames}
+    return {"synthetic": True, "frames": args.frames, "seed": args.seed}
+
+def compare(results: List[Dict], baseline: Dict, tolerance: float, rss_slack: float = 16.0) -> List[str]:
+    """ Returns a message for every stage that is slower or bigger than the baseline allows
+
+    Args:
+        results (List[Dict]): results of this run
+        baseline (Dict): saved results, see --save-baseline
+        tolerance (float): allowed relative change, 0.25 is 25 %
+        rss_slack (float): allowed peak RSS growth in MB on top of the tolerance
+    """
+    saved = {r["stage"]: r for r in baseline["results"] if "error" not in r}
+    regressions = []
+    for result in results:
+        before = saved.get(result["stage"])
+        if before is None or "error" in result:
+            continue
+        name = result["stage"]
+        if result["fps"] < before["fps"] / (1 + tolerance):
+            regressions.append(f"{name}: {result['fps']:.1f} frames/s, baseline {before['fps']:.1f}")
+        if result["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {result['p50_ms']:.2f} ms, baseline {before['p50_ms']:.2f} ms")
+        if result["p99_ms"] > before["p99_ms"] * (1 + 2 * tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']:.2f} ms, baseline {before['p99_ms']:.2f} ms")
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance) + rss_slack:
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mb']:.0f} MB, baseline {before['peak_rss_mb']:.0f} MB")
+    return regressions
+
+def print_results(results: List[Dict]):
+    print(f"{'stage':<18}{'frames/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>10}{'+MB':>8}")
+    for r in results:
+        if "error" in r:
+            print(f"{r['stage']:<18} failed: {r['error']}")
+            continue
+        print(f"{r['stage']:<18}{r['fps']:>10.1f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+              f"{r['peak_rss_mb']:>10.0f}{r['rss_growth_mb']:>8.1f}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the capture and processing stages")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES),
+                        help="stages to run (default: all)")
+    parser.add_argument("--iterations", type=int, default=50, help="timed calls per stage")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed calls before measuring")
+    parser.add_argument("--frames", type=int, default=16, help="distinct frames per sensor")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic frames")
+    parser.add_argument("--archive", metavar="PATH",
+                        help="use frames of a recorded session or tar archive instead of synthetic ones")
+    parser.add_argument("--calibration", metavar="FILE", help="calibration.npz for the align stage")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="save this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before a stage counts as a regression (0.25 = 25%%)")
+    parser.add_argument("--output", metavar="FILE", help="also save the results as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.calibration:
+        args.calibration = os.path.abspath(args.calibration)
+    if args.archive:
+        args.archive = os.path.abspath(args.archive)
+
+    print(f"------- Benchmark ({machine_id()}) -------")
+    results = run_benchmarks(args)
+    print_results(results)
+
+    report = {"machine": machine_id(), "python": platform.python_version(),
+              "numpy": np.__version__, "opencv": cv2.__version__,
+              "input": input_id(args), "iterations": args.iterations, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = [r for r in results if "error" in r]
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved as {args.baseline}")
+        return 1 if failed else 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline yet, run with --save-baseline to record one")
+        return 1 if failed else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("input") != report["input"]:
+        print(f"Baseline was recorded on {baseline.get('input', 'an unrecorded input')}, this run on "
+              f"{report['input']}: not compared, run with --save-baseline to record one for this input")
+        return 1 if failed else 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if baseline.get("machine") != machine_id():
+        print(f"Baseline was recorded on {baseline.get('machine')}, not enforced on this machine")
+        for r in regressions:
+            print(f"  {r}")
+        return 1 if failed else 0
+
+    if regressions:
+        print("------- PERFORMANCE REGRESSIONS -------")
+        for r in regressions:
+            print(f"  {r}")
+        return 1
+    print("No regressions against the baseline")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
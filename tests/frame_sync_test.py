@@ -0,0 +1,71 @@
+"""
+File: frame_sync_test.py
+Description:
+    Checks that FrameSynchronizer pairs the streams the same way whatever order their frames arrive in.
+
+    Notes:
+    - The thermal and depth frames are pushed interleaved, then with one stream arriving in a burst
+      ahead of the other (a collector thread that stalled and caught up), both ways round
+    - Every thermal frame must come out matched to the depth frame taken at the same time, with no
+      dropped bundle
+    - A depth stream that stops is flushed by the reference buffer filling up and by flush()
+    - Exits with an error when a check fails
+
+"""
+# import libraries here
+import sys
+from typing import *
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "Scripts"))
+from frame_sync import FrameSynchronizer
+
+def frames(sensor: str, times: Iterable[float]) -> List[Dict]:
+    """ Minimal frames of one sensor at the given monotonic times """
+    return [{"sensor": sensor, "timestamp": f"{t:.3f}", "t_mono": t, "arrays": {}} for t in times]
+
+def run(order: List[Dict], **kwargs) -> Tuple[List[Dict], Dict]:
+    """ Pushes the frames in the given order and flushes, returns the bundles and the stats """
+    sync = FrameSynchronizer(sensors=("thermal", "depth"), reference="thermal", **kwargs)
+    bundles = []
+    for frame in order:
+        bundles += sync.push(frame)
+    bundles += sync.flush()
+    return bundles, sync.stats
+
+def check(name: str, bundles: List[Dict], stats: Dict, expected: int) -> List[str]:
+    """ Every bundle pairs frames taken at the same time, none is dropped """
+    errors = []
+    if len(bundles) != expected or stats["dropped_bundles"]:
+        errors.append(f"{name}: {len(bundles)} bundles (dropped {stats['dropped_bundles']}), expected {expected}")
+    for bundle in bundles:
+        thermal, depth = bundle["frames"]["thermal"], bundle["frames"]["depth"]
+        if thermal["t_mono"] != depth["t_mono"]:
+            errors.append(f"{name}: thermal {thermal['t_mono']} paired with depth {depth['t_mono']}")
+    return errors
+
+def main() -> int:
+    times = [float(t) for t in range(6)]
+    thermal, depth = frames("thermal", times), frames("depth", times)
+    errors = []
+
+    interleaved = [frame for pair in zip(thermal, depth) for frame in pair]
+    errors += check("interleaved", *run(interleaved, tolerance=0.5), expected=6)
+    errors += check("thermal burst ahead", *run(thermal + depth, tolerance=0.5), expected=6)
+    errors += check("depth burst ahead", *run(depth + thermal, tolerance=0.5), expected=6)
+
+    # depth stops after t=1: the full reference buffer and flush() still emit every thermal frame
+    longer = frames("thermal", [float(t) for t in range(8)])
+    order = [longer[0], depth[0], longer[1], depth[1]] + longer[2:]
+    bundles, stats = run(order, tolerance=0.5, max_buffer=4, require_all=False)
+    if len(bundles) != 8 or stats["unmatched"]["depth"] != 6:
+        errors.append(f"stalled depth: {len(bundles)} bundles, {stats['unmatched']['depth']} unmatched, "
+                      f"expected 8 and 6")
+
+    for error in errors:
+        print(f"FAILED {error}")
+    print("FrameSynchronizer checks " + ("failed" if errors else "passed"))
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+File: startup_budget.py
+Description:
+    Measures how long the entry points of the pipeline take to start, so a heavy import at module
+    level (matplotlib, a sensor SDK, ...) shows up before it slows every tool and pool worker down.
+
+    Notes:
+    - Every entry point is imported in a fresh interpreter, the fastest of --runs imports is compared
+      against the fastest `import numpy, cv2`, the floor every tool pays anyway; the minimum is the
+      run the rest of the machine disturbed least, so the check does not fail at random on a busy box
+    - The budgets are the time allowed on top of that floor as a fraction of it, so they carry over
+      from a laptop to the Pi
+    - Offline tools and pool workers must not load matplotlib or the sensor SDKs, the script fails if
+      any of them shows up in sys.modules after the import
+    - Pool worker start (pool created -> first task done) is measured for every start method with the
+      same preload and initializer as the pipeline, the forkserver number is the one the harness pays
+    - Exits with an error when an entry point is over its budget or loads a forbidden module
+
+"""
+# import libraries here (standard library only, forkserver and spawn workers import this file again)
+import os
+import ast
+import sys
+import json
+import time
+import argparse
+import subprocess
+import functools
+from typing import *
+from pathlib import Path
+
+import multiprocessing as mp
+
+SCRIPTS = Path(__file__).resolve().parent.parent / "Scripts"
+TESTS = Path(__file__).resolve().parent
+PATHS = [str(SCRIPTS), str(SCRIPTS / "HotspotDetection"), str(TESTS)]
+
+# modules only the capture processes (or --publication) may load
+FORBIDDEN = ["matplotlib", "adafruit_mlx90640", "ArducamDepthCamera", "picamera2", "RPi", "board", "busio"]
+
+# entry point -> time allowed on top of the numpy + cv2 floor, as a fraction of the floor; the floor
+# itself moves by a fifth between runs, matplotlib alone costs about 5x the floor
+BUDGETS = {
+    "frame_handlers": 1.0,      # what every forkserver worker imports
+    "pipeline_runner": 1.5,
+    "all_sensor_test": 1.5,
+    "session_reader": 1.0,
+    "registration": 1.0,
+    "temporal_filter": 1.0,
+    "depth_anomaly": 1.0,
+    "tracker": 1.0,
+    "process_depth_data": 1.0,
+    "process_thermal_data": 1.0,
+    "probability_map": 1.0,
+    "preview_server": 1.5,
+    "batch_reprocess": 1.0,
+}
+
+# worker start -> allowed milliseconds (fork and forkserver reuse the parent or server imports)
+WORKER_BUDGETS_MS = {"fork": 250.0, "forkserver": 250.0, "spawn": None}
+
+# ------------------------------------------------------------------------------
+# Imports
+# ------------------------------------------------------------------------------
+
+PROBE = """
+import sys, time
+sys.path[:0] = {paths!r}
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+forbidden = sorted(name for name in {forbidden!r} if name in sys.modules)
+print(repr((elapsed, forbidden)))
+"""
+
+def time_import(statement: str, runs: int = 5) -> Tuple[float, List[str]]:
+    """ Times an import statement in fresh interpreters
+
+    Args:
+        statement (str): e.g. "import frame_handlers"
+        runs (int): interpreters started, the fastest is returned
+
+    Returns:
+        Tuple[float, List[str]]: fastest seconds and the forbidden modules that were loaded
+    """
+    code = PROBE.format(paths=PATHS, statement=statement, forbidden=FORBIDDEN)
+    times, loaded = [], set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=str(TESTS)).stdout
+        elapsed, forbidden = ast.literal_eval(output.strip().splitlines()[-1])
+        times.append(elapsed)
+        loaded.update(forbidden)
+    return min(times), sorted(loaded)
+
+# ------------------------------------------------------------------------------
+# Workers
+# ------------------------------------------------------------------------------
+
+def probe_worker(_=None) -> Tuple[bool, List[str]]:
+    """ Task run by the measured workers: whether the handlers are loaded and the forbidden modules that are """
+    return "frame_handlers" in sys.modules, sorted(name for name in FORBIDDEN if name in sys.modules)
+
+def time_worker_start(method: str, runs: int = 3) -> Tuple[float, float, List[str]]:
+    """ Times pools started like the pipeline's FrameScheduler pools
+
+    Args:
+        method (str): multiprocessing start method
+        runs (int): pools started, the first one also starts the forkserver
+
+    Returns:
+        Tuple[float, float, List[str]]: seconds to the first result of the first pool, the fastest of
+        the later pools, and the forbidden modules the workers had loaded
+    """
+    from frame_scheduler import export_sys_path
+    from image_writer import configure_writer
+
+    context = mp.get_context(method)
+    if method == "forkserver":
+        export_sys_path()
+        context.set_forkserver_preload(["frame_handlers"])
+    times, loaded = [], set()
+    for _ in range(runs):
+        start = time.perf_counter()
+        pool = context.Pool(processes=1, initializer=functools.partial(configure_writer))
+        try:
+            preloaded, forbidden = pool.apply(probe_worker)
+        finally:
+            pool.terminate()
+            pool.join()
+        times.append(time.perf_counter() - start)
+        loaded.update(forbidden)
+        if method == "forkserver" and not preloaded:
+            loaded.add("(frame_handlers not preloaded)")
+    return times[0], min(times[1:] or times), sorted(loaded)
+
+# ------------------------------------------------------------------------------
+# Main
+# ------------------------------------------------------------------------------
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the startup time of the entry points and pool workers")
+    parser.add_argument("--entry-points", nargs="+", choices=list(BUDGETS), default=list(BUDGETS),
+                        help="entry points to import (default: all)")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per entry point")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiplies every budget, e.g. while a slow SD card warms up")
+    parser.add_argument("--output", metavar="FILE", help="also save the results as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    sys.path[:0] = PATHS
+    over = []
+
+    floor, _ = time_import("import numpy, cv2", args.runs)
+    print(f"------- Import time (floor: numpy + cv2 {floor * 1000:.0f} ms) -------")
+    print(f"{'entry point':<22}{'ms':>8}{'+ms':>8}{'budget':>8}  forbidden")
+    imports = []
+    for name in args.entry_points:
+        elapsed, forbidden = time_import(f"import {name}", args.runs)
+        extra = max(elapsed - floor, 0.0)
+        budget = BUDGETS[name] * floor * args.scale
+        imports.append({"entry_point": name, "ms": elapsed * 1000, "extra_ms": extra * 1000,
+                        "budget_ms": budget * 1000, "forbidden": forbidden})
+        print(f"{name:<22}{elapsed * 1000:>8.0f}{extra * 1000:>8.0f}{budget * 1000:>8.0f}  {', '.join(forbidden) or '-'}")
+        if extra > budget:
+            over.append(f"{name}: {extra * 1000:.0f} ms on top of numpy + cv2, budget {budget * 1000:.0f} ms")
+        if forbidden:
+            over.append(f"{name}: loads {', '.join(forbidden)}")
+
+    print("------- Pool worker start -------")
+    print(f"{'start method':<22}{'first ms':>10}{'next ms':>10}{'budget':>8}  forbidden")
+    workers = []
+    for method in mp.get_all_start_methods():
+        first, later, forbidden = time_worker_start(method)
+        budget = WORKER_BUDGETS_MS.get(method)
+        workers.append({"start_method": method, "first_ms": first * 1000, "ms": later * 1000,
+                        "budget_ms": budget, "forbidden": forbidden})
+        print(f"{method:<22}{first * 1000:>10.0f}{later * 1000:>10.0f}"
+              f"{'-' if budget is None else f'{budget * args.scale:.0f}':>8}  {', '.join(forbidden) or '-'}")
+        if budget is not None and later * 1000 > budget * args.scale:
+            over.append(f"{method} workers: {later * 1000:.0f} ms to start, budget {budget * args.scale:.0f} ms")
+        if forbidden:
+            over.append(f"{method} workers: load {', '.join(forbidden)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version.split()[0], "floor_ms": floor * 1000,
+                       "imports": imports, "workers": workers}, f, indent=2)
+
+    if over:
+        print("------- OVER BUDGET -------")
+        for message in over:
+            print(f"  {message}")
+        return 1
+    print("All entry points within budget")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())